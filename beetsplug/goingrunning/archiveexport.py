@@ -0,0 +1,156 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import contextlib
+import io
+import os
+import tarfile
+import time
+from pathlib import Path
+
+from alive_progress import alive_bar
+from beets import util
+from beetsplug.goingrunning import common
+from beetsplug.goingrunning.itemexport import ItemExport
+
+
+class ArchiveExport(ItemExport):
+    """Streams the songs and the playlist into one tar archive, on the
+    target or, if the target declares an `archive_path`, into a local file
+    for later transfer. Players that are slow at creating many small files
+    get one big sequential file instead.
+    """
+
+    def prepare(self):
+        # A local archive does not take any space on the target
+        if not self._get_target_attribute("archive_path"):
+            with self.stats.stage("capacity"):
+                if not self._check_capacity():
+                    return False
+            with self.stats.stage("clean"):
+                self._clean_target()
+
+        return True
+
+    def copy(self):
+        with self.stats.stage("copy"):
+            self._write_archive(self._get_archive_path())
+
+    def finish(self, write_tags=True):
+        # The playlist is inside the archive
+        if write_tags:
+            self.write_tags()
+        self._finish_cleaning()
+        self._report()
+
+    def _get_report_path(self):
+        return "{0}.report.json".format(
+            os.path.splitext(self._get_archive_path())[0])
+
+    def _write_archive(self, archive_path):
+        profile = self._get_transcode_profile()
+        jobs = self._get_jobs(Path(self._get_cleaned_training_name()))
+
+        common.say("Archiving to target[{0}]: {1}".format(self.target_name,
+                                                        archive_path))
+        if self.cfg_dry_run:
+            for job in jobs:
+                common.say("Archiving[{1}]: {0}{2}".format(
+                    job["src"], job["filename"],
+                    " (transcode: {})".format(profile)
+                    if job["transcode"] else ""))
+            self._set_plan(jobs)
+            return
+
+        transcoder = None
+        if any(job["transcode"] for job in jobs):
+            transcoder = self._get_transcoder(profile)
+
+        # The archive is only put in place once it is complete
+        part_path = "{0}.part".format(archive_path)
+        buffer_size = self._get_file_copier().buffer_size
+        archived = []
+        try:
+            with open(part_path, "wb", buffering=buffer_size) as archive, \
+                    tarfile.open(fileobj=archive, mode="w") as tar, \
+                    alive_bar(len(jobs)) as bar, \
+                    transcoder or contextlib.nullcontext():
+                tar.copybufsize = buffer_size
+
+                # The songs are transcoded ahead while they are archived in
+                # their order
+                src_futures = [transcoder.submit(
+                    job["src"], os.path.splitext(job["filename"])[0])
+                    if job["transcode"] else None for job in jobs]
+
+                for job, src_future in zip(jobs, src_futures):
+                    src = src_future.result() if src_future else job["src"]
+                    common.say("Archiving[{1}]: {0}".format(job["src"],
+                                                            job["filename"]))
+                    start_time = time.monotonic()
+                    size = self._add_file_to_archive(tar, src,
+                                                     str(job["dst"]))
+                    self.stats.add_file(size, time.monotonic() - start_time)
+                    self._set_export_path(job)
+                    archived.append(job["item"])
+                    bar()
+
+                if self._get_target_attribute("generate_playlist"):
+                    playlist = "".join("{}\n".format(line) for line in
+                                       self._get_playlist_lines())
+                    name = "{0}/{1}.m3u".format(
+                        self._get_cleaned_training_name(),
+                        self._get_training_name())
+                    self._add_data_to_archive(tar, playlist.encode("utf-8"),
+                                              name)
+            os.replace(part_path, archive_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(part_path)
+            raise
+        finally:
+            if transcoder:
+                self._release_transcoder(transcoder)
+
+        # The songs are only on the target once the archive is in place
+        if common.get_training_attribute(self.training,
+                                         "increment_play_count"):
+            for item in archived:
+                self._increment_play_count(item)
+            self._store_play_counts()
+
+    @staticmethod
+    def _add_file_to_archive(tar: tarfile.TarFile, src, name):
+        """Streams the file into the archive straight from its source"""
+        with open(util.syspath(src), "rb") as src_file:
+            st = os.fstat(src_file.fileno())
+            info = tarfile.TarInfo(name)
+            info.size = st.st_size
+            info.mtime = int(st.st_mtime)
+            info.mode = 0o644
+            tar.addfile(info, src_file)
+
+        return info.size
+
+    @staticmethod
+    def _add_data_to_archive(tar: tarfile.TarFile, data, name):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(data))
+
+    def _get_archive_path(self):
+        """Returns the path of the archive: the `archive_path` target
+        attribute (a file or a folder) or a file in the target folder.
+        """
+        filename = "{}.tar".format(self._get_training_name())
+        archive_path = self._get_target_attribute("archive_path")
+        if not archive_path:
+            return os.path.join(self._get_destination_path(), filename)
+
+        archive_path = os.path.expanduser(archive_path)
+        if os.path.isdir(archive_path):
+            archive_path = os.path.join(archive_path, filename)
+
+        return archive_path
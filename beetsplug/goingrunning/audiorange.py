@@ -0,0 +1,124 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import os
+import struct
+
+from beets import util
+from beetsplug.goingrunning import common
+from beetsplug.goingrunning import merge
+
+
+def get_audio_key(path):
+    """Returns a key derived from the audio of the file only. Rewriting the
+    tags of the song (e.g. the play count) does not change it.
+    """
+    start, end = get_audio_range(path)
+    return common.get_file_content_key(path, start=start, end=end)
+
+
+def get_audio_range(path):
+    """Returns the (start, end) offsets of the audio data of the file, the
+    tags are left out. MP3, FLAC, MP4 (M4A) and Ogg files are recognized,
+    for any other file the whole file is returned.
+    """
+    path = util.syspath(path)
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = f.read(10)
+        start = 0
+        if len(head) == 10 and head[0:3] == b"ID3":
+            # Some FLAC files get an ID3v2 tag too
+            start = 10 + _get_syncsafe_int(head[6:10]) + \
+                (10 if head[5] & 0x10 else 0)
+        f.seek(start)
+        head = f.read(12)
+
+        if head[0:4] == b"fLaC":
+            audio_range = _get_flac_audio_range(f, start, size)
+        elif head[0:4] == b"OggS":
+            audio_range = _get_ogg_audio_range(f, start, size)
+        elif head[4:8] == b"ftyp":
+            audio_range = _get_mp4_audio_range(f, start, size)
+        elif os.path.splitext(util.displayable_path(path))[1].lower() == \
+                merge.MP3_EXTENSION:
+            audio_range = merge.get_mp3_audio_range(path)
+        else:
+            audio_range = None
+
+    if not audio_range or audio_range[1] <= audio_range[0]:
+        return 0, size
+
+    return audio_range
+
+
+def _get_syncsafe_int(data):
+    return (data[0] & 0x7f) << 21 | (data[1] & 0x7f) << 14 | \
+           (data[2] & 0x7f) << 7 | (data[3] & 0x7f)
+
+
+def _get_flac_audio_range(f, start, size):
+    """The audio frames follow the metadata blocks (the Vorbis comments and
+    the padding are metadata blocks too)
+    """
+    offset = start + 4
+    while offset + 4 <= size:
+        f.seek(offset)
+        header = f.read(4)
+        if len(header) < 4:
+            return None
+        offset += 4 + int.from_bytes(header[1:4], "big")
+        if header[0] & 0x80:
+            # The last metadata block
+            return offset, _get_id3v1_start(f, offset, size)
+
+    return None
+
+
+def _get_ogg_audio_range(f, start, size):
+    """The audio pages follow the header pages (identification, comments
+    and setup), which are the ones with a granule position of 0
+    """
+    offset = start
+    while offset + 27 <= size:
+        f.seek(offset)
+        header = f.read(27)
+        if len(header) < 27 or header[0:4] != b"OggS":
+            return None
+        granule = struct.unpack("<q", header[6:14])[0]
+        if granule != 0:
+            return offset, size
+        segments = f.read(header[26])
+        offset += 27 + len(segments) + sum(segments)
+
+    return None
+
+
+def _get_mp4_audio_range(f, start, size):
+    """The audio is in the `mdat` atom, the tags in the `moov` atom"""
+    offset = start
+    while offset + 8 <= size:
+        f.seek(offset)
+        header = f.read(16)
+        atom_size = int.from_bytes(header[0:4], "big")
+        header_size = 8
+        if atom_size == 1:
+            atom_size = int.from_bytes(header[8:16], "big")
+            header_size = 16
+        elif atom_size == 0:
+            atom_size = size - offset
+        if atom_size < header_size:
+            return None
+        if header[4:8] == b"mdat":
+            return offset + header_size, min(size, offset + atom_size)
+        offset += atom_size
+
+    return None
+
+
+def _get_id3v1_start(f, offset, size):
+    if size - offset >= 128:
+        f.seek(size - 128)
+        if f.read(3) == b"TAG":
+            return size - 128
+    return size
@@ -4,18 +4,19 @@
 
 from optparse import OptionParser
 
-from beets import library
 from beets import logging
 from beets.dbcore import query
 from beets.dbcore.db import Results
 from beets.dbcore.queryparse import parse_query_part, construct_query_part
-from beets.library import Library, Item
+from beets.library import Library
 from beets.ui import Subcommand, decargs
 from confuse import Subview
 from beetsplug.goingrunning import common
+from beetsplug.goingrunning import export
 from beetsplug.goingrunning import itemexport
 from beetsplug.goingrunning import itemorder
 from beetsplug.goingrunning import itempick
+from beetsplug.goingrunning import libquery
 
 
 class GoingRunningCommand(Subcommand):
@@ -29,6 +30,8 @@ class GoingRunningCommand(Subcommand):
     cfg_quiet = False
     cfg_count = False
     cfg_dry_run = False
+    cfg_resume = False
+    cfg_plan_path = None
 
     def __init__(self, cfg):
         self.config = cfg
@@ -57,6 +60,20 @@ class GoingRunningCommand(Subcommand):
             help=u'Do not delete/copy any songs. Just show what would be done'
         )
 
+        self.parser.add_option(
+            '--plan',
+            action='store', dest='plan_path', default=None, metavar='PATH',
+            help=u'write the export plan with the estimated duration as JSON '
+                 u'to PATH ("-" for the output) without copying (implies '
+                 u'--dry-run)'
+        )
+
+        self.parser.add_option(
+            '--resume',
+            action='store_true', dest='resume', default=False,
+            help=u'resume the interrupted export of a training'
+        )
+
         self.parser.add_option(
             '-q', '--cfg_quiet',
             action='store_true', dest='quiet', default=False,
@@ -81,7 +98,9 @@ class GoingRunningCommand(Subcommand):
     def func(self, lib: Library, options, arguments):
         self.cfg_quiet = options.quiet
         self.cfg_count = options.count
-        self.cfg_dry_run = options.dry_run
+        self.cfg_plan_path = options.plan_path
+        self.cfg_dry_run = options.dry_run or bool(self.cfg_plan_path)
+        self.cfg_resume = options.resume
 
         self.lib = lib
         self.query = decargs(arguments)
@@ -149,23 +168,45 @@ class GoingRunningCommand(Subcommand):
                     training_name), log_only=False)
             return
 
-        # Verify target device path path
-        if not common.get_destination_path_for_training(training):
-            self._say(
-                "Invalid target!", log_only=False)
+        # Verify target device path path (of each target of the training)
+        target_names = common.get_target_names_for_training(training)
+        for target_name in target_names or [None]:
+            if self._is_local_archive_target(training, target_name):
+                continue
+            if not common.get_destination_path_for_training(training,
+                                                            target_name):
+                self._say(
+                    "Invalid target!", log_only=False)
+                return
+
+        if self.cfg_resume:
+            self.resume_training(training)
             return
 
-        # Get the library items
-        lib_items: Results = self._retrieve_library_items(training)
+        # Queries on numeric flexible attributes can use an index
+        if common.get_training_attribute(training, "numeric_index"):
+            libquery.create_numeric_index(self.lib)
+
+        parsed_query = self._get_training_query(training)
+        lib_items = None
+        needs_match = libquery.split_query(parsed_query)[1] is not None
+        if needs_match:
+            # The items need to be loaded to be matched anyway: they are
+            # retrieved only once and counted
+            lib_items = self._retrieve_library_items(training, parsed_query)
+            available = len(lib_items)
+        else:
+            # Count the library items (without loading them)
+            available = libquery.count_items(self.lib, parsed_query)
 
         # Show count only
         if self.cfg_count:
-            self._say("Number of songs available: {}".format(len(lib_items)),
+            self._say("Number of songs available: {}".format(available),
                       log_only=False)
             return
 
         # Check count
-        if len(lib_items) < 1:
+        if available < 1:
             self._say(
                 "No songs in your library match this training!", log_only=False)
             return
@@ -176,6 +217,22 @@ class GoingRunningCommand(Subcommand):
                       log_only=False)
             return
 
+        # Get the library items
+        lightweight = common.get_training_attribute(training,
+                                                    "lightweight_retrieval")
+        if lightweight and needs_match:
+            self._say("The query of the training needs the full songs, "
+                      "lightweight retrieval is not possible.")
+            lightweight = False
+        elif lightweight:
+            lib_items = libquery.get_light_items(
+                self.lib, parsed_query,
+                self._get_light_item_fields(training),
+                common.get_query_model())
+        if lib_items is None:
+            lib_items: Results = self._retrieve_library_items(training,
+                                                              parsed_query)
+
         # 1) order items by `ordering_strategy`
         sorted_items = itemorder.get_ordered_items(training, lib_items)
         # flds = ["ordering_score", "artist", "title"]
@@ -186,6 +243,9 @@ class GoingRunningCommand(Subcommand):
             common.get_training_attribute(training, "favour_unplayed")
         sel_items = itempick.get_items_for_duration(training, sorted_items,
                                                     duration * 60)
+        if lightweight:
+            # Only the selected songs are loaded with all their fields
+            sel_items = libquery.hydrate_items(self.lib, sel_items)
 
         # 3) Show some info
         total_time = common.get_duration_of_items(sel_items)
@@ -202,9 +262,42 @@ class GoingRunningCommand(Subcommand):
         self.display_library_items(sel_items, flds, prefix="Selected: ")
 
         # 5) Clean, Copy, Playlist, Run
-        itemexport.generate_output(training, sel_items, self.cfg_dry_run)
+        if not export.generate_output(training, sel_items,
+                                          self.cfg_dry_run,
+                                          plan_path=self.cfg_plan_path):
+            return
         self._say("Run!", log_only=False)
 
+    def resume_training(self, training: Subview):
+        """Continues the interrupted export of the training with the songs
+        that were selected for it (as registered in the journal on the target)
+        """
+        sel_items = itemexport.get_journal_items(training, self.lib)
+        if not sel_items:
+            self._say("There is no interrupted export to resume for this "
+                      "training!", log_only=False)
+            return
+
+        self._say("Resuming export of {} songs".format(len(sel_items)),
+                  log_only=False)
+        flds = ["play_count", "artist", "title"]
+        self.display_library_items(sel_items, flds, prefix="Selected: ")
+
+        if not export.generate_output(training, sel_items,
+                                          self.cfg_dry_run, resume=True,
+                                          plan_path=self.cfg_plan_path):
+            return
+        self._say("Run!", log_only=False)
+
+    @staticmethod
+    def _is_local_archive_target(training: Subview, target_name):
+        """Targets exporting to a local archive do not need the device"""
+        return target_name and common.get_target_attribute_for_training(
+            training, "export_mode", target_name) == \
+            itemexport.EXPORT_MODE_ARCHIVE and \
+            common.get_target_attribute_for_training(
+                training, "archive_path", target_name)
+
     def _get_training_query_element_keys(self, training):
         # todo: move to common
         answer = []
@@ -308,29 +401,56 @@ class GoingRunningCommand(Subcommand):
 
         return query.AndQuery(query_parts)
 
-    def _retrieve_library_items(self, training: Subview):
+    def _retrieve_library_items(self, training: Subview, parsed_query=None):
         """Returns the results of the library query for a specific training
-        The storing/overriding/restoring of the library.Item._types
-        is made necessary by this issue:
-        https://github.com/beetbox/beets/issues/3520
-        Until the issue is solved this 'hack' is necessary.
         """
-        full_query = self._gather_query_elements(training)
+        if parsed_query is None:
+            parsed_query = self._get_training_query(training)
 
-        # Store a copy of defined types and update them with our own overrides
-        original_types = library.Item._types.copy()
-        override_types = common.get_item_attribute_type_overrides()
-        library.Item._types.update(override_types)
+        return libquery.get_items(self.lib, parsed_query)
 
-        # Execute the query parsing (using our own type overrides)
-        parsed_query = self.parse_query_elements(full_query, Item)
+    @staticmethod
+    def _get_light_item_fields(training: Subview):
+        """The fields that the ordering and the picking of the songs use"""
+        fields = ["length", "play_count", "path"]
+        ordering = common.get_training_attribute(training, "ordering")
+        if ordering:
+            fields.extend(str(key).strip() for key in ordering.keys())
+
+        return fields
+
+    def _get_training_query(self, training: Subview):
+        """Returns the parsed library query of a specific training
+        The query is parsed with a subclass of Item carrying our own type
+        overrides (see `common.get_query_model`) because of this issue:
+        https://github.com/beetbox/beets/issues/3520
+        """
+        def build():
+            full_query = self._gather_query_elements(training)
+            return self.parse_query_elements(full_query,
+                                             common.get_query_model())
 
-        # Restore the original types
-        library.Item._types = original_types.copy()
+        parsed_query = libquery.get_query_cache().get(
+            self._get_query_cache_key(training), build)
 
         self._say("Parsed query: {}".format(parsed_query))
 
-        return self.lib.items(parsed_query)
+        return parsed_query
+
+    def _get_query_cache_key(self, training: Subview):
+        """The parsed query depends on the command line terms, the query of
+        the training and the flavours it uses
+        """
+        flavour_names = common.get_training_attribute(training, "use_flavours")
+        if type(flavour_names) == str:
+            flavour_names = [flavour_names]
+        flavours = [(name, self.config["flavours"][name].get()
+                     if self.config["flavours"][name].exists() else None)
+                    for name in flavour_names or []]
+
+        return libquery.get_query_cache_key(
+            self.query, common.get_training_attribute(training, "query"),
+            flavours)
 
     def display_library_items(self, items, fields, prefix=""):
         fmt = prefix
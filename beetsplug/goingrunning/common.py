@@ -1,18 +1,29 @@
 #  Copyright: Copyright (c) 2020., Adam Jakab
 #  Author: Adam Jakab <adam at jakab dot pro>
 #  License: See LICENSE.txt
+import contextlib
+import hashlib
 import importlib
+import json
 # todo: use beets logger?!
 # from beets import logging
 import logging
 import os
 import random
 import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from beets.dbcore import types
+from beets import config as beets_config
 from beets.library import Item
 from confuse import Subview
+from beetsplug.goingrunning import libquery
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Get values as: plg_ns['__PLUGIN_NAME__']
 plg_ns = {}
@@ -65,13 +76,38 @@ def say(msg: str, log_only=True, is_error=False):
 
 
 def get_item_attribute_type_overrides():
+    # Queries on these attributes are evaluated by the database
     _types = {}
     for attr in KNOWN_NUMERIC_FLEX_ATTRIBUTES:
-        _types[attr] = types.Float(6)
+        _types[attr] = libquery.FlexFloat(6)
 
     return _types
 
 
+def get_query_model(model_cls=Item):
+    """Returns a subclass of the model class carrying the type overrides of
+    the plugin. Queries parsed with it get the right query classes for the
+    flexible attributes (https://github.com/beetbox/beets/issues/3520)
+    while the types of the model class itself, which are shared by the whole
+    process, are left untouched. Queries can be parsed in several threads.
+    """
+    _types = dict(model_cls._types)
+    _types.update(get_item_attribute_type_overrides())
+
+    return type("GoingRunning{0}".format(model_cls.__name__), (model_cls,),
+                {"_types": _types})
+
+
+def get_plugin_data_dir(*parts):
+    """Returns (and creates) a folder for the local data of the plugin
+    (caches, stores) inside the beets configuration directory.
+    """
+    path = os.path.join(beets_config.config_dir(), plg_ns['__PLUGIN_NAME__'],
+                        *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
 def get_human_readable_time(seconds):
     """Formats seconds as a short human-readable HH:MM:SS string.
     """
@@ -81,6 +117,46 @@ def get_human_readable_time(seconds):
     return "%d:%02d:%02d" % (h, m, s)
 
 
+def get_human_readable_size(size):
+    """Formats a byte count as a short human-readable string (1.5MB).
+    """
+    size = float(size)
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024:
+            return "{0:.1f}{1}".format(size, unit)
+        size /= 1024
+
+    return "{0:.1f}{1}".format(size, "TB")
+
+
+def get_size_in_bytes(value):
+    """Converts a size given as a number of bytes or as a string with a unit
+    (500MB, 1.5 GB) to bytes. Returns None for empty or invalid values.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+
+    if isinstance(value, (int, float)):
+        return int(value) if value > 0 else None
+
+    units = {"TB": 1024 ** 4, "GB": 1024 ** 3, "MB": 1024 ** 2,
+             "KB": 1024, "B": 1}
+    value = str(value).strip().upper()
+    multiplier = 1
+    for unit, unit_multiplier in units.items():
+        if value.endswith(unit):
+            value = value[:-len(unit)].strip()
+            multiplier = unit_multiplier
+            break
+
+    try:
+        size = int(float(value) * multiplier)
+    except ValueError:
+        return None
+
+    return size if size > 0 else None
+
+
 def get_normalized_query_element(key, val):
     answer = ""
 
@@ -128,16 +204,39 @@ def get_training_attribute(training: Subview, attrib: str):
     return value
 
 
-def get_target_for_training(training: Subview):
+def get_target_names_for_training(training: Subview):
+    """Returns the names of the targets of the training. The `target`
+    attribute can be a single target name or a list of target names.
+    """
+    target = get_training_attribute(training, "target")
+    if not target:
+        return []
+
+    if isinstance(target, (list, tuple)):
+        return [str(name) for name in target if name]
+
+    return [target]
+
+
+def _get_target_name(training: Subview, target_name=None):
+    """Returns `target_name` or the (first) target of the training"""
+    if target_name:
+        return target_name
+
+    target_names = get_target_names_for_training(training)
+    return target_names[0] if target_names else None
+
+
+def get_target_for_training(training: Subview, target_name=None):
     answer = None
 
-    target_name = get_training_attribute(training, "target")
+    target_name = _get_target_name(training, target_name)
     say("Finding target: {0}".format(target_name))
 
     cfg_targets: Subview = training.parent.parent["targets"]
     if not cfg_targets.exists():
         say("Cannot find 'targets' node!")
-    elif not cfg_targets[target_name].exists():
+    elif not target_name or not cfg_targets[target_name].exists():
         say("Target name '{0}' is not defined!".format(target_name))
     else:
         answer = cfg_targets[target_name]
@@ -146,14 +245,15 @@ def get_target_for_training(training: Subview):
 
 
 def get_target_attribute_for_training(training: Subview,
-                                      attrib: str = "name"):
+                                      attrib: str = "name",
+                                      target_name=None):
     answer = None
 
-    target_name = get_training_attribute(training, "target")
+    target_name = _get_target_name(training, target_name)
     say("Getting attribute[{0}] for target: {1}".format(attrib, target_name),
         log_only=True)
 
-    target = get_target_for_training(training)
+    target = get_target_for_training(training, target_name)
     if target:
         if attrib == "name":
             answer = target_name
@@ -166,18 +266,20 @@ def get_target_attribute_for_training(training: Subview,
     return answer
 
 
-def get_destination_path_for_training(training: Subview):
+def get_destination_path_for_training(training: Subview, target_name=None):
     answer = None
 
-    target_name = get_training_attribute(training, "target")
+    target_name = _get_target_name(training, target_name)
 
     if not target_name:
         say("Training does not declare a `target`!".
             format(target_name), log_only=False)
         return answer
 
-    root = get_target_attribute_for_training(training, "device_root")
-    path = get_target_attribute_for_training(training, "device_path")
+    root = get_target_attribute_for_training(training, "device_root",
+                                             target_name)
+    path = get_target_attribute_for_training(training, "device_path",
+                                             target_name)
     path = path or ""
 
     if not root:
@@ -232,6 +334,51 @@ def get_duration_of_items(items):
     return round(total_time)
 
 
+def get_file_sizes(paths, workers=8, batch_size=64):
+    """Returns the sizes of the files as a dictionary of {path: size}. The
+    size is None for the files that cannot be accessed. The stat calls are
+    made in batches on parallel threads because on network mounted libraries
+    each call can take a round trip.
+    """
+    paths = list(paths)
+    batches = [paths[i:i + batch_size]
+               for i in range(0, len(paths), batch_size)]
+
+    def stat_batch(batch):
+        sizes = {}
+        for path in batch:
+            try:
+                sizes[path] = os.stat(path).st_size
+            except (OSError, TypeError, ValueError):
+                sizes[path] = None
+        return sizes
+
+    answer = {}
+    if len(batches) <= 1:
+        for batch in batches:
+            answer.update(stat_batch(batch))
+        return answer
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(batches))) as ex:
+        for sizes in ex.map(stat_batch, batches):
+            answer.update(sizes)
+
+    return answer
+
+
+def get_folder_size(path):
+    """Returns the total size of the files inside the folder (recursively)"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+
+    return total
+
+
 def get_min_max_sum_avg_for_items(items, field_name):
     _min = 99999999.9
     _max = 0
@@ -280,6 +427,47 @@ def increment_play_count_on_item(item: Item, store=True, write=True):
     if write:
         item.write()
 
+
+def increment_play_count_on_items(items, write=True):
+    """Increments the play count of the items in a single transaction of the
+    library. The increment is made by the database itself so that the counts
+    of concurrent runs are never lost. An item listed twice is incremented
+    twice. The new counts are set on the items (without making them dirty).
+    """
+    stored = [item for item in items if item._db and item.id]
+    for item in items:
+        if not (item._db and item.id):
+            increment_play_count_on_item(item, store=False, write=write)
+
+    if not stored:
+        return
+
+    counts = {}
+    with stored[0]._db.transaction() as tx:
+        for item in stored:
+            # The row is only inserted if the update did not find it
+            tx.mutate("UPDATE item_attributes "
+                      "SET value = CAST(value AS INTEGER) + 1 "
+                      "WHERE entity_id = ? AND key = 'play_count'",
+                      (item.id,))
+            tx.mutate("INSERT OR IGNORE INTO item_attributes "
+                      "(entity_id, key, value) VALUES (?, 'play_count', 1)",
+                      (item.id,))
+        for item_id in set(item.id for item in stored):
+            rows = tx.query("SELECT value FROM item_attributes "
+                            "WHERE entity_id = ? AND key = 'play_count'",
+                            (item_id,))
+            counts[item_id] = int(rows[0][0])
+
+    for item in stored:
+        # clear_dirty is necessary to make sure that `ordering_score` and
+        # `ordering_info` will not get stored to the library
+        item["play_count"] = counts[item.id]
+        item.clear_dirty()
+        if write:
+            item.write()
+
+
 def get_class_instance(module_name, class_name):
     try:
         module = importlib.import_module(module_name)
@@ -295,6 +483,72 @@ def get_class_instance(module_name, class_name):
     return instance
 
 
+def get_file_content_key(path, sample_size=65536, start=0, end=None):
+    """Returns a key derived from the content of the file (or of its bytes
+    from `start` to `end`). Only the size and the head and tail of the
+    content are hashed so that it remains cheap to compute for large audio
+    files.
+    """
+    end = os.path.getsize(path) if end is None else end
+    size = max(0, end - start)
+    digest = hashlib.sha1(str(size).encode("UTF-8"))
+    with open(path, "rb") as f:
+        f.seek(start)
+        digest.update(f.read(min(size, sample_size)))
+        if size > sample_size:
+            f.seek(start + max(sample_size, size - sample_size))
+            digest.update(f.read(min(sample_size, size - sample_size)))
+
+    return digest.hexdigest()
+
+
 def get_random_string(length=6):
     letters = string.ascii_letters + string.digits
     return ''.join(random.choice(letters) for i in range(length))
+
+
+class JsonStore:
+    """A small JSON file in the plugin data folder that keeps one dictionary
+    under `key`. The file is replaced in one step so that a crash never
+    leaves it broken, and it is locked (a lock file next to it) while it is
+    changed so that it can be shared by several runs of beets.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Holds the store for this thread and, where it is supported, for
+        this process (other processes wait for the lock file). The changes
+        are read with `load` and written with `save` while it is held.
+        """
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+
+            with open("{0}.lock".format(self.path), "a") as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def load(self):
+        try:
+            with open(self.path, "r") as store_file:
+                store = json.load(store_file)
+        except (OSError, ValueError):
+            return {}
+
+        data = store.get(self.key) if isinstance(store, dict) else None
+        return data if isinstance(data, dict) else {}
+
+    def save(self, data):
+        tmp_path = "{0}.{1}.tmp".format(self.path, get_random_string())
+        with open(tmp_path, "w") as store_file:
+            json.dump({"version": 1, self.key: data}, store_file)
+        os.replace(tmp_path, self.path)
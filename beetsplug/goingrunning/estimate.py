@@ -0,0 +1,83 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import os
+
+from beetsplug.goingrunning import common
+
+# Only the most recent exports of each target are used for the estimates
+MAX_SAMPLES = 20
+
+
+def get_throughput_profiles():
+    """Returns the store of the measured target speeds in the plugin data
+    folder
+    """
+    return ThroughputProfiles(os.path.join(common.get_plugin_data_dir(),
+                                           "throughput.json"))
+
+
+def fit_profile(samples):
+    """Fits the time of the exports as `seconds = files * overhead + bytes /
+    throughput` (least squares over the samples). Returns a (per file
+    overhead in seconds, throughput in bytes/s) tuple or None if there are
+    no usable samples. If the samples cannot separate the two (a single
+    export or exports of the same shape) the overhead is left out.
+    """
+    samples = [s for s in samples if s.get("bytes", 0) > 0
+               and s.get("seconds", 0) > 0 and s.get("files", 0) > 0]
+    if not samples:
+        return None
+
+    sff = sum(s["files"] ** 2 for s in samples)
+    sbb = sum(s["bytes"] ** 2 for s in samples)
+    sfb = sum(s["files"] * s["bytes"] for s in samples)
+    sfs = sum(s["files"] * s["seconds"] for s in samples)
+    sbs = sum(s["bytes"] * s["seconds"] for s in samples)
+    det = sff * sbb - sfb ** 2
+    if len(samples) > 1 and det > 1e-9 * sff * sbb:
+        overhead = (sfs * sbb - sbs * sfb) / det
+        per_byte = (sff * sbs - sfb * sfs) / det
+        if overhead >= 0 and per_byte > 0:
+            return overhead, 1 / per_byte
+
+    seconds = sum(s["seconds"] for s in samples)
+    return 0, sum(s["bytes"] for s in samples) / seconds
+
+
+def estimate_seconds(profile, files, size):
+    """Returns the estimated time (in seconds) of the export of `files` files
+    of `size` bytes in total with the (overhead, throughput) profile
+    """
+    overhead, throughput = profile
+    return files * overhead + size / throughput
+
+
+class ThroughputProfiles:
+    """A local store of the measured export speed of each target. Every
+    export adds the number of files, the bytes and the time of its copy and
+    the profile of the target is fitted from its recent exports.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._store = common.JsonStore(path, "targets")
+
+    def add_sample(self, key, files, size, seconds):
+        with self._store.locked():
+            profiles = self._store.load()
+            samples = profiles.setdefault(key, [])
+            samples.append({"files": files, "bytes": size,
+                            "seconds": round(seconds, 4)})
+            del samples[:-MAX_SAMPLES]
+            self._store.save(profiles)
+
+    def get_samples(self, key):
+        with self._store.locked():
+            return list(self._store.load().get(key, []))
+
+    def get_profile(self, key):
+        """Returns the (overhead, throughput) profile of the target or None
+        if it was never measured
+        """
+        return fit_profile(self.get_samples(key))
@@ -0,0 +1,327 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import contextlib
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from alive_progress import alive_bar
+from beets import util
+from confuse import Subview
+from beetsplug.goingrunning import common
+from beetsplug.goingrunning import filecopy
+from beetsplug.goingrunning import itemexport
+from beetsplug.goingrunning import tagwrite
+from beetsplug.goingrunning.archiveexport import ArchiveExport
+from beetsplug.goingrunning.itemexport import ItemExport
+from beetsplug.goingrunning.mergedexport import MergedExport
+
+EXPORTERS = {
+    itemexport.EXPORT_MODE_FILES: ItemExport,
+    itemexport.EXPORT_MODE_ARCHIVE: ArchiveExport,
+    itemexport.EXPORT_MODE_MERGED: MergedExport,
+}
+
+
+def generate_output(training: Subview, items, dry_run=False, resume=False,
+                    plan_path=None):
+    target_names = common.get_target_names_for_training(training)
+    if len(target_names) > 1:
+        exporter = MultiTargetExport(training, items, target_names, dry_run,
+                                     resume)
+        exporters = exporter.exporters
+    else:
+        exporter = create_exporter(training, items, dry_run, resume)
+        exporters = [exporter]
+
+    answer = exporter.export()
+    if plan_path:
+        write_plan(plan_path, [e.plan for e in exporters if e.plan])
+
+    return answer
+
+
+def write_plan(path, plans):
+    """Writes the plans of the (dry run) export to each target as JSON to
+    the file or, if `path` is "-", to the standard output
+    """
+    plan = OrderedDict([
+        ("date", datetime.now().isoformat(timespec="seconds")),
+        ("bytes", sum(p["bytes"] for p in plans)),
+        ("targets", plans),
+    ])
+    if path == "-":
+        print(json.dumps(plan, indent=2))
+        return
+
+    with open(path, "w") as plan_file:
+        json.dump(plan, plan_file, indent=2)
+    common.say("Written export plan: {0}".format(path), log_only=False)
+
+
+def create_exporter(training: Subview, items, dry_run=False, resume=False,
+                    target_name=None) -> ItemExport:
+    """Returns the exporter for the `export_mode` of the target"""
+    if not target_name:
+        target_names = common.get_target_names_for_training(training)
+        target_name = target_names[0] if target_names else None
+    export_mode = common.get_target_attribute_for_training(
+        training, "export_mode", target_name) or itemexport.EXPORT_MODE_FILES
+    exporter_class = EXPORTERS.get(export_mode, ItemExport)
+
+    return exporter_class(training, items, dry_run, resume,
+                          target_name=target_name)
+
+
+class MultiTargetExport:
+    """Exports the same items to all the targets of a training. Every song is
+    read only once and written to all the targets concurrently. Each target
+    is cleaned, gets its playlist and its journal like it does with a single
+    target, and a target that fails is left out while the export to the
+    other targets goes on.
+    """
+    training: Subview = None
+    exporters = []
+    cfg_dry_run = False
+    cfg_resume = False
+
+    def __init__(self, training, items, target_names, dry_run=False,
+                 resume=False):
+        self.training = training
+        self.cfg_dry_run = dry_run
+        self.cfg_resume = resume
+        self.exporters = [create_exporter(training, items, dry_run, resume,
+                                          target_name=target_name)
+                          for target_name in target_names]
+        self._counted = set()
+        self._play_counts = []
+        self._journal_entries = []
+        for exporter in self.exporters:
+            exporter.play_count_handler = self._increment_play_count
+
+    def export(self):
+        """Exports the items to the targets. Returns False if the export was
+        not made to any of the targets.
+        """
+        exporters = []
+        archived = 0
+        for exporter in self.exporters:
+            if exporter._get_export_mode() != itemexport.EXPORT_MODE_FILES:
+                # Archives and merged files are written sequentially, one
+                # target at a time
+                try:
+                    archived += 1 if exporter.export() else 0
+                except (OSError, util.FilesystemError) as err:
+                    self._set_failed(exporter, err)
+                continue
+
+            journal = exporter.read_journal() if self.cfg_resume else None
+            if self.cfg_resume and not journal:
+                common.say("There is nothing to resume on target[{0}]".format(
+                    exporter.target_name), log_only=False)
+                continue
+            if journal:
+                self._counted |= journal["counted"]
+
+            try:
+                if not exporter.prepare():
+                    continue
+            except (OSError, util.FilesystemError) as err:
+                self._set_failed(exporter, err)
+                continue
+            exporters.append(exporter)
+
+        # The songs are read once for all the targets
+        copying = [exporter for exporter in exporters
+                   if exporter.copy_jobs is not None]
+        start_time = time.monotonic()
+        try:
+            self._copy_items(copying)
+        finally:
+            self._store_play_counts()
+        for exporter in copying:
+            exporter.stats.add_stage("copy", time.monotonic() - start_time)
+
+        exported = 0
+        for exporter in exporters:
+            if exporter.failed:
+                continue
+            try:
+                # The tags are written once for all the targets
+                exporter.finish(write_tags=False)
+            except (OSError, util.FilesystemError) as err:
+                self._set_failed(exporter, err)
+                continue
+            exported += 1
+
+        if self.exporters:
+            self.exporters[0].write_tags()
+        exported += archived
+
+        common.say("Exported to {0} of {1} targets".format(
+            exported, len(self.exporters)), log_only=False)
+
+        return exported > 0
+
+    def _copy_items(self, exporters):
+        if not exporters:
+            return
+
+        # Group the jobs of all targets by the file that needs to be read
+        groups = OrderedDict()
+        profiles = {}
+        for exporter in exporters:
+            profile = exporter._get_transcode_profile()
+            for job in exporter.copy_jobs:
+                profile_key = profile.key if job["transcode"] else None
+                if profile_key:
+                    profiles[profile_key] = profile
+                groups.setdefault((job["src"], profile_key), []) \
+                    .append((exporter, job))
+
+        copy_workers = max(exporter._get_copy_workers()
+                           for exporter in exporters)
+        copiers = {exporter.target_name: exporter._get_file_copier(
+            copy_workers) for exporter in exporters}
+        # All the targets read the same library files: the lowest read limit
+        # and niceness hold for the shared reads
+        read_limiters = [c.read_limiter for c in copiers.values()
+                         if c.read_limiter]
+        copier = filecopy.FileCopier(
+            buffer_budget=max(c.buffer_size * c.buffer_count * copy_workers
+                              for c in copiers.values()),
+            workers=copy_workers,
+            read_limiter=min(read_limiters, key=lambda l: l.rate)
+            if read_limiters else None,
+            io_nice=max(c.io_nice for c in copiers.values()))
+        common.say("Copy workers: {0} for {1} targets (buffers: {2} x {3})"
+                   .format(copy_workers, len(exporters), copier.buffer_count,
+                           common.get_human_readable_size(
+                               copier.buffer_size)))
+
+        # Targets with the same transcode profile share the transcoding
+        transcoders = {}
+        try:
+            with alive_bar(len(groups)) as bar, \
+                    ThreadPoolExecutor(max_workers=copy_workers,
+                                       initializer=copier.init_worker) \
+                    as executor, contextlib.ExitStack() as stack:
+                for profile_key, profile in profiles.items():
+                    transcoders[profile_key] = stack.enter_context(
+                        ItemExport._get_transcoder(profile))
+
+                futures = {}
+                for index, ((src, profile_key), entries) in \
+                        enumerate(groups.items()):
+                    common.say("Copying[{1} targets]: {0}".format(
+                        src, len(entries)))
+                    src_future = transcoders[profile_key].submit(
+                        src, str(index).zfill(6)) if profile_key else None
+                    future = executor.submit(self._export_group, copier,
+                                             copiers, entries, src_future)
+                    futures[future] = entries
+
+                # The library is only touched from this thread
+                for future in as_completed(futures):
+                    for exporter, job, result, latency in future.result():
+                        if exporter.failed:
+                            continue
+                        if isinstance(result, Exception):
+                            self._set_failed(exporter, result)
+                            continue
+                        exporter._on_file_exported(job, result, latency)
+                    bar()
+        finally:
+            for transcoder in transcoders.values():
+                ItemExport._release_transcoder(transcoder)
+
+    @staticmethod
+    def _export_group(copier: filecopy.FileCopier, copiers, entries,
+                      src_future=None):
+        """Writes the (transcoded) song to the destinations of all the jobs
+        of the group. This is called from the copy worker threads.
+        Returns a list of (exporter, job, size or exception, latency).
+        """
+        try:
+            src = src_future.result() if src_future else entries[0][1]["src"]
+        except Exception as err:
+            return [(exporter, job, err, None) for exporter, job in entries]
+
+        results = []
+        streamed = []
+        for exporter, job in entries:
+            if exporter.failed:
+                continue
+            target_copier = copiers[exporter.target_name]
+            if target_copier.link_files and filecopy.get_link_method(
+                    util.syspath(src), os.path.dirname(job["dst"])) \
+                    != filecopy.METHOD_COPY:
+                start_time = time.monotonic()
+                digest = hashlib.sha1()
+                try:
+                    size = target_copier.copy(src, job["dst"], digest)
+                    job["checksum"] = digest.hexdigest()
+                except Exception as err:
+                    size = err
+                results.append((exporter, job, size,
+                                time.monotonic() - start_time))
+            else:
+                streamed.append((exporter, job))
+
+        if streamed:
+            start_time = time.monotonic()
+            digest = hashlib.sha1()
+            sizes = copier.fan_out(
+                src, [job["dst"] for _, job in streamed],
+                [copiers[exporter.target_name].write_limiter
+                 for exporter, _ in streamed], digest)
+            latency = time.monotonic() - start_time
+            for _, job in streamed:
+                job["checksum"] = digest.hexdigest()
+            results.extend((exporter, job, size, latency)
+                           for (exporter, job), size in zip(streamed, sizes))
+
+        return results
+
+    def _increment_play_count(self, exporter: ItemExport, item):
+        """The play count of a song is incremented only once no matter how
+        many targets it is exported to.
+        """
+        if item.id not in self._counted:
+            self._counted.add(item.id)
+            self._play_counts.append(item)
+        self._journal_entries.append((exporter, item.id))
+        if len(self._play_counts) >= ItemExport._play_count_batch_size_:
+            self._store_play_counts()
+
+    def _store_play_counts(self):
+        items = self._play_counts
+        self._play_counts = []
+        if items:
+            lib = self.exporters[0]._get_library()
+            if lib:
+                tagwrite.get_tag_write_queue(lib).add(
+                    item.id for item in items)
+            common.increment_play_count_on_items(items, write=False)
+
+        for exporter, item_id in self._journal_entries:
+            exporter._write_journal({"type": "counted", "id": item_id})
+        self._journal_entries = []
+
+    @staticmethod
+    def _set_failed(exporter: ItemExport, err):
+        """Leaves the target out of the rest of the export. The journal is
+        kept on the target so that its export can be resumed.
+        """
+        exporter.failed = err
+        if exporter.journal:
+            exporter.journal.close()
+            exporter.journal = None
+        common.say("Export to target[{0}] failed: {1}".format(
+            exporter.target_name, err), is_error=True)
+        exporter._wait_for_cleaning()
@@ -0,0 +1,117 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import contextlib
+import time
+from collections import OrderedDict
+
+from beetsplug.goingrunning import common
+
+# Upper bounds (in seconds) of the buckets of the latency histogram
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class ExportStats:
+    """Collects the numbers of an export: the time spent in each stage (clean,
+    copy, playlist, ...), the number and size of the exported files and the
+    latency of the copy of each file.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.files = 0
+        self.bytes = 0
+        self.latencies = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measures the time spent in the `with` block as the stage `name`"""
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.monotonic() - start_time)
+
+    def add_stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def add_file(self, size, latency):
+        self.files += 1
+        self.bytes += size
+        self.latencies.append(latency)
+
+    @property
+    def throughput(self):
+        """Bytes per second of the copy stage"""
+        elapsed = self.stages.get("copy", 0)
+        return self.bytes / elapsed if elapsed > 0 else 0
+
+    def get_percentile(self, percentile):
+        if not self.latencies:
+            return 0
+        latencies = sorted(self.latencies)
+        index = int(round(percentile / 100 * (len(latencies) - 1)))
+        return latencies[index]
+
+    def get_histogram(self):
+        """Returns the number of files per latency bucket as an ordered
+        dictionary of {label: count}
+        """
+        labels = ["<{0}ms".format(int(bound * 1000))
+                  for bound in LATENCY_BUCKETS]
+        labels.append(">={0}ms".format(int(LATENCY_BUCKETS[-1] * 1000)))
+        counts = [0] * len(labels)
+        for latency in self.latencies:
+            index = len(LATENCY_BUCKETS)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency < bound:
+                    index = i
+                    break
+            counts[index] += 1
+
+        return OrderedDict(zip(labels, counts))
+
+    def get_summary_lines(self):
+        lines = [
+            "Exported {0} files ({1}) [{2}/s]".format(
+                self.files, common.get_human_readable_size(self.bytes),
+                common.get_human_readable_size(self.throughput)),
+            "Stages: {0}".format(", ".join(
+                "{0} {1:.2f}s".format(name, seconds)
+                for name, seconds in self.stages.items())),
+        ]
+        if self.latencies:
+            lines.append(
+                "File latency: min {0:.3f}s, p50 {1:.3f}s, p90 {2:.3f}s, "
+                "max {3:.3f}s".format(min(self.latencies),
+                                      self.get_percentile(50),
+                                      self.get_percentile(90),
+                                      max(self.latencies)))
+            lines.append("Latency histogram: {0}".format(", ".join(
+                "{0}: {1}".format(label, count)
+                for label, count in self.get_histogram().items() if count)))
+
+        return lines
+
+    def to_dict(self):
+        answer = {
+            "files": self.files,
+            "bytes": self.bytes,
+            "throughput": round(self.throughput),
+            "stages": OrderedDict((name, round(seconds, 4))
+                                  for name, seconds in self.stages.items()),
+            "latency": {
+                "histogram": self.get_histogram(),
+            },
+        }
+        if self.latencies:
+            answer["latency"].update({
+                "min": round(min(self.latencies), 4),
+                "mean": round(sum(self.latencies) / len(self.latencies), 4),
+                "p50": round(self.get_percentile(50), 4),
+                "p90": round(self.get_percentile(90), 4),
+                "p99": round(self.get_percentile(99), 4),
+                "max": round(max(self.latencies), 4),
+            })
+
+        return answer
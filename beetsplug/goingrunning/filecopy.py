@@ -0,0 +1,687 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import contextlib
+import ctypes
+import errno
+import os
+import platform
+import queue
+import re
+import sys
+import threading
+import time
+import traceback
+
+from beets import util
+from beetsplug.goingrunning import common
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request number of FICLONE (linux/fs.h)
+FICLONE = 0x40049409
+
+METHOD_REFLINK = "reflink"
+METHOD_HARDLINK = "hardlink"
+METHOD_COPY = "copy"
+
+COPY_METHOD_KERNEL = "kernel"
+COPY_METHOD_STREAM = "stream"
+COPY_METHOD_SIMPLE = "simple"
+COPY_METHODS = [COPY_METHOD_KERNEL, COPY_METHOD_STREAM, COPY_METHOD_SIMPLE]
+DEFAULT_COPY_METHOD = COPY_METHOD_KERNEL
+
+# Largest amount of data moved by one copy_file_range/sendfile call
+KERNEL_COPY_CHUNK = 64 * 1024 * 1024
+
+# Errors meaning that a kernel copy call cannot be used for the files
+_KERNEL_COPY_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                            errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF,
+                            errno.ETXTBSY}
+
+DEFAULT_BUFFER_BUDGET = 16 * 1024 * 1024
+MAX_BUFFER_SIZE = 1024 * 1024
+
+# The nice value of the copy workers with `io_nice: yes` (the lowest)
+IO_NICENESS = 19
+
+# ioprio_set/ioprio_get (linux/ioprio.h): the best-effort class has the levels
+# 0 (the highest) to 7 (the lowest)
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_BE_LOWEST = 7
+
+# The number of the ioprio_set system call on each architecture, ioprio_get
+# is the next one everywhere
+_IOPRIO_SET_SYSCALLS = {
+    "x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "riscv64": 30,
+    "armv7l": 314, "ppc64": 273, "ppc64le": 273, "s390x": 282,
+}
+
+_link_methods = {}
+_link_methods_lock = threading.Lock()
+
+# The kernel copy calls that failed for a (source, destination) device pair
+_kernel_copy_unsupported = set()
+
+# The filesystems with a native fallocate. Elsewhere (FAT, exFAT, ...) the C
+# library emulates posix_fallocate by writing every block of the file, which
+# only makes the copy slower.
+FALLOCATE_FILESYSTEMS = {"ext4", "xfs", "btrfs"}
+MOUNTS_PATH = "/proc/self/mounts"
+
+# The filesystem type of each device
+_filesystem_types = {}
+
+
+def reflink(src, dst):
+    """Creates `dst` as a copy-on-write clone of `src` (Btrfs, XFS, ...).
+    Raises OSError when the filesystem does not support it.
+    """
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform!")
+
+    with open(src, "rb") as src_file:
+        with open(dst, "xb") as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except OSError:
+                dst_file.close()
+                os.remove(dst)
+                raise
+
+
+def get_link_method(src, dst_dir):
+    """Returns the cheapest method (reflink, hardlink or copy) that can be
+    used to materialize `src` inside `dst_dir`. The result is probed only
+    once for each source filesystem and destination folder.
+    """
+    key = (os.stat(src).st_dev, os.path.realpath(dst_dir))
+    with _link_methods_lock:
+        if key not in _link_methods:
+            _link_methods[key] = _probe_link_method(src, dst_dir)
+            common.say("Link method for '{0}': {1}".format(
+                key[1], _link_methods[key]))
+
+        return _link_methods[key]
+
+
+def _probe_link_method(src, dst_dir):
+    probe = os.path.join(dst_dir, ".goingrunning_probe_{}".format(
+        common.get_random_string()))
+
+    for method, link in [(METHOD_REFLINK, reflink),
+                         (METHOD_HARDLINK, os.link)]:
+        try:
+            link(src, probe)
+        except OSError:
+            continue
+        os.remove(probe)
+        return method
+
+    return METHOD_COPY
+
+
+def remove_existing(path):
+    """Removes the file (or link) left at `path` by an earlier export. The
+    destinations are never written in place: an existing destination can be
+    a hardlink of the library file itself, truncating it would destroy it.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+
+
+def link_or_copy(src, dst, copy=util.copy):
+    """Materializes `src` as `dst` with a reflink or a hardlink when the
+    destination supports it and falls back to `copy` otherwise. An existing
+    `dst` is replaced. Returns the method which was used.
+    """
+    remove_existing(dst)
+    method = get_link_method(src, os.path.dirname(dst))
+    try:
+        if method == METHOD_REFLINK:
+            reflink(src, dst)
+        elif method == METHOD_HARDLINK:
+            os.link(src, dst)
+    except FileExistsError:
+        # Created in the meantime, this is not a missing link support
+        raise
+    except OSError as err:
+        common.say("Linking failed ({0}), copying: {1}".format(err, src))
+        method = METHOD_COPY
+
+    if method == METHOD_COPY:
+        copy(src, dst)
+
+    return method
+
+
+def get_filesystem_type(path):
+    """Returns the type of the filesystem holding `path` (as listed in the
+    mount table, e.g. "ext4" or "vfat") or None if it cannot be found out.
+    """
+    device = os.stat(path).st_dev
+    if device not in _filesystem_types:
+        _filesystem_types[device] = _find_filesystem_type(path)
+    return _filesystem_types[device]
+
+
+def _find_filesystem_type(path):
+    path = os.path.realpath(path)
+    try:
+        with open(MOUNTS_PATH, "r") as mounts_file:
+            mounts = mounts_file.read().splitlines()
+    except OSError:
+        return None
+
+    mount_point = None
+    fs_type = None
+    for line in mounts:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        # Spaces and the like are octal escapes in the mount table
+        point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)),
+                       fields[1])
+        if path != point and \
+                not path.startswith(point.rstrip("/") + "/"):
+            continue
+        # The deepest (and the latest, it is mounted over) mount point wins
+        if mount_point is None or len(point) >= len(mount_point):
+            mount_point = point
+            fs_type = fields[2]
+
+    return fs_type
+
+
+def preallocate(fd, size, path):
+    """Reserves the space of the file `path` open as `fd` in one go (less
+    fragmentation on the device filesystems). This is only done where the
+    filesystem supports it natively (`FALLOCATE_FILESYSTEMS`). Returns False
+    if the space was not reserved.
+    """
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return False
+
+    try:
+        if get_filesystem_type(path) not in FALLOCATE_FILESYSTEMS:
+            return False
+    except OSError:
+        return False
+
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        return False
+
+    return True
+
+
+def lower_io_priority(niceness=IO_NICENESS):
+    """Lowers the CPU priority of the calling thread to the nice value and
+    its I/O priority to the best-effort level of the same rank (7 for the
+    lowest nice value, see `set_io_priority`). The threads it starts inherit
+    both. Returns False if neither can be changed here.
+    """
+    lowered = set_io_priority(get_io_priority_level(niceness))
+    if not hasattr(os, "setpriority") or \
+            not hasattr(threading, "get_native_id"):
+        return lowered
+
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+    except OSError as err:
+        common.say("Cannot lower the CPU priority: {0}".format(err))
+        return lowered
+
+    return True
+
+
+def get_io_priority_level(niceness):
+    """Returns the best-effort I/O level the kernel derives from the nice
+    value for the threads without an I/O priority of their own
+    """
+    return min(IOPRIO_BE_LOWEST, max(0, (niceness + 20) // 5))
+
+
+def set_io_priority(level, tid=0):
+    """Puts the thread (the calling one by default) in the best-effort I/O
+    class with the level (0-7) with the ioprio_set system call. A nice value
+    alone only reaches the disk scheduler through this derived priority,
+    which some schedulers do not look at. Returns False if the call is not
+    available here.
+    """
+    libc = _get_ioprio_libc()
+    if libc is None:
+        return False
+
+    ioprio = IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT | level
+    if libc.syscall(_IOPRIO_SET_SYSCALLS[platform.machine()],
+                    IOPRIO_WHO_PROCESS, tid, ioprio) != 0:
+        common.say("Cannot lower the I/O priority: {0}".format(
+            os.strerror(ctypes.get_errno())))
+        return False
+
+    return True
+
+
+def get_io_priority(tid=0):
+    """Returns the (class, level) I/O priority of the thread (the calling one
+    by default) or None if it cannot be read here
+    """
+    libc = _get_ioprio_libc()
+    if libc is None:
+        return None
+
+    ioprio = libc.syscall(_IOPRIO_SET_SYSCALLS[platform.machine()] + 1,
+                          IOPRIO_WHO_PROCESS, tid)
+    if ioprio < 0:
+        return None
+
+    return ioprio >> IOPRIO_CLASS_SHIFT, ioprio & ((1 << IOPRIO_CLASS_SHIFT)
+                                                  - 1)
+
+
+def _get_ioprio_libc():
+    if not sys.platform.startswith("linux") or \
+            platform.machine() not in _IOPRIO_SET_SYSCALLS:
+        return None
+
+    try:
+        return ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+
+
+class RateLimiter:
+    """A token bucket capping the bytes per second moved by all the threads
+    that share it. A thread that goes over the rate sleeps for as long as it
+    takes the bucket to refill, so the following ones wait in turn.
+    """
+
+    def __init__(self, rate, burst=MAX_BUFFER_SIZE):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= size
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _throttle(limiters, size):
+    for limiter in limiters:
+        if limiter:
+            limiter.consume(size)
+
+
+def kernel_copy(src, dst, limiters=()):
+    """Copies `src` to `dst` inside the kernel with `copy_file_range` or
+    `sendfile` so that the data never goes through user space buffers. The
+    destination is preallocated (see `preallocate`). Returns the number of
+    bytes copied or None if neither call can be used for these files
+    (nothing is copied then).
+    With rate `limiters` the data is moved in small chunks, each one waiting
+    for its share of the rate.
+    """
+    calls = [(name, call) for name, call in
+             [("copy_file_range", _copy_file_range), ("sendfile", _sendfile)]
+             if hasattr(os, name)]
+    if not calls:
+        return None
+
+    with open(src, "rb") as src_file, open(dst, "xb") as dst_file:
+        src_fd = src_file.fileno()
+        dst_fd = dst_file.fileno()
+        size = os.fstat(src_fd).st_size
+        devices = (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+        preallocated = preallocate(dst_fd, size, dst)
+
+        for name, call in calls:
+            if (name,) + devices in _kernel_copy_unsupported:
+                continue
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            try:
+                copied = call(src_fd, dst_fd, size, limiters)
+            except OSError as err:
+                if err.errno not in _KERNEL_COPY_UNSUPPORTED:
+                    raise
+                common.say("Kernel copy with {0} is not supported: "
+                           "{1}".format(name, err))
+                _kernel_copy_unsupported.add((name,) + devices)
+                continue
+
+            if preallocated and copied != size:
+                # The source changed while it was copied
+                os.ftruncate(dst_fd, copied)
+            return copied
+
+    # Nothing was copied, the caller creates the file in another way
+    os.remove(dst)
+
+    return None
+
+
+def _copy_file_range(src_fd, dst_fd, size, limiters=()):
+    chunk = MAX_BUFFER_SIZE if any(limiters) else KERNEL_COPY_CHUNK
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src_fd, dst_fd, min(size - copied, chunk))
+        if n == 0:
+            break
+        copied += n
+        _throttle(limiters, n)
+
+    return copied
+
+
+def _sendfile(src_fd, dst_fd, size, limiters=()):
+    chunk = MAX_BUFFER_SIZE if any(limiters) else KERNEL_COPY_CHUNK
+    copied = 0
+    while copied < size:
+        n = os.sendfile(dst_fd, src_fd, copied, min(size - copied, chunk))
+        if n == 0:
+            break
+        copied += n
+        _throttle(limiters, n)
+
+    return copied
+
+
+def update_digest(digest, path, chunk_size=MAX_BUFFER_SIZE):
+    """Updates the `digest` (a hashlib object) with the content of the file
+    """
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+
+class BufferPool:
+    """A bounded pool of reusable buffers. Getting a buffer blocks until one
+    is returned to the pool, this is what caps the memory used by a copy.
+    """
+
+    def __init__(self, buffer_size, buffer_count):
+        self.buffer_size = buffer_size
+        self._free = queue.Queue()
+        for i in range(buffer_count):
+            self._free.put(bytearray(buffer_size))
+
+    def get(self):
+        return self._free.get()
+
+    def put(self, buf):
+        self._free.put(buf)
+
+
+def stream_copy(src, dst, pool: BufferPool, read_limiter=None,
+                write_limiter=None, digest=None):
+    """Copies `src` to `dst` with a reader thread that reads ahead into the
+    buffers of the pool while the calling thread writes the filled buffers
+    to the destination. This keeps both the source and the destination busy.
+    The optional rate limiters throttle the reads and the writes and the
+    optional `digest` (a hashlib object) is updated with the written data.
+    Returns the number of bytes written.
+    """
+    filled = queue.Queue()
+    stop = threading.Event()
+
+    def read_ahead():
+        buf = None
+        try:
+            with open(src, "rb") as src_file:
+                while not stop.is_set():
+                    buf = pool.get()
+                    n = src_file.readinto(buf)
+                    _throttle([read_limiter], n)
+                    filled.put((buf, n))
+                    buf = None
+                    if not n:
+                        break
+        except BaseException as err:
+            if buf is not None:
+                pool.put(buf)
+            filled.put((None, err))
+
+    reader = threading.Thread(target=read_ahead, daemon=True)
+    reader.start()
+
+    written = 0
+    try:
+        with open(dst, "xb") as dst_file:
+            while True:
+                buf, n = filled.get()
+                if buf is None:
+                    raise n
+                try:
+                    if not n:
+                        break
+                    _throttle([write_limiter], n)
+                    dst_file.write(memoryview(buf)[:n])
+                    if digest is not None:
+                        digest.update(memoryview(buf)[:n])
+                    written += n
+                finally:
+                    pool.put(buf)
+    finally:
+        # Give back the buffers that were read ahead but never written. The
+        # reader might be waiting for a buffer before it notices the stop.
+        stop.set()
+        while reader.is_alive() or not filled.empty():
+            try:
+                buf, n = filled.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if buf is not None:
+                pool.put(buf)
+
+    return written
+
+
+def fan_out_copy(src, dsts, pool: BufferPool, read_limiter=None,
+                 write_limiters=None, digest=None):
+    """Reads `src` once and writes it to all the `dsts` concurrently. The
+    calling thread fills the buffers of the pool and each destination has its
+    own writer thread, a buffer goes back to the pool once every writer is
+    done with it. A failing destination does not interrupt the others.
+    Returns a list with the number of bytes written (or the exception that
+    was raised) for each destination. The reads and the writes to each
+    destination are throttled by the optional rate limiters and the optional
+    `digest` (a hashlib object) is updated with the data that is read.
+    """
+    write_limiters = write_limiters or [None] * len(dsts)
+    results = [0] * len(dsts)
+    queues = [queue.Queue() for _ in dsts]
+    pending = {}
+    lock = threading.Lock()
+
+    def release(buf):
+        with lock:
+            pending[id(buf)] -= 1
+            done = pending[id(buf)] == 0
+            if done:
+                del pending[id(buf)]
+        if done:
+            pool.put(buf)
+
+    def write(index):
+        error = None
+        dst_file = None
+        try:
+            dst_file = open(dsts[index], "xb")
+        except OSError as err:
+            error = err
+
+        # A failed writer keeps consuming the buffers so that the reader and
+        # the other writers are never blocked by it
+        while True:
+            buf, n = queues[index].get()
+            if buf is None:
+                error = error or n
+                break
+            try:
+                if error is None:
+                    _throttle([write_limiters[index]], n)
+                    dst_file.write(memoryview(buf)[:n])
+                    results[index] += n
+            except OSError as err:
+                error = err
+            finally:
+                release(buf)
+
+        if dst_file:
+            try:
+                dst_file.close()
+            except OSError as err:
+                error = error or err
+
+        if error is not None:
+            results[index] = error
+            with contextlib.suppress(OSError):
+                os.remove(dsts[index])
+
+    writers = [threading.Thread(target=write, args=(i,), daemon=True)
+               for i in range(len(dsts))]
+    for writer in writers:
+        writer.start()
+
+    read_error = None
+    buf = None
+    try:
+        with open(src, "rb") as src_file:
+            while True:
+                buf = pool.get()
+                n = src_file.readinto(buf)
+                if not n:
+                    break
+                _throttle([read_limiter], n)
+                if digest is not None:
+                    digest.update(memoryview(buf)[:n])
+                with lock:
+                    pending[id(buf)] = len(dsts)
+                for q in queues:
+                    q.put((buf, n))
+                buf = None
+    except OSError as err:
+        read_error = err
+    finally:
+        if buf is not None:
+            pool.put(buf)
+        for q in queues:
+            q.put((None, read_error))
+        for writer in writers:
+            writer.join()
+
+    return results
+
+
+class FileCopier:
+    """Copies the files of an export. One instance is shared by all the copy
+    workers: each worker thread gets its own share of the buffer budget while
+    the rate limits hold for all the workers together.
+    """
+
+    def __init__(self, copy_method=DEFAULT_COPY_METHOD, link_files=False,
+                 buffer_budget=DEFAULT_BUFFER_BUDGET, workers=1,
+                 read_limiter: RateLimiter = None,
+                 write_limiter: RateLimiter = None, io_nice=0):
+        self.copy_method = copy_method \
+            if copy_method in COPY_METHODS else DEFAULT_COPY_METHOD
+        self.link_files = link_files
+        self.read_limiter = read_limiter
+        self.write_limiter = write_limiter
+        self.io_nice = io_nice
+
+        # At least two buffers per worker (double buffering)
+        worker_budget = max(2, int(buffer_budget / max(1, workers)))
+        self.buffer_size = max(1, min(MAX_BUFFER_SIZE, worker_budget // 2))
+        self.buffer_count = max(2, worker_budget // self.buffer_size)
+        self._local = threading.local()
+
+    def init_worker(self):
+        """Prepares the thread of a copy worker (executor initializer)"""
+        if self.io_nice:
+            lower_io_priority(self.io_nice)
+
+    def copy(self, src, dst, digest=None):
+        """Copies (or links) `src` to `dst` and returns the size of `dst`.
+        The optional `digest` (a hashlib object) is updated with the content
+        of the file: on the way when it is streamed, from the source when the
+        data never goes through the copier (links, kernel and simple copies).
+        """
+        src = util.syspath(src)
+        dst = util.syspath(dst)
+        remove_existing(dst)
+        digested = []
+
+        def copy(copy_src, copy_dst):
+            digested.append(self._copy(copy_src, copy_dst, digest))
+
+        if self.link_files:
+            link_or_copy(src, dst, copy=copy)
+        else:
+            copy(src, dst)
+        if digest is not None and not any(digested):
+            update_digest(digest, src, self.buffer_size)
+
+        return os.path.getsize(dst)
+
+    def _copy(self, src, dst, digest=None):
+        """Returns True if the `digest` was updated with the copied data"""
+        limited = self.read_limiter or self.write_limiter
+        if self.copy_method == COPY_METHOD_SIMPLE and not limited:
+            util.copy(src, dst)
+            return False
+
+        try:
+            # Falls back to the stream copy if the kernel cannot copy them
+            if self.copy_method == COPY_METHOD_KERNEL and kernel_copy(
+                    src, dst, [self.read_limiter, self.write_limiter]) \
+                    is not None:
+                return False
+            stream_copy(src, dst, self._get_buffer_pool(), self.read_limiter,
+                        self.write_limiter, digest)
+            return digest is not None
+        except OSError as exc:
+            raise util.FilesystemError(exc, 'copy', (src, dst),
+                                       traceback.format_exc())
+
+    def fan_out(self, src, dsts, write_limiters=None, digest=None):
+        """Copies `src` to all the `dsts` reading it only once. Returns the
+        size of each destination or the FilesystemError of the ones that
+        failed. The optional `digest` is updated with the copied data.
+        """
+        src = util.syspath(src)
+        dsts = [util.syspath(dst) for dst in dsts]
+        for dst in dsts:
+            remove_existing(dst)
+        results = fan_out_copy(src, dsts, self._get_buffer_pool(),
+                               self.read_limiter, write_limiters, digest)
+
+        answer = []
+        for dst, result in zip(dsts, results):
+            if isinstance(result, OSError):
+                result = util.FilesystemError(result, 'copy', (src, dst))
+            answer.append(result)
+
+        return answer
+
+    def _get_buffer_pool(self):
+        if not hasattr(self._local, "pool"):
+            self._local.pool = BufferPool(self.buffer_size, self.buffer_count)
+        return self._local.pool
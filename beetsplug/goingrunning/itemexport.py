@@ -1,95 +1,513 @@
 #   Copyright: Copyright (c) 2020., Adam Jakab
 #   Author: Adam Jakab <adam at jakab dot pro>
 #   License: See LICENSE.txt
+import contextlib
 import hashlib
+import json
 import os
 import shutil
 import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 
 from alive_progress import alive_bar
 from beets import util
 from confuse import Subview
+from beetsplug.goingrunning import audiorange
 from beetsplug.goingrunning import common
+from beetsplug.goingrunning import estimate
+from beetsplug.goingrunning import exportstats
+from beetsplug.goingrunning import filecopy
+from beetsplug.goingrunning import tagwrite
+from beetsplug.goingrunning import transcode
+from beetsplug.goingrunning import trash
+from beetsplug.goingrunning import verify
 
+EXPORT_MODE_FILES = "files"
+EXPORT_MODE_ARCHIVE = "archive"
+EXPORT_MODE_MERGED = "merged"
 
-def generate_output(training: Subview, items, dry_run=False):
-    exporter = ItemExport(training, items, dry_run)
-    exporter.export()
+
+def get_journal_items(training: Subview, lib):
+    """Returns the library items planned by the interrupted export of the
+    training (in their original order) or an empty list if there is nothing
+    to resume.
+    """
+    journal = None
+    for target_name in common.get_target_names_for_training(training):
+        journal = ItemExport(training, [], target_name=target_name) \
+            .read_journal()
+        if journal:
+            break
+
+    if not journal:
+        return []
+
+    items = []
+    for entry in journal["plan"]:
+        item = lib.get_item(entry.get("id"))
+        if item:
+            items.append(item)
+        else:
+            common.say("Item[{0}] of the journal is not in the library "
+                       "anymore.".format(entry.get("id")))
+
+    return items
 
 
 class ItemExport:
+    _manifest_filename_ = ".goingrunning.json"
+    _journal_filename_ = ".goingrunning.journal"
+
+    # Play counts are stored to the library in batches of this many songs
+    _play_count_batch_size_ = 50
+
+    # Space lost to the allocation of each file (FAT32 cluster size)
+    _file_overhead_ = 32 * 1024
+    _space_reserve_ = 1024 * 1024
+
     cfg_dry_run = False
+    cfg_resume = False
     training: Subview = None
+    target_name = None
     items = []
+    journal = None
+    failed = None
+    copy_jobs = None
+    play_count_handler = None
+    plan = None
+    _transcode_profile = False
+    _trash = None
+    _clean_first = False
 
-    def __init__(self, training, items, dry_run=False):
+    def __init__(self, training, items, dry_run=False, resume=False,
+                 target_name=None):
         self.training = training
         self.items = items
         self.cfg_dry_run = dry_run
+        self.cfg_resume = resume
+        if not target_name:
+            target_names = common.get_target_names_for_training(training)
+            target_name = target_names[0] if target_names else None
+        self.target_name = target_name
+        self._export_paths = {}
+        self._copied_jobs = []
+        self._play_counts = []
+        self.stats = exportstats.ExportStats()
 
     def export(self):
-        self._clean_target()
-        self._copy_items()
-        self._generate_playist()
+        """Exports the items to the target. Returns False if the export was
+        not made because the items do not fit on the target.
+        """
+        if not self.prepare():
+            return False
+        self.copy()
+        self.finish()
+
+        return True
+
+    def prepare(self):
+        """Makes the target ready for the copy: checks that the items fit,
+        cleans the target and plans the copy (`copy_jobs`). Returns False if
+        the items do not fit on the target.
+        """
+        with self.stats.stage("capacity"):
+            if not self._check_capacity():
+                return False
+
+        # A resumed export continues in the folder left by the interrupted one
+        if not self.cfg_resume:
+            with self.stats.stage("clean"):
+                self._clean_target()
+        with self.stats.stage("plan"):
+            self.copy_jobs = self._plan_copy()
+
+        return True
+
+    def copy(self):
+        """Copies the files planned by `prepare` to the target"""
+        with self.stats.stage("copy"):
+            self._copy_items()
+
+    def finish(self, write_tags=True):
+        """Completes the export once the files are on the target: verifies
+        them, writes the playlist, removes the journal, writes the tags
+        (unless `write_tags` is False, e.g. when they are written once for
+        several targets), waits for the cleaning and reports.
+        """
+        if self.copy_jobs is not None:
+            if self._get_target_attribute("verify"):
+                with self.stats.stage("verify"):
+                    self._verify_files()
+            self._finish_copy()
+        with self.stats.stage("playlist"):
+            self._generate_playist()
+        self._close_journal()
+        if write_tags:
+            self.write_tags()
+        self._finish_cleaning()
+        self._report()
+
+    def write_tags(self):
+        """Writes the tags of the songs whose play count was incremented,
+        together with the tag writes left pending by the previous runs.
+        """
+        with self.stats.stage("tags"):
+            self._write_tags()
+
+    def _finish_cleaning(self):
+        if self._trash:
+            with self.stats.stage("clean"):
+                self._wait_for_cleaning()
+
+    def _get_report_path(self):
+        dst_sub_dir = Path(self._get_destination_path()).joinpath(
+            self._get_cleaned_training_name())
+        os.makedirs(dst_sub_dir, exist_ok=True)
+        return dst_sub_dir.joinpath(self._get_report_filename())
+
+    def _report(self):
+        """Shows the numbers of the export and, if the `export_report` target
+        attribute is set, writes them as a JSON report next to the playlist.
+        """
+        if self.cfg_dry_run:
+            return
+
+        self._record_throughput()
+
+        common.say("Export statistics for target[{0}]:".format(
+            self.target_name), log_only=False)
+        for line in self.stats.get_summary_lines():
+            common.say("  {0}".format(line), log_only=False)
+
+        if not self._get_target_attribute("export_report"):
+            return
+
+        profile = self._get_transcode_profile()
+        report = {
+            "training": self._get_training_name(),
+            "target": self.target_name,
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "options": {
+                "copy_files": self._is_copy_enabled(),
+                "copy_method": self._get_file_copier().copy_method,
+                "copy_workers": self._get_copy_workers(),
+                "link_files": self._is_link_mode(),
+                "sync": self._is_sync_mode(),
+                "export_mode": self._get_export_mode(),
+                "transcode": str(profile) if profile else None,
+            },
+        }
+        report.update(self.stats.to_dict())
+
+        path = self._get_report_path()
+        with open(path, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+        common.say("Written export report: {0}".format(path), log_only=False)
+
+    def _record_throughput(self):
+        """Adds the measured speed of the copy to the profile of the target
+        """
+        seconds = self.stats.stages.get("copy", 0)
+        if self.cfg_dry_run or not self.stats.files or seconds <= 0:
+            return
+
+        try:
+            estimate.get_throughput_profiles().add_sample(
+                self._get_throughput_key(), self.stats.files,
+                self.stats.bytes, seconds)
+        except OSError as err:
+            common.say("Cannot store the throughput of target[{0}]: "
+                       "{1}".format(self.target_name, err), is_error=True)
+
+    def _set_plan(self, jobs):
+        """Describes the files that the export would write, with their
+        estimated size and the time the export is expected to take on the
+        target (from the speed measured by its previous exports).
+        """
+        sizes = [size or 0 for size in
+                 self._get_estimated_sizes([job["item"] for job in jobs])]
+        total = sum(sizes)
+        profile = estimate.get_throughput_profiles().get_profile(
+            self._get_throughput_key())
+        seconds = estimate.estimate_seconds(profile, len(jobs), total) \
+            if profile else None
+
+        self.plan = OrderedDict([
+            ("training", self._get_training_name()),
+            ("target", self.target_name),
+            ("export_mode", self._get_export_mode()),
+            ("destination", str(self._get_destination_path())),
+            ("files", len(jobs)),
+            ("bytes", total),
+            ("estimated_seconds", round(seconds, 2)
+             if seconds is not None else None),
+            ("throughput", round(profile[1]) if profile else None),
+            ("file_overhead", round(profile[0], 4) if profile else None),
+            ("items", [OrderedDict([
+                ("id", job["item"].get("id")),
+                ("src", job["src"]),
+                ("filename", job["filename"]),
+                ("bytes", size),
+                ("transcode", job["transcode"]),
+            ]) for job, size in zip(jobs, sizes)]),
+        ])
+
+        if seconds is None:
+            common.say("Estimate for target[{0}]: {1} files, {2} (the speed "
+                       "of the target is not known yet, it is measured by "
+                       "the exports)".format(
+                self.target_name, len(jobs),
+                common.get_human_readable_size(total)), log_only=False)
+        else:
+            common.say("Estimate for target[{0}]: {1} files, {2} in {3} "
+                       "[{4}/s, {5:.3f}s per file]".format(
+                self.target_name, len(jobs),
+                common.get_human_readable_size(total),
+                common.get_human_readable_time(round(seconds)),
+                common.get_human_readable_size(profile[1]), profile[0]),
+                log_only=False)
+
+    def _get_throughput_key(self):
+        # The speed depends on how the target is written to
+        return "{0}:{1}:{2}".format(self.target_name, self._get_export_mode(),
+                                    self._get_copy_workers())
+
+    def _check_capacity(self):
+        """Verifies that the items fit on the target before anything is
+        deleted or copied. Depending on the `on_insufficient_space` target
+        attribute (abort|shrink) the export is aborted or the items at the end
+        of the selection are dropped until the rest fits.
+        """
+        if not self._is_copy_enabled():
+            return True
+
+        target_name = self.target_name
+        dst_path = Path(self._get_destination_path())
+
+        sizes = self._get_estimated_sizes(self.items)
+        needed = [size + self._file_overhead_ if size is not None else 0
+                  for size in sizes]
+
+        if self._is_link_mode():
+            existing = [util.syspath(item.get("path"))
+                        for item, size in zip(self.items, sizes)
+                        if size is not None]
+            if existing and filecopy.get_link_method(existing[0], dst_path) \
+                    != filecopy.METHOD_COPY:
+                common.say("Capacity check skipped: songs are linked.")
+                return True
+
+        free = shutil.disk_usage(dst_path).free
+        freed = self._get_bytes_freed_by_cleaning(dst_path)
+        available = free + freed - self._space_reserve_
+        total = sum(needed)
+        self._clean_first = total > free - self._space_reserve_
+
+        common.say("Capacity of target[{0}]: {1} needed, {2} free, {3} freed "
+                   "by cleaning".format(target_name,
+                                        common.get_human_readable_size(total),
+                                        common.get_human_readable_size(free),
+                                        common.get_human_readable_size(freed)))
+
+        if total <= available:
+            return True
+
+        policy = self._get_target_attribute("on_insufficient_space")
+        if policy != "shrink":
+            common.say("Not enough space on target[{0}]: {1} needed, {2} "
+                       "available! Nothing was deleted or copied.".format(
+                target_name, common.get_human_readable_size(total),
+                common.get_human_readable_size(max(0, available))),
+                is_error=True)
+            return False
+
+        self.items = list(self.items)
+        while self.items and total > available:
+            item = self.items.pop()
+            total -= needed.pop()
+            common.say("Dropped (no space): {0} - {1}".format(
+                item.get("artist"), item.get("title")))
+        self._clean_first = total > free - self._space_reserve_
+
+        common.say("Selection reduced to {0} songs to fit on target[{1}] "
+                   "({2})".format(len(self.items), target_name,
+                                  common.get_human_readable_size(total)),
+                   log_only=False)
+
+        return len(self.items) > 0
+
+    def _get_estimated_sizes(self, items):
+        """Returns the estimated size on the target of each item (None for
+        the missing files). The size of a song that is transcoded is
+        estimated from its length and the bitrate of the profile.
+        """
+        profile = self._get_transcode_profile()
+        paths = [util.syspath(item.get("path")) for item in items]
+        sizes = common.get_file_sizes(paths)
+
+        answer = []
+        for item, path in zip(items, paths):
+            size = sizes.get(path)
+            if size is not None and profile and \
+                    profile.needs_transcoding(path):
+                try:
+                    length = float(item.get("length"))
+                except (TypeError, ValueError):
+                    length = 0
+                if length > 0:
+                    # bitrate is in kbit/s
+                    size = min(size, int(length * profile.bitrate * 125))
+            answer.append(size)
 
-    def _generate_playist(self):
+        return answer
+
+    def _get_bytes_freed_by_cleaning(self, dst_path: Path):
+        """Returns the number of bytes that the cleaning of the target (and
+        the reuse of the files in the training folder) will make available.
+        """
+        training_dir = dst_path.joinpath(self._get_cleaned_training_name())
+        clean_target = self._get_target_attribute("clean_target")
+
+        # Like `_clean_target`: anything but `no` cleans the whole target
+        folder = None
+        if clean_target is not False and clean_target != "training" and \
+                not self.cfg_resume:
+            folder = dst_path
+        elif clean_target == "training" or self.cfg_resume or \
+                self._is_sync_mode():
+            folder = training_dir
+
+        freed = common.get_folder_size(folder) \
+            if folder and os.path.isdir(folder) else 0
+
+        additional_files = self._get_target_attribute("delete_from_device")
+        if additional_files and not self.cfg_resume:
+            root = Path(self._get_target_attribute("device_root")).expanduser()
+            paths = [os.path.realpath(root.joinpath(str.strip(path, "/")))
+                     for path in additional_files]
+            freed += sum(size for size in
+                         common.get_file_sizes(paths).values() if size)
+
+        return freed
+
+    def _generate_playist(self, paths=None):
         training_name = self._get_cleaned_training_name()
         playlist_name = self._get_training_name()
-        target_name = common.get_training_attribute(self.training, "target")
+        target_name = self.target_name
 
-        if not common.get_target_attribute_for_training(self.training,
-                                                        "generate_playlist"):
+        if not self._get_target_attribute("generate_playlist"):
             common.say("Playlist generation to target[{0}] was skipped "
                        "(generate_playlist=no).".
                        format(target_name), log_only=False)
             return
 
-        dst_path = Path(common.get_destination_path_for_training(self.training))
+        dst_path = Path(self._get_destination_path())
         dst_sub_dir = dst_path.joinpath(training_name)
         playlist_filename = "{}.m3u".format(playlist_name)
         dst = dst_sub_dir.joinpath(playlist_filename)
 
+        with tempfile.NamedTemporaryFile(mode='w+b', delete=False) as ntf:
+            tmp_playlist = ntf.name
+            for line in self._get_playlist_lines(paths):
+                ntf.write("{}\n".format(line).encode("utf-8"))
+
+        common.say("Created playlist: {0}".format(dst), log_only=True)
+        util.copy(tmp_playlist, dst, replace=True)
+        util.remove(tmp_playlist)
+
+    def _get_playlist_lines(self, paths=None):
+        """Returns the lines of the playlist: the exported songs or `paths`
+        """
         lines = [
             "# Playlist generated for training '{}' on {}". \
-                format(training_name, datetime.now())
+                format(self._get_cleaned_training_name(), datetime.now())
         ]
 
-        for item in self.items:
-            path = util.displayable_path(item.get("exportpath",
-                                                  item.get("path")))
+        if paths is None:
+            paths = [self._export_paths.get(id(item), item.get("path"))
+                     for item in self.items]
+
+        for path in paths:
+            path = util.displayable_path(path)
             if path:
                 path = util.syspath(path)
                 line = "{path}".format(path=path)
                 lines.append(line)
 
-        with tempfile.NamedTemporaryFile(mode='w+b', delete=False) as ntf:
-            tmp_playlist = ntf.name
-            for line in lines:
-                ntf.write("{}\n".format(line).encode("utf-8"))
-
-        common.say("Created playlist: {0}".format(dst), log_only=True)
-        util.copy(tmp_playlist, dst)
-        util.remove(tmp_playlist)
+        return lines
 
     def _copy_items(self):
-        training_name = self._get_cleaned_training_name()
-        target_name = common.get_training_attribute(self.training, "target")
+        jobs = self.copy_jobs
+        if jobs is None:
+            self._store_play_counts()
+            return
 
-        # The copy_files is only False when it is explicitly declared so
-        copy_files = common.get_target_attribute_for_training(
-            self.training, "copy_files")
-        copy_files = False if copy_files == False else True
+        copy_workers = self._get_copy_workers()
+        copier = self._get_file_copier(copy_workers)
+        common.say("Copy workers: {0} (method: {1}, link_files: {2}, "
+                   "buffers: {3} x {4})".format(
+            copy_workers, copier.copy_method,
+            'yes' if copier.link_files else 'no', copier.buffer_count,
+            common.get_human_readable_size(copier.buffer_size)))
+
+        # todo: disable alive bar when running in verbose mode
+        # from beets import logging as beetslogging
+        # beets_log = beetslogging.getLogger("beets")
+        # print(beets_log.getEffectiveLevel())
+
+        # Songs are transcoded to the local cache (or to a temporary work
+        # folder) first. The copy of a song waits for its own transcoding
+        # only, so encoding and copying of different songs overlap.
+        transcoder = None
+        if any(job["transcode"] for job in jobs):
+            transcoder = self._get_transcoder(self._get_transcode_profile())
+
+        try:
+            with alive_bar(len(jobs)) as bar, \
+                    ThreadPoolExecutor(max_workers=copy_workers,
+                                       initializer=copier.init_worker) \
+                    as executor, transcoder or contextlib.nullcontext():
+                futures = {}
+                for job in jobs:
+                    common.say("Copying[{1}]: {0}".format(job["src"],
+                                                           job["filename"]))
+                    src_future = transcoder.submit(
+                        job["src"], os.path.splitext(job["filename"])[0]) \
+                        if job["transcode"] else None
+                    future = executor.submit(self._export_file, copier, job,
+                                             src_future)
+                    futures[future] = job
+
+                # The library is only touched from this thread
+                for future in as_completed(futures):
+                    size, latency = future.result()
+                    self._on_file_exported(futures[future], size, latency)
+                    bar()
+        finally:
+            self._store_play_counts()
+            if transcoder:
+                self._release_transcoder(transcoder)
+
+    def _plan_copy(self):
+        """Prepares the copy of the items: generates the destination file
+        names, reconciles them with the files on the device (sync mode or
+        resumed export) and opens the journal. Returns the list of jobs that
+        need to be copied or None if there is nothing to copy (copying is
+        disabled or this is a dry run).
+        """
+        training_name = self._get_cleaned_training_name()
+        target_name = self.target_name
 
-        if not copy_files:
+        if not self._is_copy_enabled():
             common.say("Copying to target[{0}] was skipped (copy_files=no).".
                        format(target_name))
-            return
+            return None
 
-        increment_play_count = common.get_training_attribute(
-            self.training, "increment_play_count")
-        dst_path = Path(common.get_destination_path_for_training(self.training))
+        dst_path = Path(self._get_destination_path())
 
         dst_sub_dir = dst_path.joinpath(training_name)
         if not os.path.isdir(dst_sub_dir):
@@ -98,52 +516,568 @@ class ItemExport:
         common.say("Copying to target[{0}]: {1}".
                    format(target_name, dst_sub_dir))
 
+        sync_target = self._is_sync_mode()
+        profile = self._get_transcode_profile()
+
+        journal = self.read_journal() if self.cfg_resume else None
+        planned_filenames = {}
+        if journal:
+            for entry in journal["plan"]:
+                planned_filenames[entry.get("id")] = entry.get("filename")
+
+        jobs = self._get_jobs(dst_sub_dir, sync_target, planned_filenames)
+
+        self._planned_jobs = jobs
+        if journal:
+            jobs = self._resume_from_journal(journal, jobs)
+        elif sync_target:
+            jobs = self._sync_target_files(dst_sub_dir, jobs)
+
+        if not self.cfg_dry_run and not journal:
+            self._open_journal(self._planned_jobs)
+
+        if self.cfg_dry_run:
+            for job in jobs:
+                common.say("Copying[{1}]: {0}{2}".format(
+                    job["src"], job["filename"],
+                    " (transcode: {})".format(profile)
+                    if job["transcode"] else ""))
+            self._set_plan(jobs)
+            return None
+
+        self._copy_start_time = time.monotonic()
+        return jobs
+
+    def _get_jobs(self, dst_sub_dir: Path, sync_target=False,
+                  planned_filenames=None):
+        """Generates the (ordered) destination file names before any copying
+        starts so that the order on the device does not depend on which copy
+        finishes first. Returns the list of jobs.
+        """
+        profile = self._get_transcode_profile()
+        planned_filenames = planned_filenames or {}
+
+        jobs = []
         cnt = 0
-        # todo: disable alive bar when running in verbose mode
-        # from beets import logging as beetslogging
-        # beets_log = beetslogging.getLogger("beets")
-        # print(beets_log.getEffectiveLevel())
+        for item in self.items:
+            src = util.displayable_path(item.get("path"))
+            if not os.path.isfile(src):
+                # todo: this is bad enough to interrupt! create option
+                # for this
+                common.say("File does not exist: {}".format(src))
+                continue
+
+            fn, ext = os.path.splitext(src)
+            needs_transcoding = profile is not None and \
+                profile.needs_transcoding(src)
+            if needs_transcoding:
+                ext = profile.extension
+
+            # In sync mode file names are derived from the content so that
+            # songs already on the device can be recognized on the next run
+            key = self._get_sync_key(src) if sync_target else None
+            if key and needs_transcoding:
+                key = hashlib.sha1("{0}|{1}".format(key, profile.key).encode(
+                    "UTF-8")).hexdigest()
+
+            gen_filename = planned_filenames.get(item.id) or "{0}_{1}{2}" \
+                .format(str(cnt).zfill(6),
+                        key[:6] if key else common.get_random_string(), ext)
+
+            jobs.append({
+                "item": item,
+                "src": src,
+                "dst": dst_sub_dir.joinpath(gen_filename),
+                "filename": gen_filename,
+                "key": key,
+                "transcode": needs_transcoding,
+            })
+            cnt += 1
+
+        return jobs
+
+    @staticmethod
+    def _get_sync_key(src):
+        """Returns the content key of the song used by the sync. The tags are
+        left out, so rewriting them (e.g. the play count) does not make the
+        song look new and copied over again.
+        """
+        return audiorange.get_audio_key(src)
+
+    def _on_file_exported(self, job, size, latency=0):
+        """Registers the song of the job as exported (journal, playlist,
+        play count and statistics). This is only called from the main thread.
+        """
+        self.stats.add_file(size, latency)
+        self._copied_jobs.append(job)
+        self._write_journal({
+            "type": "copied",
+            "filename": job["filename"],
+            "size": size,
+            "checksum": job.get("checksum"),
+        })
+
+        self._set_export_path(job)
+        if common.get_training_attribute(self.training,
+                                         "increment_play_count"):
+            self._increment_play_count(job["item"])
+
+    def _verify_files(self):
+        """Compares the songs copied by this export with their sources when
+        the `verify` target attribute is set (cheap flash devices can corrupt
+        the writes silently). The songs that differ are copied once more, if
+        they are still broken the export fails and the broken files are
+        removed so that a resumed export copies them again.
+        """
+        if not self._get_target_attribute("verify") or self.cfg_dry_run:
+            return
+
+        # Transcoded songs have nothing to be compared with
+        pairs = [(job["src"], job["dst"]) for job in self._copied_jobs
+                 if not job["transcode"]]
+        if not pairs:
+            return
+
+        verifier = verify.Verifier(verify.get_source_hash_cache())
+        broken = verifier.verify(pairs)
+        if broken:
+            copier = self._get_file_copier()
+            for src, dst in broken:
+                common.say("Verification failed, copying again: {0}".format(
+                    dst), is_error=True)
+                copier.copy(src, dst)
+            broken = verifier.verify(broken)
+
+        common.say("Verified {0} files on target[{1}] ({2} source hashes "
+                   "cached)".format(len(pairs), self.target_name,
+                                    verifier.cache.hits), log_only=False)
+
+        if broken:
+            for src, dst in broken:
+                with contextlib.suppress(OSError):
+                    os.remove(dst)
+            raise util.FilesystemError(
+                "{0} files are corrupted on the target".format(len(broken)),
+                'verify', [str(dst) for src, dst in broken])
+
+    def _finish_copy(self):
+        elapsed = time.monotonic() - self._copy_start_time
+        common.say("Copied {0} files ({1}) to target[{2}] in {3:.1f}s "
+                   "[{4}/s]".format(
+            self.stats.files,
+            common.get_human_readable_size(self.stats.bytes),
+            self.target_name, elapsed,
+            common.get_human_readable_size(self.stats.bytes / elapsed
+                                           if elapsed > 0 else 0)))
+
+        if self._is_sync_mode():
+            dst_sub_dir = Path(self._get_destination_path()).joinpath(
+                self._get_cleaned_training_name())
+            self._write_manifest(dst_sub_dir, self._planned_jobs)
+
+    def _set_export_path(self, job):
+        # store the file_name for the playlist
+        job["item"]["exportpath"] = util.bytestring_path(job["filename"])
+        self._export_paths[id(job["item"])] = job["item"]["exportpath"]
 
-        with alive_bar(len(self.items)) as bar:
-            for item in self.items:
-                src = util.displayable_path(item.get("path"))
-                if not os.path.isfile(src):
-                    # todo: this is bad enough to interrupt! create option
-                    # for this
-                    common.say("File does not exist: {}".format(src))
+    def _increment_play_count(self, item):
+        if self.play_count_handler:
+            self.play_count_handler(self, item)
+            return
+
+        self._play_counts.append(item)
+        if len(self._play_counts) >= self._play_count_batch_size_:
+            self._store_play_counts()
+
+    def _store_play_counts(self):
+        """Stores the pending play count increments to the library in one
+        transaction. They are registered in the journal only once they are
+        stored so that an interrupted export applies the missing ones when
+        it is resumed.
+        """
+        if not self._play_counts:
+            return
+
+        items = self._play_counts
+        self._play_counts = []
+        # The tags are written once the copy to the device is complete
+        lib = self._get_library()
+        if lib:
+            tagwrite.get_tag_write_queue(lib).add(item.id for item in items)
+        common.increment_play_count_on_items(items, write=False)
+        for item in items:
+            self._write_journal({"type": "counted", "id": item.id})
+
+    def _get_library(self):
+        """Returns the library of the exported songs (None if they are not
+        stored in one)
+        """
+        return next((item._db for item in self.items if item._db), None)
+
+    def _write_tags(self):
+        """Writes the tags of the songs whose play count was incremented,
+        together with the tag writes left pending by the previous runs.
+        """
+        if self.cfg_dry_run:
+            return
+
+        lib = self._get_library()
+        if not lib:
+            return
+
+        written, failed = tagwrite.get_tag_write_queue(lib).drain(lib)
+        if written or failed:
+            common.say("Written tags of {0} songs ({1} failed, they will be "
+                       "retried on the next run)".format(written, failed),
+                       log_only=failed == 0)
+
+    def read_journal(self):
+        """Reads the journal left on the target by an interrupted export.
+        Returns None if there is no journal or a dictionary with the planned
+        files (`plan`), the files copied so far (`copied`, by file name) and
+        the ids of the items whose play count was incremented (`counted`).
+        """
+        path = self._get_journal_path()
+        if not path or not os.path.isfile(path):
+            return None
+
+        journal = {"plan": [], "copied": {}, "counted": set()}
+        with open(path, "r") as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line might be truncated
                     continue
+                if entry.get("type") == "plan":
+                    journal["plan"] = entry.get("items", [])
+                elif entry.get("type") == "copied":
+                    journal["copied"][entry.get("filename")] = entry
+                elif entry.get("type") == "counted":
+                    journal["counted"].add(entry.get("id"))
+
+        return journal if journal["plan"] else None
+
+    def _resume_from_journal(self, journal, jobs):
+        """Keeps the files which the journal registers as copied if they are
+        still intact on the device and applies the play count increments that
+        were missed. Returns the list of jobs that still need to be copied.
+        """
+        self._open_journal(append=True)
+        increment_play_count = common.get_training_attribute(
+            self.training, "increment_play_count")
 
-                fn, ext = os.path.splitext(src)
-                gen_filename = "{0}_{1}{2}" \
-                    .format(str(cnt).zfill(6), common.get_random_string(), ext)
+        to_copy = []
+        for job in jobs:
+            entry = journal["copied"].get(job["filename"])
+            if not entry or not self._verify_journal_entry(job, entry):
+                to_copy.append(job)
+                continue
 
-                dst = dst_sub_dir.joinpath(gen_filename)
-                # dst = "{0}/{1}".format(dst_path, gen_filename)
+            common.say("Verified[{1}]: {0}".format(job["src"],
+                                                   job["filename"]))
+            if self.cfg_dry_run:
+                continue
 
-                common.say("Copying[{1}]: {0}".format(src, gen_filename))
+            self._set_export_path(job)
+            if increment_play_count and \
+                    job["item"].id not in journal["counted"]:
+                self._increment_play_count(job["item"])
+
+        common.say("Resuming export: {0} verified, {1} to copy".format(
+            len(jobs) - len(to_copy), len(to_copy)), log_only=False)
+
+        return to_copy
+
+    @staticmethod
+    def _verify_journal_entry(job, entry):
+        """The file is kept if it has the size and the sha1 of the whole
+        content that were registered when it was copied
+        """
+        dst = job["dst"]
+        try:
+            return os.path.getsize(dst) == entry.get("size") and \
+                verify.hash_file(dst) == entry.get("checksum")
+        except OSError:
+            return False
+
+    def _open_journal(self, jobs=None, append=False):
+        """Opens the journal of the export on the target. A new journal
+        starts with the plan: the items and the file names they get.
+        """
+        if self.cfg_dry_run:
+            return
 
-                if not self.cfg_dry_run:
-                    util.copy(src, dst)
+        self.journal = open(self._get_journal_path(), "a" if append else "w")
+        if not append:
+            self._write_journal({
+                "type": "plan",
+                "items": [{"id": job["item"].id, "filename": job["filename"]}
+                          for job in jobs],
+            })
 
-                    # store the file_name for the playlist
-                    item["exportpath"] = util.bytestring_path(gen_filename)
+    def _write_journal(self, entry):
+        if self.journal:
+            self.journal.write("{}\n".format(json.dumps(entry)))
+            self.journal.flush()
 
-                    if increment_play_count:
-                        common.increment_play_count_on_item(item)
+    def _close_journal(self):
+        """Removes the journal once the export is complete"""
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+            os.remove(self._get_journal_path())
 
-                cnt += 1
-                bar()
+    def _get_journal_path(self):
+        dst_path = self._get_destination_path()
+        if not dst_path:
+            return None
+
+        return Path(dst_path).joinpath(self._get_cleaned_training_name(),
+                                       self._journal_filename_)
+
+    def _sync_target_files(self, dst_sub_dir: Path, jobs):
+        """Reconciles the training folder on the device with the jobs using
+        the manifest written by the previous export. Songs already on the
+        device are kept (and renamed if their position changed), songs which
+        are not part of the training anymore are deleted.
+        Returns the list of jobs that still need to be copied.
+        """
+        manifest = self._read_manifest(dst_sub_dir)
+        increment_play_count = common.get_training_attribute(
+            self.training, "increment_play_count")
+
+        # Map content keys to the files present on the device
+        available = {}
+        for filename, info in manifest.items():
+            path = dst_sub_dir.joinpath(filename)
+            if not os.path.isfile(path) or \
+                    os.path.getsize(path) != info.get("size"):
+                continue
+            available.setdefault(info.get("key"), []).append(filename)
+
+        to_copy = []
+        to_rename = []
+        kept = set()
+        for job in jobs:
+            filenames = available.get(job["key"])
+            if not filenames:
+                to_copy.append(job)
+                continue
+
+            # Prefer the file that already has the right name
+            filename = job["filename"] if job["filename"] in filenames \
+                else filenames[0]
+            filenames.remove(filename)
+            kept.add(filename)
+            if filename != job["filename"]:
+                to_rename.append((filename, job["filename"]))
+
+            common.say("Keeping[{1}]: {0}".format(job["src"], job["filename"]))
+            if not self.cfg_dry_run:
+                self._set_export_path(job)
+                if increment_play_count:
+                    self._increment_play_count(job["item"])
+
+        # Remove everything that is not part of the new selection
+        protected = kept | {self._manifest_filename_,
+                            self._journal_filename_,
+                            "{}.m3u".format(self._get_training_name()),
+                            self._get_report_filename()}
+        for filename in sorted(os.listdir(dst_sub_dir)):
+            path = dst_sub_dir.joinpath(filename)
+            if filename in protected or not os.path.isfile(path):
+                continue
+            common.say("Deleting: {}".format(path))
+            if not self.cfg_dry_run:
+                os.remove(path)
+
+        # Rename in two steps so that names cannot clash with each other
+        renamed = []
+        for old_name, new_name in to_rename:
+            common.say("Renaming: {0} -> {1}".format(old_name, new_name))
+            if not self.cfg_dry_run:
+                tmp_name = "{}.tmp".format(new_name)
+                os.rename(dst_sub_dir.joinpath(old_name),
+                          dst_sub_dir.joinpath(tmp_name))
+                renamed.append((tmp_name, new_name))
+        for tmp_name, new_name in renamed:
+            os.rename(dst_sub_dir.joinpath(tmp_name),
+                      dst_sub_dir.joinpath(new_name))
+
+        common.say("Sync to target: {0} kept, {1} to copy".format(
+            len(jobs) - len(to_copy), len(to_copy)), log_only=False)
+
+        return to_copy
+
+    def _read_manifest(self, dst_sub_dir: Path):
+        """Returns the files registered in the manifest of the training folder
+        as a dictionary of {filename: {"key": ..., "size": ...}}
+        """
+        path = dst_sub_dir.joinpath(self._manifest_filename_)
+        try:
+            with open(path, "r") as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return {}
+
+        files = manifest.get("files") if isinstance(manifest, dict) else None
+        return files if isinstance(files, dict) else {}
+
+    def _write_manifest(self, dst_sub_dir: Path, jobs):
+        files = {}
+        for job in jobs:
+            if os.path.isfile(job["dst"]):
+                files[job["filename"]] = {
+                    "key": job["key"],
+                    "size": os.path.getsize(job["dst"]),
+                }
+
+        path = dst_sub_dir.joinpath(self._manifest_filename_)
+        with open(path, "w") as manifest_file:
+            json.dump({"version": 1, "files": files}, manifest_file,
+                      indent=2, sort_keys=True)
+        common.say("Written manifest: {0}".format(path), log_only=True)
+
+    def _is_copy_enabled(self):
+        # The copy_files is only False when it is explicitly declared so
+        copy_files = self._get_target_attribute("copy_files")
+        return False if copy_files == False else True
+
+    def _is_link_mode(self):
+        return self._get_target_attribute("link_files") is True
+
+    def _get_export_mode(self):
+        return self._get_target_attribute("export_mode") or EXPORT_MODE_FILES
+
+    def _is_sync_mode(self):
+        return self._get_target_attribute("sync") is True
+
+    @staticmethod
+    def _export_file(copier: filecopy.FileCopier, job, src_future=None):
+        """Copies the (transcoded) song of the job to the target. This is
+        called from the copy worker threads.
+        Returns the size of the copy and the time it took, the sha1 of the
+        copied content is stored in the job (`checksum`).
+        """
+        src = src_future.result() if src_future else job["src"]
+        start_time = time.monotonic()
+        digest = hashlib.sha1()
+        size = copier.copy(src, job["dst"], digest)
+        job["checksum"] = digest.hexdigest()
+        return size, time.monotonic() - start_time
+
+    def _get_transcode_profile(self):
+        """Returns the transcode profile of the target or None if the target
+        does not declare one or the encoder cannot be found.
+        """
+        if self._transcode_profile is not False:
+            return self._transcode_profile
+
+        profile = transcode.get_transcode_profile(
+            self._get_target_attribute("transcode"))
+        if profile and not profile.is_encoder_available():
+            common.say("The encoder for transcoding is not available, "
+                       "copying the original files: {0}".format(
+                profile.command), is_error=True)
+            profile = None
+
+        self._transcode_profile = profile
+        return profile
+
+    @staticmethod
+    def _get_transcoder(profile: transcode.TranscodeProfile):
+        """Returns a transcoder for the profile which encodes to the local
+        cache or, if the cache is disabled, to a temporary work folder.
+        """
+        work_dir = None
+        cache = None
+        if profile.cache_size > 0:
+            cache = transcode.TranscodeCache(
+                common.get_plugin_data_dir("transcode_cache"),
+                profile.cache_size)
+        else:
+            work_dir = tempfile.mkdtemp(prefix="goingrunning_")
+
+        transcoder = transcode.Transcoder(profile, work_dir, cache=cache)
+        common.say("Transcoding to {0} with {1} workers".format(
+            profile, transcoder.workers))
+        return transcoder
+
+    @staticmethod
+    def _release_transcoder(transcoder: transcode.Transcoder):
+        if transcoder.work_dir:
+            shutil.rmtree(transcoder.work_dir, ignore_errors=True)
+        if transcoder.cache:
+            cache = transcoder.cache
+            removed = cache.evict()
+            common.say("Transcode cache: {0} hits, {1} misses, {2} "
+                       "evicted".format(cache.hits, cache.misses, removed))
+
+    def _get_file_copier(self, copy_workers=1):
+        """Returns the file copier configured from the target attributes:
+        `copy_method`, `link_files`, `buffer_budget` (in MB), the rate limits
+        `max_read_mbps` and `max_write_mbps` (in MB/s) and `io_nice`.
+        """
+        copy_method = self._get_target_attribute("copy_method")
+        buffer_budget = self._get_target_attribute("buffer_budget")
+        try:
+            buffer_budget = int(float(buffer_budget) * 1024 * 1024)
+        except (TypeError, ValueError):
+            buffer_budget = filecopy.DEFAULT_BUFFER_BUDGET
+
+        return filecopy.FileCopier(
+            copy_method=copy_method, link_files=self._is_link_mode(),
+            buffer_budget=buffer_budget, workers=copy_workers,
+            read_limiter=self._get_rate_limiter("max_read_mbps"),
+            write_limiter=self._get_rate_limiter("max_write_mbps"),
+            io_nice=self._get_io_niceness())
+
+    def _get_rate_limiter(self, attrib):
+        """Returns a rate limiter for the MB/s set in the target attribute or
+        None if there is no limit.
+        """
+        rate = self._get_target_attribute(attrib)
+        try:
+            rate = float(rate)
+        except (TypeError, ValueError):
+            return None
+
+        return filecopy.RateLimiter(rate * 1024 * 1024) if rate > 0 else None
+
+    def _get_io_niceness(self):
+        """Returns the nice value of the copy workers: `io_nice: yes` is the
+        lowest priority, a number (1-19) sets it explicitly.
+        """
+        io_nice = self._get_target_attribute("io_nice")
+        if io_nice is True:
+            return filecopy.IO_NICENESS
+        try:
+            return min(filecopy.IO_NICENESS, max(0, int(io_nice)))
+        except (TypeError, ValueError):
+            return 0
+
+    def _get_copy_workers(self):
+        """Returns the number of concurrent copy workers declared on the
+        target (`copy_workers`). Defaults to 1 (sequential copy).
+        """
+        copy_workers = self._get_target_attribute("copy_workers")
+        try:
+            copy_workers = int(copy_workers)
+        except (TypeError, ValueError):
+            copy_workers = 1
+
+        return max(1, copy_workers)
 
     def _clean_target(self):
         training_name = self._get_cleaned_training_name()
-        target_name = common.get_training_attribute(self.training, "target")
-        clean_target = common.get_target_attribute_for_training(
-            self.training, "clean_target")
+        target_name = self.target_name
+        clean_target = self._get_target_attribute("clean_target")
 
         if clean_target is False:
             return
 
-        dst_path = Path(common.get_destination_path_for_training(self.training))
+        dst_path = Path(self._get_destination_path())
 
         # Clean entire target
         dst_sub_dir = dst_path
@@ -155,17 +1089,33 @@ class ItemExport:
         common.say("Cleaning target[{0}]: {1}".
                    format(target_name, dst_sub_dir))
 
-        if os.path.isdir(dst_sub_dir):
-            shutil.rmtree(dst_sub_dir)
-            os.mkdir(dst_sub_dir)
+        # Folders are moved to the trash and deleted in the background while
+        # the songs are copied
+        trash_bin = None if self.cfg_dry_run else trash.Trash(dst_path)
+        if trash_bin:
+            trash_bin.discard_leftovers()
+
+        if self._is_sync_mode():
+            # The training folder itself is reconciled in `_copy_items`
+            if clean_target != "training" and os.path.isdir(dst_sub_dir) \
+                    and trash_bin:
+                for name in os.listdir(dst_sub_dir):
+                    if name == training_name or trash.is_trash(name):
+                        continue
+                    trash_bin.discard(dst_sub_dir.joinpath(name))
+        elif os.path.isdir(dst_sub_dir) and trash_bin:
+            if dst_sub_dir == dst_path:
+                for name in os.listdir(dst_sub_dir):
+                    if not trash.is_trash(name):
+                        trash_bin.discard(dst_sub_dir.joinpath(name))
+            else:
+                trash_bin.discard(dst_sub_dir)
+                os.mkdir(dst_sub_dir)
 
         # Clean additional files
-        additional_files = common.get_target_attribute_for_training(
-            self.training,
-            "delete_from_device")
+        additional_files = self._get_target_attribute("delete_from_device")
         if additional_files and len(additional_files) > 0:
-            root = common.get_target_attribute_for_training(self.training,
-                                                            "device_root")
+            root = self._get_target_attribute("device_root")
             root = Path(root).expanduser()
 
             common.say("Deleting additional files: {0}".
@@ -182,8 +1132,38 @@ class ItemExport:
                     continue
 
                 common.say("Deleting: {}".format(dst_path))
-                if not self.cfg_dry_run:
-                    os.remove(dst_path)
+                if trash_bin:
+                    trash_bin.delete(dst_path)
+
+        self._trash = trash_bin
+        if self._clean_first:
+            # The songs only fit once the old ones are gone
+            self._wait_for_cleaning()
+
+    def _wait_for_cleaning(self):
+        """Waits for the deletions started by `_clean_target`"""
+        if not self._trash:
+            return
+
+        common.say("Waiting for the cleaning of target[{0}]".format(
+            self.target_name))
+        errors = self._trash.wait()
+        self._trash = None
+        if errors:
+            common.say("{0} files could not be deleted from target[{1}], they "
+                       "are deleted by the next cleaning".format(
+                len(errors), self.target_name), is_error=True)
+
+    def _get_target_attribute(self, attrib: str):
+        return common.get_target_attribute_for_training(
+            self.training, attrib, self.target_name)
+
+    def _get_destination_path(self):
+        return common.get_destination_path_for_training(self.training,
+                                                        self.target_name)
+
+    def _get_report_filename(self):
+        return "{}.report.json".format(self._get_training_name())
 
     def _get_training_name(self):
         # This will be the name of the playlist file
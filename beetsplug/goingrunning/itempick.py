@@ -6,6 +6,7 @@ from abc import ABC
 from abc import abstractmethod
 from random import randint
 
+from beets import util
 from beets.library import Item
 from confuse import Subview
 from beetsplug.goingrunning import common
@@ -18,12 +19,19 @@ pickers = {
     'random_from_bins': {
         'module': 'beetsplug.goingrunning.itempick',
         'class': 'RandomFromBinsPicker'
+    },
+    'size_budgeted': {
+        'module': 'beetsplug.goingrunning.itempick',
+        'class': 'SizeBudgetedPicker'
     }
 }
 
 default_picker = 'top'
 favour_unplayed = False
 
+# The sizes of the candidates are looked up in batches of this many files
+SIZE_BATCH = 64
+
 
 def get_items_for_duration(training: Subview, items, duration):
     """Returns the items picked by the Picker strategy specified bu the
@@ -37,6 +45,18 @@ def get_items_for_duration(training: Subview, items, duration):
     instance: BasePicker = common.get_class_instance(
         picker_info["module"], picker_info["class"])
     instance.setup(training, items, duration)
+
+    # The size of the selection is limited by the `max_bytes` target attribute
+    # (by the smallest one when the training has several targets)
+    budgets = [common.get_size_in_bytes(
+        common.get_target_attribute_for_training(training, "max_bytes",
+                                                 target_name))
+        for target_name in common.get_target_names_for_training(training)]
+    budgets = [budget for budget in budgets if budget]
+    max_bytes = min(budgets) if budgets else None
+    if max_bytes:
+        instance.set_size_budget(max_bytes)
+
     return instance.get_picked_items()
 
 
@@ -45,6 +65,8 @@ class BasePicker(ABC):
     items = []
     duration = 0
     selection = []
+    max_bytes = None
+    sizes = {}
 
     def __init__(self):
         common.say("PICKER strategy: {0} ('favour_unplayed': {1})".
@@ -57,6 +79,17 @@ class BasePicker(ABC):
         self.items = items
         self.duration = duration
         self.selection = []
+        self.max_bytes = None
+        self.sizes = {}
+
+    def set_size_budget(self, max_bytes, sizes=None):
+        """Limits the total size of the selection to `max_bytes`. The `sizes`
+        list holds the file size of each item (None for missing files).
+        Without it the sizes are only looked up for the items the picker
+        considers.
+        """
+        self.max_bytes = max_bytes
+        self.sizes = dict(enumerate(sizes)) if sizes is not None else {}
 
     @abstractmethod
     def _make_selection(self):
@@ -66,6 +99,7 @@ class BasePicker(ABC):
         answer = []
 
         self._make_selection()
+        self._apply_size_budget()
 
         for sel_data in self.selection:
             index = sel_data["index"]
@@ -74,6 +108,46 @@ class BasePicker(ABC):
 
         return answer
 
+    def _get_item_size(self, index):
+        if index not in self.sizes:
+            self._load_item_sizes([index])
+        return self.sizes.get(index)
+
+    def _load_item_sizes(self, indices):
+        """Looks up the sizes of the items that are not known yet with one
+        batch of stat calls
+        """
+        paths = {index: util.syspath(self.items[index].get("path"))
+                 for index in indices
+                 if index not in self.sizes and 0 <= index < len(self.items)}
+        if not paths:
+            return
+
+        sizes = common.get_file_sizes(paths.values())
+        for index, path in paths.items():
+            self.sizes[index] = sizes.get(path)
+
+    def _apply_size_budget(self):
+        """Drops items from the end of the selection (and the missing files)
+        until the selection fits in the size budget
+        """
+        if not self.max_bytes:
+            return
+
+        self._load_item_sizes(sel_data["index"] for sel_data in self.selection)
+        self.selection = [sel_data for sel_data in self.selection
+                          if self._get_item_size(sel_data["index"])
+                          is not None]
+        sel_bytes = sum(self._get_item_size(sel_data["index"])
+                        for sel_data in self.selection)
+        while self.selection and sel_bytes > self.max_bytes:
+            sel_data = self.selection.pop()
+            sel_bytes -= self._get_item_size(sel_data["index"])
+
+        common.say("SIZE BUDGET: {} of {}".format(
+            common.get_human_readable_size(sel_bytes),
+            common.get_human_readable_size(self.max_bytes)))
+
     # def _show_items_in_bins(self):
     #     max_bin = len(self.bin_boundaries)
     #     for bi in range(0, max_bin):
@@ -106,6 +180,48 @@ class TopPicker(BasePicker):
             self.selection.append(sel_data)
 
 
+class SizeBudgetedPicker(BasePicker):
+    """Picks the top items (as the TopPicker) that fit both the duration and
+    the size budget. Items that would exceed the remaining budget are skipped
+    in favour of the next (smaller) ones.
+    """
+
+    def __init__(self):
+        super(SizeBudgetedPicker, self).__init__()
+
+    def _make_selection(self):
+        sel_dur = 0
+        sel_bytes = 0
+        candidates = list(range(len(self.items) - 1, -1, -1))
+        if favour_unplayed:
+            candidates.sort(
+                key=lambda i: self.items[i].get("play_count", 0) or 0)
+
+        for position, index in enumerate(candidates):
+            if sel_dur >= self.duration:
+                break
+            if self.max_bytes and index not in self.sizes:
+                self._load_item_sizes(
+                    candidates[position:position + SIZE_BATCH])
+
+            item: Item = self.items[index]
+            size = self._get_item_size(index) if self.max_bytes else 0
+            if size is None or \
+                    (self.max_bytes and sel_bytes + size > self.max_bytes):
+                continue
+
+            sel_data = {
+                "index": index,
+                "length": item.get("length")
+            }
+            sel_dur += round(item.get("length"))
+            sel_bytes += size
+            self.selection.append(sel_data)
+
+        common.say("SELECTED(sec):{} of {} SIZE:{}".format(
+            sel_dur, self.duration, common.get_human_readable_size(sel_bytes)))
+
+
 class RandomFromBinsPicker(BasePicker):
     bin_boundaries = []
     max_allowed_time_difference = 120
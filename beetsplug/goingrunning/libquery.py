@@ -0,0 +1,244 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from beets.dbcore import query, types
+from beets.library import Library, Item
+
+# The least recently used queries are dropped above this number of entries
+MAX_CACHED_QUERIES = 64
+
+# Expression index on the numeric values of the flexible attributes
+NUMERIC_INDEX_NAME = "goingrunning_numeric_attributes"
+_NUMERIC_VALUE = "CAST(value AS REAL)"
+
+
+class FlexNumericQuery(query.NumericQuery):
+    """A numeric (range) query on a flexible attribute that the database can
+    evaluate: the values stored in `item_attributes` are cast to numbers and
+    compared in SQL instead of loading every item to match it in Python.
+    """
+
+    def clause(self):
+        if self.fast:
+            # A real column of the items table
+            return super().clause()
+
+        if self.point is not None:
+            condition, subvals = _NUMERIC_VALUE + " = ?", (self.point,)
+        elif self.rangemin is not None and self.rangemax is not None:
+            condition = "{0} >= ? AND {0} <= ?".format(_NUMERIC_VALUE)
+            subvals = (self.rangemin, self.rangemax)
+        elif self.rangemin is not None:
+            condition, subvals = _NUMERIC_VALUE + " >= ?", (self.rangemin,)
+        elif self.rangemax is not None:
+            condition, subvals = _NUMERIC_VALUE + " <= ?", (self.rangemax,)
+        else:
+            condition, subvals = "1", ()
+
+        return "{0}.id IN (SELECT entity_id FROM {1} WHERE key = ? AND {2})" \
+                   .format(Item._table, Item._flex_table, condition), \
+            (self.field,) + subvals
+
+
+class FlexFloat(types.Float):
+    """The type of the numeric flexible attributes, queried in SQL"""
+    query = FlexNumericQuery
+
+
+def create_numeric_index(lib: Library):
+    """Indexes the numeric values of the flexible attributes so that a range
+    query on them is an index lookup instead of a scan of all the values.
+    """
+    with lib.transaction() as tx:
+        tx.mutate("CREATE INDEX IF NOT EXISTS {0} ON {1} (key, {2})".format(
+            NUMERIC_INDEX_NAME, Item._flex_table, _NUMERIC_VALUE))
+
+
+def split_query(parsed_query):
+    """Splits the clauses of the (AND) query into the ones that the database
+    can evaluate and the ones that need to be matched in Python. Beets
+    evaluates the whole query in Python as soon as one clause needs it, this
+    way the database still filters the items by the other clauses.
+    Returns a (fast, slow) tuple of queries, each one can be None.
+    """
+    if isinstance(parsed_query, query.AndQuery):
+        subqueries = list(parsed_query.subqueries)
+    else:
+        subqueries = [parsed_query]
+
+    fast = []
+    slow = []
+    for subquery in subqueries:
+        if isinstance(subquery, query.TrueQuery):
+            continue
+        if subquery.clause()[0] is None:
+            slow.append(subquery)
+        else:
+            fast.append(subquery)
+
+    return query.AndQuery(fast) if fast else None, \
+        query.AndQuery(slow) if slow else None
+
+
+def count_items(lib: Library, parsed_query):
+    """Returns the number of items matching the query. The database counts
+    them when the whole query can be expressed in SQL, otherwise only the
+    items passing the SQL clauses are loaded to match the others.
+    """
+    fast, slow = split_query(parsed_query)
+    if slow:
+        return sum(1 for item in lib.items(fast) if slow.match(item))
+
+    where, subvals = fast.clause() if fast else (None, ())
+    with lib.transaction() as tx:
+        rows = tx.query("SELECT COUNT(*) FROM {0} WHERE {1}".format(
+            Item._table, where or "1"), subvals)
+
+    return rows[0][0]
+
+
+def get_items(lib: Library, parsed_query):
+    """Returns the items matching the query (see `split_query`)"""
+    fast, slow = split_query(parsed_query)
+    items = lib.items(fast)
+    if not slow:
+        return items
+
+    return [item for item in items if slow.match(item)]
+
+
+class LightItem(dict):
+    """A lightweight stand-in for a library item holding only the few fields
+    that the ordering and the picking of the songs need. Fields are read
+    like those of an item (`item.get("length")`, `item["id"]`,
+    `item.ordering_score`).
+    """
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+
+def get_light_items(lib: Library, parsed_query, fields, model_cls=Item):
+    """Returns the items matching the query as LightItems with the `id` and
+    the requested fields only (fixed fields and flexible attributes), in the
+    default item order of the library. Returns None if the query needs to be
+    matched in Python (that needs the full items).
+    """
+    fast, slow = split_query(parsed_query)
+    if slow:
+        return None
+
+    where, subvals = fast.clause() if fast else (None, ())
+    where = where or "1"
+    fixed = ["id"] + [f for f in fields if f in model_cls._fields
+                      and f != "id"]
+    flex = [f for f in fields if f not in model_cls._fields]
+
+    sort = lib.get_default_item_sort()
+    order_by = sort.order_clause() if sort and not sort.is_slow() else None
+
+    with lib.transaction() as tx:
+        rows = tx.query("SELECT {0} FROM {1} WHERE {2} {3}".format(
+            ", ".join(fixed), model_cls._table, where,
+            "ORDER BY {0}".format(order_by) if order_by else ""), subvals)
+        flex_rows = tx.query(
+            "SELECT entity_id, key, value FROM {0} WHERE key IN ({1}) AND "
+            "entity_id IN (SELECT id FROM {2} WHERE {3})".format(
+                model_cls._flex_table, ", ".join("?" * len(flex)),
+                model_cls._table, where), tuple(flex) + tuple(subvals)) \
+            if flex else []
+
+    items = []
+    items_by_id = {}
+    for row in rows:
+        item = LightItem((key, model_cls._type(key).from_sql(row[key]))
+                         for key in fixed)
+        items.append(item)
+        items_by_id[item["id"]] = item
+
+    for entity_id, key, value in flex_rows:
+        item = items_by_id.get(entity_id)
+        if item is not None:
+            item[key] = model_cls._type(key).from_sql(value)
+
+    return items
+
+
+def hydrate_items(lib: Library, items):
+    """Returns the full library items of the (light) items in their order"""
+    answer = []
+    for item in items:
+        if not isinstance(item, LightItem):
+            answer.append(item)
+            continue
+        lib_item = lib.get_item(item["id"])
+        if lib_item:
+            answer.append(lib_item)
+
+    return answer
+
+
+def get_query_cache_key(*parts):
+    """Returns a hash of the (JSON serializable) parts that make a query.
+    The types of the Item model (plugins can add types) are part of it too
+    because they decide how the query is parsed.
+    """
+    item_types = sorted((key, type(item_type).__name__)
+                        for key, item_type in Item._types.items())
+    data = json.dumps([parts, item_types], default=str)
+
+    return hashlib.sha1(data.encode("UTF-8")).hexdigest()
+
+
+class QueryCache:
+    """A bounded cache of the parsed training queries. The key is a hash of
+    everything the query is built from (see `get_query_cache_key`), so a
+    change in the configuration simply makes a new entry. It can be shared
+    by several threads.
+    """
+
+    def __init__(self, max_size=MAX_CACHED_QUERIES):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._queries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """Returns the cached query or builds (and caches) it with `build`
+        """
+        with self._lock:
+            if key in self._queries:
+                self.hits += 1
+                self._queries.move_to_end(key)
+                return self._queries[key]
+
+        parsed_query = build()
+        with self._lock:
+            self.misses += 1
+            self._queries[key] = parsed_query
+            self._queries.move_to_end(key)
+            while len(self._queries) > self.max_size:
+                self._queries.popitem(last=False)
+
+        return parsed_query
+
+    def clear(self):
+        with self._lock:
+            self._queries.clear()
+
+
+_query_cache = QueryCache()
+
+
+def get_query_cache():
+    """Returns the query cache shared by the whole process"""
+    return _query_cache
@@ -0,0 +1,191 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import os
+import shutil
+import subprocess
+
+from beets import util
+from beetsplug.goingrunning import common
+
+MP3_EXTENSION = ".mp3"
+
+# Bitrates (kbit/s) of MPEG Layer III by version (1 or 2/2.5) and index
+_MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_MP3_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG 1
+    2: [22050, 24000, 16000],  # MPEG 2
+    0: [11025, 12000, 8000],  # MPEG 2.5
+}
+
+
+def can_concatenate(paths, extension=MP3_EXTENSION):
+    """The songs can be joined without encoding if they all are MP3 files of
+    the same stream format (see `get_mp3_stream_format`). Frames of another
+    sample rate or MPEG version in the same stream make the players play at
+    the wrong speed or glitch.
+    """
+    if extension != MP3_EXTENSION or not paths or not all(
+            os.path.splitext(util.displayable_path(path))[1].lower() ==
+            MP3_EXTENSION for path in paths):
+        return False
+
+    formats = set()
+    for path in paths:
+        try:
+            formats.add(get_mp3_stream_format(util.syspath(path)))
+        except OSError:
+            return False
+
+    return len(formats) == 1 and None not in formats
+
+
+def get_mp3_stream_format(path):
+    """Returns the (MPEG version, sample rate, channels) of the first audio
+    frame of the file or None if its audio does not start with a valid
+    frame. Stereo and joint stereo frames mix well, so only the number of
+    channels is compared.
+    """
+    start, end = get_mp3_audio_range(path)
+    with open(path, "rb") as f:
+        f.seek(start)
+        header = f.read(4)
+    if _get_mp3_frame_length(header) is None:
+        return None
+
+    version = (header[1] >> 3) & 0x03
+    sample_rate = _MP3_SAMPLE_RATES[version][(header[2] >> 2) & 0x03]
+    channels = 1 if header[3] >> 6 == 3 else 2
+
+    return version, sample_rate, channels
+
+
+def get_mp3_audio_range(path):
+    """Returns the (start, end) offsets of the MPEG audio frames of the file,
+    leaving out the ID3v2 tag at the start, the Xing/Info/VBRI header frame
+    (it describes the single file only) and the ID3v1 tag at the end.
+    """
+    size = os.path.getsize(path)
+    start = 0
+    end = size
+    with open(path, "rb") as f:
+        header = f.read(10)
+        if len(header) == 10 and header[0:3] == b"ID3":
+            tag_size = (header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | \
+                       (header[8] & 0x7f) << 7 | (header[9] & 0x7f)
+            # The footer flag adds another 10 bytes
+            start = 10 + tag_size + (10 if header[5] & 0x10 else 0)
+
+        if size - start >= 128:
+            f.seek(size - 128)
+            if f.read(3) == b"TAG":
+                end = size - 128
+
+        f.seek(start)
+        frame = f.read(64)
+        length = _get_mp3_frame_length(frame)
+        if length and _is_mp3_info_frame(frame):
+            start += length
+
+    return start, max(start, end)
+
+
+def _get_mp3_frame_length(header):
+    """Returns the length of the Layer III frame starting with the 4 bytes of
+    `header` or None if they are not a valid frame header.
+    """
+    if len(header) < 4 or header[0] != 0xff or header[1] & 0xe0 != 0xe0:
+        return None
+
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or \
+            sample_rate_index == 3:
+        return None
+
+    bitrate = _MP3_BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    samples = 144 if version == 3 else 72
+
+    return samples * bitrate // sample_rate + padding
+
+
+def _is_mp3_info_frame(frame):
+    """Checks if the frame is a Xing/Info or VBRI header frame"""
+    version = (frame[1] >> 3) & 0x03
+    mono = (frame[3] >> 6) == 3
+    if version == 3:
+        side_info = 17 if mono else 32
+    else:
+        side_info = 9 if mono else 17
+    offset = 4 + side_info + (0 if frame[1] & 0x01 else 2)
+
+    return frame[offset:offset + 4] in (b"Xing", b"Info") or \
+        frame[36:40] == b"VBRI"
+
+
+def concatenate_mp3(srcs, dst, buffer_size=1024 * 1024):
+    """Joins the audio frames of the MP3 files into `dst` without encoding.
+    The data is streamed through a single buffer so the memory use does not
+    depend on the size of the songs. Returns the number of bytes written.
+    """
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    written = 0
+    with open(dst, "wb") as dst_file:
+        for src in srcs:
+            src = util.syspath(src)
+            start, end = get_mp3_audio_range(src)
+            with open(src, "rb") as src_file:
+                src_file.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    n = src_file.readinto(view[:min(buffer_size, remaining)])
+                    if not n:
+                        break
+                    dst_file.write(view[:n])
+                    remaining -= n
+                    written += n
+
+    return written
+
+
+def encode_merged(srcs, dst, bitrate):
+    """Decodes and joins the songs with the concat filter of ffmpeg and
+    encodes them into `dst` (the format follows the extension of `dst`).
+    """
+    if not is_encoder_available():
+        raise util.FilesystemError("ffmpeg is not available", 'merge',
+                                   (srcs, dst))
+
+    args = ["ffmpeg", "-v", "error", "-y"]
+    for src in srcs:
+        args += ["-i", util.syspath(src)]
+    inputs = "".join("[{}:a:0]".format(i) for i in range(len(srcs)))
+    args += ["-filter_complex",
+             "{0}concat=n={1}:v=0:a=1[out]".format(inputs, len(srcs)),
+             "-map", "[out]", "-b:a", "{}k".format(bitrate),
+             util.syspath(dst)]
+
+    common.say("Merging: {0}".format(" ".join(args)))
+    try:
+        subprocess.run(args, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       check=True)
+    except (OSError, subprocess.CalledProcessError) as exc:
+        stderr = getattr(exc, "stderr", None)
+        raise util.FilesystemError(
+            stderr.decode("utf-8", "replace") if stderr else exc,
+            'merge', (srcs, dst))
+
+    return os.path.getsize(dst)
+
+
+def is_encoder_available():
+    return shutil.which("ffmpeg") is not None
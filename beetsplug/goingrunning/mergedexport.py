@@ -0,0 +1,94 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import contextlib
+import os
+import time
+from pathlib import Path
+
+from beetsplug.goingrunning import common
+from beetsplug.goingrunning import merge
+from beetsplug.goingrunning import transcode
+from beetsplug.goingrunning.itemexport import ItemExport
+
+
+class MergedExport(ItemExport):
+    """Joins the songs, in their order, into one single file in the training
+    folder of the target. Players that stutter between tracks get one long
+    track instead, which is also the fastest thing to write.
+    """
+    merged_filename = None
+
+    def prepare(self):
+        with self.stats.stage("capacity"):
+            if not self._check_capacity():
+                return False
+        with self.stats.stage("clean"):
+            self._clean_target()
+
+        return True
+
+    def copy(self):
+        with self.stats.stage("copy"):
+            self.merged_filename = self._write_merged()
+
+    def finish(self, write_tags=True):
+        with self.stats.stage("playlist"):
+            self._generate_playist(
+                [self.merged_filename] if self.merged_filename else [])
+        if write_tags:
+            self.write_tags()
+        self._finish_cleaning()
+        self._report()
+
+    def _write_merged(self):
+        """Writes the merged file and returns its name. MP3 songs are joined
+        without encoding, anything else is encoded with the bitrate and in
+        the format of the `transcode` target attribute (MP3 by default).
+        """
+        dst_sub_dir = Path(self._get_destination_path()).joinpath(
+            self._get_cleaned_training_name())
+        jobs = self._get_jobs(dst_sub_dir)
+        if not jobs:
+            return None
+
+        profile = self._get_transcode_profile()
+        extension = profile.extension if profile else merge.MP3_EXTENSION
+        bitrate = profile.bitrate if profile else transcode.DEFAULT_BITRATE
+        filename = "{0}{1}".format(self._get_training_name(), extension)
+        srcs = [job["src"] for job in jobs]
+        concatenate = merge.can_concatenate(srcs, extension)
+
+        common.say("Merging {0} songs to target[{1}]: {2} ({3})".format(
+            len(srcs), self.target_name, filename,
+            "joining MP3 frames" if concatenate else
+            "encoding to {0}@{1}k".format(extension[1:], bitrate)),
+            log_only=False)
+        os.makedirs(dst_sub_dir, exist_ok=True)
+        if self.cfg_dry_run:
+            self._set_plan(jobs)
+            return filename
+
+        part_path = dst_sub_dir.joinpath("{0}.part{1}".format(
+            self._get_training_name(), extension))
+        start_time = time.monotonic()
+        try:
+            if concatenate:
+                size = merge.concatenate_mp3(
+                    srcs, part_path, self._get_file_copier().buffer_size)
+            else:
+                size = merge.encode_merged(srcs, part_path, bitrate)
+            os.replace(part_path, dst_sub_dir.joinpath(filename))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(part_path)
+            raise
+        self.stats.add_file(size, time.monotonic() - start_time)
+
+        if common.get_training_attribute(self.training,
+                                         "increment_play_count"):
+            for job in jobs:
+                self._increment_play_count(job["item"])
+            self._store_play_counts()
+
+        return filename
@@ -0,0 +1,108 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from beets import util
+from beets.library import FileOperationError, Library
+from beetsplug.goingrunning import common
+
+DEFAULT_WORKERS = 4
+
+# Writes that keep failing are given up after this many attempts
+MAX_ATTEMPTS = 5
+
+
+def get_tag_write_queue(lib: Library):
+    """Returns the queue of the pending tag writes of the library in the
+    plugin data folder. The item ids only make sense in their own library
+    so each library (database file) has its own queue.
+    """
+    lib_key = hashlib.sha1(util.bytestring_path(lib.path)).hexdigest()
+    return TagWriteQueue(os.path.join(common.get_plugin_data_dir(),
+                                      "tag_writes_{0}.json".format(
+                                          lib_key[:16])))
+
+
+class TagWriteQueue:
+    """A persistent queue of the library items whose tags need to be written
+    to their files. The queue is a small JSON store so that the writes that
+    were still pending when an export was interrupted are made on the next
+    run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._store = common.JsonStore(path, "items")
+
+    def add(self, item_ids):
+        """Queues the tag writes of the items"""
+        with self._store.locked():
+            pending = self._store.load()
+            for item_id in item_ids:
+                if item_id:
+                    pending.setdefault(str(item_id), 0)
+            self._store.save(pending)
+
+    def get_pending(self):
+        """Returns the pending writes as a dictionary of {item_id: attempts}
+        """
+        with self._store.locked():
+            return {int(item_id): attempts
+                    for item_id, attempts in self._store.load().items()}
+
+    def drain(self, lib, workers=DEFAULT_WORKERS):
+        """Writes the tags of the queued items with a pool of workers.
+        The items that could not be written stay in the queue (up to
+        MAX_ATTEMPTS times). Returns the number of written and failed items.
+        """
+        pending = self.get_pending()
+        if not pending:
+            return 0, 0
+
+        # The library is only read from this thread
+        items = []
+        for item_id in pending:
+            item = lib.get_item(item_id)
+            if item:
+                items.append(item)
+            else:
+                common.say("Tag write skipped, item[{0}] is not in the "
+                           "library anymore.".format(item_id))
+
+        common.say("Writing tags of {0} songs with {1} workers".format(
+            len(items), workers))
+
+        failed = {}
+        failures = 0
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = executor.map(self._write_item, items)
+            for item, error in zip(items, results):
+                if error is None:
+                    continue
+                failures += 1
+                attempts = pending[item.id] + 1
+                if attempts < MAX_ATTEMPTS:
+                    failed[str(item.id)] = attempts
+                common.say("Tag write failed ({0}/{1}): {2}".format(
+                    attempts, MAX_ATTEMPTS, error), is_error=True)
+
+        with self._store.locked():
+            # Keep the writes that were queued in the meantime
+            remaining = self._store.load()
+            for item_id in pending:
+                remaining.pop(str(item_id), None)
+            remaining.update(failed)
+            self._store.save(remaining)
+
+        return len(items) - failures, failures
+
+    @staticmethod
+    def _write_item(item):
+        try:
+            item.write()
+        except FileOperationError as err:
+            return err
+        return None
@@ -0,0 +1,252 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
+
+from beets import util
+from beetsplug.goingrunning import audiorange
+from beetsplug.goingrunning import common
+
+DEFAULT_COMMAND = u'ffmpeg -v error -y -i $source -vn -map_metadata 0 ' \
+                  u'-b:a ${bitrate}k $dest'
+DEFAULT_BITRATE = 192
+DEFAULT_CACHE_SIZE = 1024
+
+FORMAT_EXTENSIONS = {
+    "mp3": ".mp3",
+    "ogg": ".ogg",
+    "opus": ".opus",
+    "aac": ".m4a",
+    "m4a": ".m4a",
+    "flac": ".flac",
+}
+
+
+def get_transcode_profile(cfg):
+    """Returns the TranscodeProfile for the `transcode` target attribute or
+    None if transcoding is not configured. The attribute can be a format
+    name (`transcode: mp3`) or a dictionary with the `format`, `bitrate`,
+    `command` and `cache_size` (MB, 0 disables the cache) keys.
+    """
+    if not cfg:
+        return None
+
+    if isinstance(cfg, str):
+        cfg = {"format": cfg}
+
+    fmt = str(cfg.get("format", "")).lower()
+    if fmt not in FORMAT_EXTENSIONS:
+        common.say("Unknown transcode format: {0}".format(fmt),
+                   log_only=False)
+        return None
+
+    try:
+        bitrate = int(cfg.get("bitrate", DEFAULT_BITRATE))
+    except (TypeError, ValueError):
+        bitrate = DEFAULT_BITRATE
+
+    try:
+        cache_size = float(cfg.get("cache_size", DEFAULT_CACHE_SIZE))
+    except (TypeError, ValueError):
+        cache_size = DEFAULT_CACHE_SIZE
+
+    profile = TranscodeProfile(fmt, bitrate,
+                               cfg.get("command", DEFAULT_COMMAND))
+    profile.cache_size = int(max(0.0, cache_size) * 1024 * 1024)
+
+    return profile
+
+
+class TranscodeProfile:
+    def __init__(self, fmt, bitrate=DEFAULT_BITRATE, command=DEFAULT_COMMAND):
+        self.format = fmt
+        self.bitrate = bitrate
+        self.command = command
+        self.cache_size = 0
+
+    @property
+    def extension(self):
+        return FORMAT_EXTENSIONS[self.format]
+
+    @property
+    def key(self):
+        """A short hash identifying the output of this profile"""
+        profile = "{0}|{1}|{2}".format(self.format, self.bitrate, self.command)
+        return hashlib.sha1(profile.encode("UTF-8")).hexdigest()[:12]
+
+    def needs_transcoding(self, src):
+        ext = os.path.splitext(src)[1].lower()
+        return ext != self.extension
+
+    def get_args(self, src, dst):
+        """Splits the command and substitutes the arguments one by one so
+        that paths with spaces do not need any quoting.
+        """
+        values = {
+            "source": src,
+            "dest": dst,
+            "bitrate": self.bitrate,
+            "format": self.format,
+        }
+        return [Template(arg).safe_substitute(values)
+                for arg in shlex.split(self.command)]
+
+    def is_encoder_available(self):
+        args = shlex.split(self.command)
+        return len(args) > 0 and shutil.which(args[0]) is not None
+
+    def __str__(self):
+        return "{0}@{1}k".format(self.format, self.bitrate)
+
+
+class Transcoder:
+    """Runs the encoder for the songs of an export. Each encoding is a
+    separate encoder process so the pool (one slot per core by default)
+    keeps all cores busy.
+    """
+
+    def __init__(self, profile: TranscodeProfile, work_dir=None, workers=None,
+                 cache=None):
+        self.profile = profile
+        self.work_dir = work_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.cache: TranscodeCache = cache
+        self._executor = None
+        self._futures = []
+
+    def __enter__(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            for future in self._futures:
+                future.cancel()
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        self._futures = []
+
+    def submit(self, src, name):
+        """Schedules the transcoding of `src` and returns a future of the path
+        of the transcoded file.
+        """
+        dst = None
+        if not self.cache:
+            dst = os.path.join(self.work_dir,
+                               "{0}{1}".format(name, self.profile.extension))
+        future = self._executor.submit(self.transcode, src, dst)
+        self._futures.append(future)
+        return future
+
+    def transcode(self, src, dst):
+        if self.cache:
+            cached = self.cache.lookup(src, self.profile)
+            if cached:
+                common.say("Transcode cache hit: {0}".format(src))
+                return cached
+            dst = self.cache.get_partial_path(src, self.profile)
+
+        args = self.profile.get_args(util.syspath(src), util.syspath(dst))
+        common.say("Transcoding: {0}".format(" ".join(args)))
+        try:
+            subprocess.run(args, stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, check=True)
+        except (OSError, subprocess.CalledProcessError) as exc:
+            stderr = getattr(exc, "stderr", None)
+            raise util.FilesystemError(
+                stderr.decode("utf-8", "replace") if stderr else exc,
+                'transcode', (src, dst))
+
+        if self.cache:
+            dst = self.cache.store(dst, src, self.profile)
+
+        return dst
+
+
+class TranscodeCache:
+    """A local folder of transcoded songs keyed by the audio of the source
+    (its tags are left out, writing them does not invalidate the cached
+    song) and by the transcode profile. The
+    modification time of the cached files is bumped on every hit so that
+    the least recently used ones are evicted first when the folder grows
+    above `max_size` bytes.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, src, profile: TranscodeProfile):
+        key = "{0}|{1}".format(audiorange.get_audio_key(src), profile.key)
+        return hashlib.sha1(key.encode("UTF-8")).hexdigest()
+
+    def get_path(self, src, profile: TranscodeProfile):
+        return os.path.join(self.directory, "{0}{1}".format(
+            self.get_key(src, profile), profile.extension))
+
+    def get_partial_path(self, src, profile: TranscodeProfile):
+        """Files are encoded to a partial path first so that an interrupted
+        encoding never ends up in the cache.
+        """
+        return "{0}.{1}.part{2}".format(self.get_path(src, profile),
+                                        common.get_random_string(),
+                                        profile.extension)
+
+    def lookup(self, src, profile: TranscodeProfile):
+        path = self.get_path(src, profile)
+        try:
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return path
+
+    def store(self, partial_path, src, profile: TranscodeProfile):
+        path = self.get_path(src, profile)
+        os.replace(partial_path, path)
+        return path
+
+    def evict(self):
+        """Removes the least recently used files until the cache fits in
+        `max_size`. Returns the number of removed files.
+        """
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if ".part" in name:
+                # Leftover of an interrupted encoding
+                if time.time() - st.st_mtime > 86400:
+                    os.remove(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total_size += st.st_size
+
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            removed += 1
+
+        return removed
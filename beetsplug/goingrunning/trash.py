@@ -0,0 +1,107 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from beetsplug.goingrunning import common
+
+TRASH_PREFIX = ".goingrunning-trash-"
+DEFAULT_WORKERS = 4
+
+
+def is_trash(name):
+    return name.startswith(TRASH_PREFIX)
+
+
+class Trash:
+    """Deletes files and folders of a target in the background. A folder is
+    first renamed into a hidden trash folder in `root` (an instant operation
+    on the same filesystem) so that its place can be reused right away, its
+    content is then deleted by a pool of workers while the export goes on.
+    """
+
+    def __init__(self, root, workers=DEFAULT_WORKERS):
+        self.root = str(root)
+        self.workers = workers
+        self.errors = []
+        self._trash_dir = None
+        self._discarded = 0
+        self._futures = []
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def discard(self, path):
+        """Moves `path` to the trash and schedules its deletion. If it cannot
+        be moved, it is deleted right away.
+        """
+        path = str(path)
+        trash_dir = self._get_trash_dir()
+        self._discarded += 1
+        trashed = os.path.join(trash_dir, "{0}_{1}".format(
+            self._discarded, os.path.basename(path)))
+        try:
+            os.rename(path, trashed)
+        except OSError as err:
+            common.say("Cannot move to trash ({0}), deleting: {1}".format(
+                err, path))
+            self._remove(path)
+            return
+
+        self.delete(trashed)
+
+    def delete(self, path):
+        """Schedules the deletion of the file or folder"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._futures.append(self._executor.submit(self._remove, str(path)))
+
+    def discard_leftovers(self):
+        """Schedules the deletion of the trash folders left by an export that
+        was interrupted before they were emptied.
+        """
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if is_trash(name) and path != self._trash_dir:
+                self.delete(path)
+
+    def wait(self):
+        """Waits until everything in the trash is deleted and removes the
+        trash folder. Returns the errors of the deletions that failed (what
+        is left is deleted by the next cleaning of the target).
+        """
+        for future in self._futures:
+            future.result()
+        self._futures = []
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        if self._trash_dir is not None:
+            self._remove(self._trash_dir)
+            self._trash_dir = None
+
+        return self.errors
+
+    def _get_trash_dir(self):
+        if self._trash_dir is None:
+            self._trash_dir = os.path.join(self.root, "{0}{1}".format(
+                TRASH_PREFIX, common.get_random_string()))
+            os.makedirs(self._trash_dir)
+        return self._trash_dir
+
+    def _remove(self, path):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError as err:
+            common.say("Cannot delete: {0} ({1})".format(path, err),
+                       is_error=True)
+            with self._lock:
+                self.errors.append(err)
@@ -0,0 +1,142 @@
+#   Copyright: Copyright (c) 2020., Adam Jakab
+#   Author: Adam Jakab <adam at jakab dot pro>
+#   License: See LICENSE.txt
+import contextlib
+import hashlib
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from beets import util
+from beetsplug.goingrunning import common
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+# The oldest source hashes are forgotten above this number of entries
+MAX_CACHE_ENTRIES = 50000
+
+
+def get_source_hash_cache():
+    """Returns the cache of the source hashes in the plugin data folder"""
+    return SourceHashCache(os.path.join(common.get_plugin_data_dir(),
+                                        "source_hashes.json"))
+
+
+def hash_file(path, drop_cache=False):
+    """Returns the sha1 of the content of the file. The file is mapped in
+    memory and hashed in large chunks (hashlib releases the GIL while it
+    works on them so several files can be hashed in parallel threads).
+    With `drop_cache` the pages of the file are flushed and dropped from the
+    page cache first so that the content is really read back from the device.
+    """
+    digest = hashlib.sha1()
+    with open(util.syspath(path), "rb") as f:
+        if drop_cache and hasattr(os, "posix_fadvise"):
+            with contextlib.suppress(OSError):
+                os.fsync(f.fileno())
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return digest.hexdigest()
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                memoryview(mm) as view:
+            for offset in range(0, size, HASH_CHUNK_SIZE):
+                digest.update(view[offset:offset + HASH_CHUNK_SIZE])
+
+    return digest.hexdigest()
+
+
+class SourceHashCache:
+    """A local store of the hashes of the library files keyed by their path,
+    size and modification time so that the songs are not hashed again on
+    every export.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._store = common.JsonStore(path, "hashes")
+        self._hashes = None
+        self._added = OrderedDict()
+
+    def get_hash(self, path):
+        key = self._get_key(path)
+        with self._lock:
+            hashes = self._load()
+            if key in hashes:
+                self.hits += 1
+                return hashes[key]
+
+        value = hash_file(path)
+        with self._lock:
+            self.misses += 1
+            self._hashes[key] = value
+            self._hashes.move_to_end(key)
+            self._added[key] = value
+        return value
+
+    def save(self):
+        with self._lock:
+            if not self._added:
+                return
+            with self._store.locked():
+                # Keep the hashes stored by other runs in the meantime
+                hashes = OrderedDict(self._store.load())
+                for key, value in self._added.items():
+                    hashes[key] = value
+                    hashes.move_to_end(key)
+                while len(hashes) > MAX_CACHE_ENTRIES:
+                    hashes.popitem(last=False)
+                self._store.save(hashes)
+            self._hashes = hashes
+            self._added = OrderedDict()
+
+    @staticmethod
+    def _get_key(path):
+        st = os.stat(util.syspath(path))
+        key = "{0}|{1}|{2}".format(util.displayable_path(path), st.st_size,
+                                   st.st_mtime_ns)
+        return hashlib.sha1(key.encode("UTF-8")).hexdigest()
+
+    def _load(self):
+        if self._hashes is None:
+            with self._store.locked():
+                self._hashes = OrderedDict(self._store.load())
+        return self._hashes
+
+
+class Verifier:
+    """Compares the copied files with their sources in parallel threads"""
+
+    def __init__(self, cache: SourceHashCache = None, workers=None):
+        self.cache = cache
+        self.workers = workers or os.cpu_count() or 1
+
+    def verify(self, pairs):
+        """Hashes the (source, destination) pairs and returns the ones that
+        differ or cannot be read.
+        """
+        pairs = list(pairs)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(self._is_intact, pairs))
+
+        if self.cache:
+            self.cache.save()
+
+        return [pair for pair, intact in zip(pairs, results) if not intact]
+
+    def _is_intact(self, pair):
+        src, dst = pair
+        try:
+            src_hash = self.cache.get_hash(src) if self.cache \
+                else hash_file(src)
+            return src_hash == hash_file(dst, drop_cache=True)
+        except OSError as err:
+            common.say("Verification error: {0}".format(err), is_error=True)
+            return False
@@ -0,0 +1,86 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+"""Compares the copy methods of the exporter on large (FLAC sized) files.
+
+    python -m test.benchmark.filecopy_benchmark [--dst DIR] [--files N]
+        [--size MB] [--rounds N]
+
+Point `--dst` to a folder on your device to measure the real gain there, by
+default the files are copied to a temporary folder beside the sources.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from beetsplug.goingrunning import filecopy
+
+
+def create_sources(src_dir, files, size):
+    paths = []
+    chunk = os.urandom(1024 * 1024)
+    for i in range(files):
+        path = os.path.join(src_dir, "song_{0:02d}.flac".format(i))
+        with open(path, "wb") as f:
+            for _ in range(size):
+                f.write(chunk)
+        paths.append(path)
+    return paths
+
+
+def run(copy_method, srcs, dst_dir, rounds):
+    """Returns the best throughput (MB/s) of the rounds"""
+    copier = filecopy.FileCopier(copy_method=copy_method)
+    total = sum(os.path.getsize(src) for src in srcs)
+    best = 0
+    for _ in range(rounds):
+        start_time = time.monotonic()
+        for src in srcs:
+            dst = os.path.join(dst_dir, os.path.basename(src))
+            copier.copy(src, dst)
+            with open(dst, "rb") as f:
+                os.fsync(f.fileno())
+        elapsed = time.monotonic() - start_time
+        best = max(best, total / elapsed / 1024 / 1024)
+        for src in srcs:
+            os.remove(os.path.join(dst_dir, os.path.basename(src)))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dst", help="destination folder")
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--size", type=int, default=40, help="file size (MB)")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    src_dir = tempfile.mkdtemp(prefix="goingrunning_bench_")
+    dst_dir = args.dst or tempfile.mkdtemp(prefix="goingrunning_bench_")
+    try:
+        srcs = create_sources(src_dir, args.files, args.size)
+        print("{0} files of {1}MB -> {2}".format(args.files, args.size,
+                                                  dst_dir))
+        results = {}
+        for copy_method in [filecopy.COPY_METHOD_SIMPLE,
+                            filecopy.COPY_METHOD_STREAM,
+                            filecopy.COPY_METHOD_KERNEL]:
+            results[copy_method] = run(copy_method, srcs, dst_dir,
+                                       args.rounds)
+            print("{0:>8}: {1:8.1f} MB/s".format(copy_method,
+                                                 results[copy_method]))
+
+        baseline = results[filecopy.COPY_METHOD_STREAM]
+        if baseline:
+            print("kernel vs stream: {0:+.1f}%".format(
+                (results[filecopy.COPY_METHOD_KERNEL] / baseline - 1) * 100))
+    finally:
+        shutil.rmtree(src_dir, ignore_errors=True)
+        if not args.dst:
+            shutil.rmtree(dst_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
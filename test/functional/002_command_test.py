@@ -4,6 +4,9 @@
 #  Created: 3/17/20, 10:44 PM
 #  License: See LICENSE.txt
 #
+from unittest import mock
+
+from beetsplug.goingrunning import libquery
 
 from test.helper import FunctionalTestHelper, PLUGIN_NAME, \
     PACKAGE_TITLE, PACKAGE_NAME, PLUGIN_VERSION, \
@@ -62,6 +65,25 @@ class CommandTest(FunctionalTestHelper):
         logged = self.run_with_log_capture(PLUGIN_NAME, training_name, "-c")
         self.assertIn("Number of songs available: {}".format(0), logged)
 
+    def test_training_song_count_slow_query(self):
+        self.setup_beets({"config_file": b"default.yml"})
+        training_name = "training-1"
+        self.ensure_training_target_path(training_name)
+        self.add_multiple_items_to_library(count=10, bpm=[120, 180],
+                                           mood="happy")
+
+        # A query on a (text) flexible attribute is matched in Python: the
+        # songs are loaded once and counted instead of being counted by the
+        # database
+        with mock.patch.object(libquery, "count_items") as count_items, \
+                mock.patch.object(libquery, "get_items",
+                                  wraps=libquery.get_items) as get_items:
+            logged = self.run_with_log_capture(PLUGIN_NAME, training_name,
+                                               "mood:happy", "--count")
+        self.assertIn("Number of songs available: {}".format(10), logged)
+        count_items.assert_not_called()
+        self.assertEqual(1, get_items.call_count)
+
     def test_training_no_songs(self):
         self.setup_beets({"config_file": b"default.yml"})
         training_name = "training-1"
@@ -72,6 +94,16 @@ class CommandTest(FunctionalTestHelper):
             "No songs in your library match this training!",
             logged)
 
+    def test_training_resume_nothing_to_resume(self):
+        self.setup_beets({"config_file": b"default.yml"})
+        training_name = "training-1"
+        self.ensure_training_target_path(training_name)
+        logged = self.run_with_log_capture(PLUGIN_NAME, training_name,
+                                           "--resume")
+        self.assertIn(
+            "There is no interrupted export to resume for this training!",
+            logged)
+
     def test_training_target_not_set(self):
         self.setup_beets({"config_file": b"default.yml"})
         self.add_single_item_to_library()
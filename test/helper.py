@@ -237,7 +237,7 @@ class BaseTestHelper(TestCase, Assertions):
         prevent duplicates.
         """
         item_count = self._get_item_count()
-        _values = self.default_item_values
+        _values = dict(self.default_item_values)
         _values['title'] = _values['title'].format(item_count)
         _values['track'] = item_count
         _values.update(values)
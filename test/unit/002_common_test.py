@@ -4,12 +4,15 @@
 #  Created: 3/17/20, 3:28 PM
 #  License: See LICENSE.txt
 #
+import multiprocessing
 import os
+from concurrent.futures import ThreadPoolExecutor
 from logging import Logger
 
-from beets import util
-from beets.dbcore import types
-from beetsplug.goingrunning import common, GoingRunningPlugin
+from beets import config, library, util
+from beets.dbcore import query, types
+from beets.dbcore.queryparse import construct_query_part
+from beetsplug.goingrunning import common, libquery, GoingRunningPlugin
 
 from test.helper import UnitTestHelper, get_plugin_configuration, \
     capture_log
@@ -39,10 +42,35 @@ class CommonTest(UnitTestHelper):
         self.assertListEqual(common.KNOWN_NUMERIC_FLEX_ATTRIBUTES,
                              list(res.keys()))
 
-        exp_types = [types.Float for n in
+        # Floats that are queried in SQL
+        exp_types = [libquery.FlexFloat for n in
                      range(0, len(common.KNOWN_NUMERIC_FLEX_ATTRIBUTES))]
         res_types = [type(v) for v in res.values()]
         self.assertListEqual(exp_types, res_types)
+        for value in res.values():
+            self.assertIsInstance(value, types.Float)
+
+    def test_get_query_model(self):
+        original_types = dict(library.Item._types)
+        model = common.get_query_model()
+        self.assertTrue(issubclass(model, library.Item))
+        self.assertIsInstance(model._type("mood_happy"), libquery.FlexFloat)
+        self.assertDictEqual(original_types, library.Item._types)
+
+        # Queries can be parsed in parallel threads
+        def parse(pattern):
+            return construct_query_part(common.get_query_model(), {},
+                                        "mood_happy:{}".format(pattern))
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            queries = list(executor.map(parse, ["0.{}..".format(i)
+                                                for i in range(8)]))
+        for i, parsed_query in enumerate(queries):
+            self.assertIsInstance(parsed_query, libquery.FlexNumericQuery)
+            self.assertEqual(i / 10, parsed_query.rangemin)
+        self.assertIsInstance(
+            construct_query_part(library.Item, {}, "mood_happy:0.5.."),
+            query.SubstringQuery)
 
     def test_get_human_readable_time(self):
         self.assertEqual("0:00:00", common.get_human_readable_time(0),
@@ -54,6 +82,27 @@ class CommonTest(UnitTestHelper):
         self.assertEqual("3:33:33", common.get_human_readable_time(12813),
                          "Bad time format!")
 
+    def test_get_human_readable_size(self):
+        self.assertEqual("0.0B", common.get_human_readable_size(0))
+        self.assertEqual("512.0B", common.get_human_readable_size(512))
+        self.assertEqual("1.5KB", common.get_human_readable_size(1536))
+        self.assertEqual("3.0MB",
+                         common.get_human_readable_size(3 * 1024 * 1024))
+        self.assertEqual("2.0TB",
+                         common.get_human_readable_size(2 * 1024 ** 4))
+
+    def test_get_size_in_bytes(self):
+        self.assertIsNone(common.get_size_in_bytes(None))
+        self.assertIsNone(common.get_size_in_bytes(""))
+        self.assertIsNone(common.get_size_in_bytes("lots"))
+        self.assertIsNone(common.get_size_in_bytes(0))
+        self.assertEqual(1000, common.get_size_in_bytes(1000))
+        self.assertEqual(1000, common.get_size_in_bytes("1000"))
+        self.assertEqual(512 * 1024, common.get_size_in_bytes("512KB"))
+        self.assertEqual(int(1.5 * 1024 ** 3),
+                         common.get_size_in_bytes("1.5 GB"))
+        self.assertEqual(2 * 1024 ** 2, common.get_size_in_bytes("2mb"))
+
     def test_get_normalized_query_element(self):
         # Test simple value pair(string)
         key = "genre"
@@ -422,6 +471,67 @@ class CommonTest(UnitTestHelper):
         expected = 4
         self.assertEqual(expected, item1.get("play_count"))
 
+    def test_increment_play_count_on_items(self):
+        config.add({"timeout": 5.0})
+        lib = library.Library(os.path.join(self.create_temp_dir(),
+                                           "library.db"))
+        item1 = library.Item(title="song 1", play_count=3)
+        item2 = library.Item(title="song 2")
+        lib.add(item1)
+        lib.add(item2)
+        item3 = self.create_item(play_count=1)
+        common.increment_play_count_on_items([item1, item2, item2, item3],
+                                             write=False)
+        self.assertEqual(4, item1.get("play_count"))
+        self.assertEqual(2, item2.get("play_count"))
+        self.assertEqual(2, item3.get("play_count"))
+        self.assertFalse(item1._dirty)
+
+        # The counts are stored in the library
+        self.assertEqual(4, int(lib.get_item(item1.id)["play_count"]))
+        self.assertEqual(2, int(lib.get_item(item2.id)["play_count"]))
+
+    def test_get_file_content_key(self):
+        tmpdir = self.create_temp_dir()
+        paths = []
+        for i, content in enumerate([b"x" * 10, b"x" * 10, b"x" * 11,
+                                     b"x" * 200000]):
+            path = os.path.join(tmpdir, "file_{}".format(i))
+            with open(path, "wb") as f:
+                f.write(content)
+            paths.append(path)
+
+        keys = [common.get_file_content_key(p) for p in paths]
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
+        self.assertNotEqual(keys[2], keys[3])
+        self.assertEqual(40, len(keys[3]))
+
+        # Only the range is part of the key
+        path = os.path.join(tmpdir, "file_range")
+        with open(path, "wb") as f:
+            f.write(b"head" + b"x" * 200000 + b"tail")
+        self.assertEqual(keys[3], common.get_file_content_key(
+            path, start=4, end=200004))
+
+    def test_get_file_sizes(self):
+        tmpdir = self.create_temp_dir()
+        paths = []
+        for i in range(150):
+            path = os.path.join(tmpdir, "file_{}".format(i))
+            with open(path, "wb") as f:
+                f.write(b"x" * i)
+            paths.append(path)
+        missing = os.path.join(tmpdir, "missing")
+
+        sizes = common.get_file_sizes(paths + [missing], batch_size=32)
+        self.assertEqual(151, len(sizes))
+        for i, path in enumerate(paths):
+            self.assertEqual(i, sizes[path])
+        self.assertIsNone(sizes[missing])
+
+        self.assertEqual(sum(range(150)), common.get_folder_size(tmpdir))
+
     def test_get_class_instance(self):
         module_name = 'beetsplug.goingrunning'
         class_name = 'GoingRunningPlugin'
@@ -436,3 +546,43 @@ class CommonTest(UnitTestHelper):
             module_name = 'beetsplug.goingrunning'
             class_name = 'GoingToSleepPlugin'
             common.get_class_instance(module_name, class_name)
+
+    def test_json_store(self):
+        path = os.path.join(self.create_temp_dir(), "store.json")
+        store = common.JsonStore(path, "entries")
+        self.assertDictEqual({}, store.load())
+
+        with store.locked():
+            store.save({"a": 1})
+        self.assertDictEqual({"a": 1}, common.JsonStore(path, "entries")
+                             .load())
+        # A store of another kind is not read
+        self.assertDictEqual({}, common.JsonStore(path, "other").load())
+
+        with open(path, "w") as f:
+            f.write("{broken")
+        self.assertDictEqual({}, store.load())
+
+    def test_json_store_shared_by_processes(self):
+        path = os.path.join(self.create_temp_dir(), "store.json")
+        processes = [multiprocessing.Process(
+            target=_add_to_json_store, args=(path, range(i * 20,
+                                                         (i + 1) * 20)))
+            for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        # No process lost the entries added by the others
+        self.assertListEqual(list(range(80)), sorted(
+            int(key) for key in common.JsonStore(path, "entries").load()))
+
+
+def _add_to_json_store(path, keys):
+    store = common.JsonStore(path, "entries")
+    for key in keys:
+        with store.locked():
+            entries = store.load()
+            entries[str(key)] = True
+            store.save(entries)
@@ -171,3 +171,25 @@ class CommandTest(UnitTestHelper):
             "])"
         )
         self.assertEqual(expected, str(query))
+
+    def test_training_query_cache(self):
+        plg_cfg: Subview = self.config["goingrunning"]
+        training: Subview = plg_cfg["trainings"]["q-test-5"]
+        cmd = GoingRunningCommand(plg_cfg)
+        cache = command.libquery.get_query_cache()
+        cache.clear()
+
+        parsed_query = cmd._get_training_query(training)
+        self.assertIs(parsed_query, cmd._get_training_query(training))
+
+        # Command line terms and flavour changes make a new query
+        cmd.query = ["year:2000.."]
+        with_terms = cmd._get_training_query(training)
+        self.assertIsNot(parsed_query, with_terms)
+        self.assertIn("year", str(with_terms))
+
+        plg_cfg["flavours"]["funkymonkey"].set({"genre": ["Soul"]})
+        changed = cmd._get_training_query(training)
+        self.assertIsNot(with_terms, changed)
+        self.assertIn("Soul", str(changed))
+        self.assertNotIn("Disco", str(changed))
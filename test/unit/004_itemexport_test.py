@@ -0,0 +1,709 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+import json
+import os
+import tarfile
+from collections import namedtuple
+from pathlib import Path
+from unittest import mock
+
+from beets import config, library, util
+from beetsplug.goingrunning import archiveexport
+from beetsplug.goingrunning import export
+from beetsplug.goingrunning import itemexport
+from beetsplug.goingrunning import merge
+from beetsplug.goingrunning import mergedexport
+
+from test.helper import UnitTestHelper, get_plugin_configuration
+
+
+class ItemExportTest(UnitTestHelper):
+    """Test methods in the beetsplug.goingrunning.itemexport module
+    """
+
+    def _get_training(self, target_cfg=None, training_cfg=None):
+        device_root = self.create_temp_dir()
+        os.mkdir(os.path.join(device_root, "music"))
+
+        target = {
+            "device_root": device_root,
+            "device_path": "music",
+            "clean_target": "training",
+            "generate_playlist": True,
+        }
+        target.update(target_cfg or {})
+        # None leaves the attribute unset
+        target = {key: value for key, value in target.items()
+                  if value is not None}
+
+        training = {
+            "target": "MPD1",
+            "increment_play_count": False,
+        }
+        training.update(training_cfg or {})
+
+        cfg = {
+            "targets": {"MPD1": target},
+            "trainings": {"T1": training},
+        }
+        config = get_plugin_configuration(cfg)
+
+        return config["trainings"]["T1"]
+
+    def _get_items(self, count=3):
+        fixture = os.path.join(self._test_fixture_dir, b"song.mp3")
+        return [self.create_item(path=fixture) for i in range(count)]
+
+    def _get_items_with_content(self, contents, extension=".mp3"):
+        source_dir = self.create_temp_dir()
+        items = []
+        for i, content in enumerate(contents):
+            path = os.path.join(source_dir, "song_{0}{1}".format(i,
+                                                                 extension))
+            with open(path, "wb") as f:
+                f.write(content)
+            items.append(self.create_item(path=util.bytestring_path(path)))
+        return items
+
+    @staticmethod
+    def _get_export_dir(exporter: itemexport.ItemExport):
+        dst_path = itemexport.common.get_destination_path_for_training(
+            exporter.training)
+        return os.path.join(dst_path, exporter._get_cleaned_training_name())
+
+    def test_copy_items(self):
+        training = self._get_training(target_cfg={"copy_workers": 3})
+        items = self._get_items(5)
+        exporter = itemexport.ItemExport(training, items)
+        exporter.export()
+
+        export_dir = self._get_export_dir(exporter)
+        files = sorted(f for f in os.listdir(export_dir) if f.endswith(".mp3"))
+        self.assertEqual(5, len(files))
+
+        # The exported file names keep the order of the items
+        for i, item in enumerate(items):
+            exportpath = util.displayable_path(item.get("exportpath"))
+            self.assertEqual(files[i], exportpath)
+            self.assertTrue(exportpath.startswith(str(i).zfill(6)))
+
+    def test_export_report(self):
+        training = self._get_training(target_cfg={"export_report": True})
+        items = self._get_items(3)
+        exporter = itemexport.ItemExport(training, items)
+        exporter.export()
+
+        export_dir = self._get_export_dir(exporter)
+        with open(os.path.join(export_dir, "T1.report.json"), "r") as f:
+            report = json.load(f)
+
+        self.assertEqual("MPD1", report["target"])
+        self.assertEqual(3, report["files"])
+        self.assertEqual(3 * os.path.getsize(items[0].get("path")),
+                         report["bytes"])
+        self.assertListEqual(["capacity", "clean", "plan", "copy",
+                              "playlist", "tags"],
+                             list(report["stages"].keys()))
+        self.assertEqual(3, sum(report["latency"]["histogram"].values()))
+
+    def test_export_archive(self):
+        training = self._get_training(target_cfg={"export_mode": "archive"})
+        contents = [b"a" * 100, b"b" * 20000, b"c" * 300]
+        items = self._get_items_with_content(contents)
+        exporter = export.create_exporter(training, items)
+        self.assertIsInstance(exporter, archiveexport.ArchiveExport)
+        self.assertTrue(exporter.export())
+
+        archive_path = exporter._get_archive_path()
+        self.assertEqual("T1.tar", os.path.basename(archive_path))
+        self.assertFalse(os.path.exists("{}.part".format(archive_path)))
+
+        training_dir = exporter._get_cleaned_training_name()
+        with tarfile.open(archive_path, "r") as tar:
+            names = tar.getnames()
+            self.assertEqual(4, len(names))
+            for name, content in zip(names, contents):
+                self.assertTrue(name.startswith(training_dir + "/"))
+                self.assertEqual(content, tar.extractfile(name).read())
+
+            # The playlist refers to the songs inside the archive folder
+            self.assertEqual("{}/T1.m3u".format(training_dir), names[3])
+            playlist = tar.extractfile(names[3]).read().decode("utf-8")
+            songs = [os.path.basename(n) for n in names[0:3]]
+            self.assertListEqual(songs, playlist.splitlines()[1:])
+
+    def test_export_archive_failure(self):
+        training = self._get_training(
+            target_cfg={"export_mode": "archive"},
+            training_cfg={"increment_play_count": True})
+        items = self._get_items_with_content([b"a" * 100, b"b" * 200,
+                                              b"c" * 300])
+        exporter = export.create_exporter(training, items)
+        with mock.patch.object(archiveexport.ArchiveExport,
+                               "_add_file_to_archive",
+                               side_effect=[100, 200, OSError("full")]), \
+                mock.patch.object(itemexport.common,
+                                  "increment_play_count_on_items") \
+                as increment:
+            with self.assertRaises(OSError):
+                exporter.export()
+
+        # Nothing reached the target: no play count is incremented
+        archive_path = exporter._get_archive_path()
+        self.assertFalse(os.path.exists(archive_path))
+        self.assertFalse(os.path.exists("{}.part".format(archive_path)))
+        increment.assert_not_called()
+        self.assertListEqual([], exporter._play_counts)
+
+    def test_export_archive_to_local_file(self):
+        archive_dir = self.create_temp_dir()
+        training = self._get_training(target_cfg={
+            "export_mode": "archive",
+            "archive_path": archive_dir,
+            "export_report": True,
+        })
+        items = self._get_items_with_content([b"a" * 100])
+        exporter = export.create_exporter(training, items)
+        self.assertTrue(exporter.export())
+
+        self.assertListEqual(["T1.report.json", "T1.tar"],
+                             sorted(os.listdir(archive_dir)))
+        dst_path = exporter._get_destination_path()
+        self.assertListEqual([], os.listdir(dst_path))
+
+    def test_export_merged(self):
+        training = self._get_training(target_cfg={"export_mode": "merged"})
+        items = self._get_items(3)
+        exporter = export.create_exporter(training, items)
+        self.assertIsInstance(exporter, mergedexport.MergedExport)
+        self.assertTrue(exporter.export())
+
+        export_dir = self._get_export_dir(exporter)
+        self.assertListEqual(["T1.m3u", "T1.mp3"], sorted(os.listdir(
+            export_dir)))
+
+        start, end = merge.get_mp3_audio_range(
+            items[0].get("path"))
+        self.assertEqual(3 * (end - start), os.path.getsize(
+            os.path.join(export_dir, "T1.mp3")))
+        with open(os.path.join(export_dir, "T1.m3u"), "r") as f:
+            self.assertListEqual(["T1.mp3"], f.read().splitlines()[1:])
+
+    def test_verify_copied_files(self):
+        training = self._get_training(target_cfg={"verify": True})
+        items = self._get_items_with_content([b"a" * 1000, b"b" * 2000])
+        exporter = itemexport.ItemExport(training, items)
+
+        # The first copy of the second song gets corrupted
+        original_export_file = itemexport.ItemExport._export_file
+        corrupted = []
+
+        def export_file(copier, job, src_future=None):
+            answer = original_export_file(copier, job, src_future)
+            if job["src"].endswith("song_1.mp3") and not corrupted:
+                corrupted.append(job["dst"])
+                with open(job["dst"], "r+b") as f:
+                    f.write(b"x")
+            return answer
+
+        with mock.patch.object(itemexport.ItemExport, "_export_file",
+                               staticmethod(export_file)):
+            self.assertTrue(exporter.export())
+
+        self.assertEqual(1, len(corrupted))
+        with open(corrupted[0], "rb") as f:
+            self.assertEqual(b"b" * 2000, f.read())
+        self.assertIn("verify", exporter.stats.stages)
+
+    def test_copy_items_dry_run(self):
+        training = self._get_training()
+        items = self._get_items(2)
+        exporter = itemexport.ItemExport(training, items, dry_run=True)
+        self.assertTrue(exporter.prepare())
+        exporter.copy()
+
+        export_dir = self._get_export_dir(exporter)
+        self.assertListEqual([], os.listdir(export_dir))
+        self.assertIsNone(items[0].get("exportpath"))
+
+    def test_sync_items(self):
+        training = self._get_training(target_cfg={"sync": True})
+        items = self._get_items_with_content([b"a" * 100, b"b" * 200,
+                                              b"c" * 300])
+
+        exporter = itemexport.ItemExport(training, items[0:2])
+        exporter.export()
+        export_dir = self._get_export_dir(exporter)
+        b_name = util.displayable_path(items[1].get("exportpath"))
+        self.assertTrue(b_name.startswith("000001_"))
+
+        # Second run: "a" is dropped, "b" moves up and "c" is new
+        b_mtime = os.path.getmtime(os.path.join(export_dir, b_name))
+        exporter = itemexport.ItemExport(training, items[1:3])
+        exporter.export()
+
+        files = sorted(f for f in os.listdir(export_dir) if f.endswith(".mp3"))
+        self.assertEqual(2, len(files))
+        self.assertEqual(files[0],
+                         util.displayable_path(items[1].get("exportpath")))
+        self.assertEqual(files[1],
+                         util.displayable_path(items[2].get("exportpath")))
+        self.assertEqual(b_name[6:], files[0][6:])
+        self.assertEqual(b_mtime,
+                         os.path.getmtime(os.path.join(export_dir, files[0])))
+        with open(os.path.join(export_dir, files[1]), "rb") as f:
+            self.assertEqual(b"c" * 300, f.read())
+
+        manifest = exporter._read_manifest(Path(export_dir))
+        self.assertListEqual(files, sorted(manifest.keys()))
+
+    def test_sync_items_play_count(self):
+        training = self._get_training(target_cfg={"sync": True}, training_cfg={
+            "increment_play_count": True})
+        # MPEG 1 Layer III frames (417 bytes each) after an ID3v2 tag
+        frame = b"\xff\xfb\x90\x00"
+        contents = [b"ID3\x04\x00\x00\x00\x00\x00\x14" + b"\x00" * 20 +
+                    (frame + bytes([i + 1]) * 413) * 3 for i in range(2)]
+        items = self._get_items_with_content(contents)
+        config.add({"timeout": 5.0, "id3v23": False})
+        lib = library.Library(os.path.join(self.create_temp_dir(),
+                                           "library.db"))
+        for item in items:
+            lib.add(item)
+
+        exporter = itemexport.ItemExport(training, items)
+        exporter.export()
+        export_dir = self._get_export_dir(exporter)
+        files = sorted(f for f in os.listdir(export_dir) if f.endswith(".mp3"))
+        mtimes = [os.path.getmtime(os.path.join(export_dir, f))
+                  for f in files]
+
+        # The tags (with the play count) written after the export changed
+        # the songs in the library
+        for item, content in zip(items, contents):
+            with open(util.displayable_path(item.get("path")), "rb") as f:
+                self.assertNotEqual(content, f.read())
+
+        exporter = itemexport.ItemExport(training, items)
+        exporter.export()
+        self.assertListEqual(files, sorted(
+            f for f in os.listdir(export_dir) if f.endswith(".mp3")))
+        self.assertListEqual(mtimes, [
+            os.path.getmtime(os.path.join(export_dir, f)) for f in files])
+        self.assertEqual(0, exporter.stats.files)
+        self.assertEqual(2, int(lib.get_item(items[0].id)["play_count"]))
+
+    def test_sync_items_flac_tags(self):
+        training = self._get_training(target_cfg={"sync": True})
+        audio = [bytes([i]) * 3000 for i in range(2)]
+        items = self._get_items_with_content(
+            [b"fLaC" + b"\x84\x00\x00\x04" + b"tag1" + a for a in audio],
+            ".flac")
+
+        exporter = itemexport.ItemExport(training, items)
+        exporter.export()
+        export_dir = self._get_export_dir(exporter)
+        files = sorted(os.listdir(export_dir))
+
+        # New tags (a longer comment block) keep the songs on the device
+        for item, a in zip(items, audio):
+            with open(util.syspath(item.path), "wb") as f:
+                f.write(b"fLaC" + b"\x84\x00\x00\x08" + b"tag1tag2" + a)
+        exporter = itemexport.ItemExport(training, items)
+        exporter.export()
+        self.assertListEqual(files, sorted(os.listdir(export_dir)))
+        self.assertEqual(0, exporter.stats.files)
+
+    def test_transcode_items(self):
+        # `cp` stands in for the encoder
+        training = self._get_training(target_cfg={
+            "transcode": {"format": "ogg", "command": "cp $source $dest"}
+        })
+        items = self._get_items(3)
+        exporter = itemexport.ItemExport(training, items)
+        exporter.export()
+
+        export_dir = self._get_export_dir(exporter)
+        files = sorted(f for f in os.listdir(export_dir) if f.endswith(".ogg"))
+        self.assertEqual(3, len(files))
+        for i, item in enumerate(items):
+            self.assertEqual(files[i],
+                             util.displayable_path(item.get("exportpath")))
+
+        # The playlist points to the transcoded files
+        playlist = os.path.join(export_dir, "T1.m3u")
+        with open(playlist, "r") as f:
+            lines = f.read().splitlines()
+        self.assertListEqual(files, lines[1:])
+
+    def test_transcode_items_cached(self):
+        training = self._get_training(target_cfg={
+            "transcode": {"format": "ogg", "command": "cp $source $dest"}
+        })
+        items = self._get_items_with_content([b"a" * 100, b"b" * 200])
+        itemexport.ItemExport(training, items).export()
+
+        cache_dir = os.path.join(self.beetsdir.decode(), "goingrunning",
+                                 "transcode_cache")
+        self.assertEqual(2, len(os.listdir(cache_dir)))
+
+        # The second export uses the cached files instead of encoding
+        for name in os.listdir(cache_dir):
+            with open(os.path.join(cache_dir, name), "wb") as f:
+                f.write(b"cached")
+
+        exporter = itemexport.ItemExport(training, items)
+        exporter.export()
+        export_dir = self._get_export_dir(exporter)
+        files = sorted(f for f in os.listdir(export_dir) if f.endswith(".ogg"))
+        self.assertEqual(2, len(files))
+        for name in files:
+            with open(os.path.join(export_dir, name), "rb") as f:
+                self.assertEqual(b"cached", f.read())
+
+    def test_transcode_missing_encoder(self):
+        training = self._get_training(target_cfg={
+            "transcode": {"format": "ogg",
+                          "command": "no-such-encoder $source $dest"}
+        })
+        exporter = itemexport.ItemExport(training, [])
+        self.assertIsNone(exporter._get_transcode_profile())
+
+    def test_resume_from_journal(self):
+        training = self._get_training()
+        items = self._get_items_with_content([b"a" * 100, b"b" * 200,
+                                              b"c" * 300])
+        for i, item in enumerate(items):
+            item.id = i + 1
+
+        # Simulate an export interrupted after the first file
+        exporter = itemexport.ItemExport(training, items)
+        self.assertTrue(exporter.prepare())
+        exporter.copy()
+        journal_path = exporter._get_journal_path()
+        names = [util.displayable_path(item.get("exportpath"))
+                 for item in items]
+        with open(journal_path, "r") as f:
+            lines = f.read().splitlines()
+        # The files are journaled in the order they complete
+        copied = [line for line in lines
+                  if json.loads(line).get("filename") == names[0]]
+        with open(journal_path, "w") as f:
+            f.write("\n".join(lines[0:1] + copied) + "\n")
+        exporter.journal.close()
+
+        export_dir = self._get_export_dir(exporter)
+        first_mtime = os.path.getmtime(os.path.join(export_dir, names[0]))
+        os.remove(os.path.join(export_dir, names[1]))
+        with open(os.path.join(export_dir, names[2]), "wb") as f:
+            f.write(b"broken")
+
+        journal = itemexport.ItemExport(training, []).read_journal()
+        self.assertListEqual(names, [e["filename"] for e in journal["plan"]])
+        self.assertListEqual([names[0]], list(journal["copied"].keys()))
+
+        exporter = itemexport.ItemExport(training, items, resume=True)
+        exporter.export()
+
+        files = sorted(f for f in os.listdir(export_dir) if f.endswith(".mp3"))
+        self.assertListEqual(names, files)
+        self.assertEqual(first_mtime,
+                         os.path.getmtime(os.path.join(export_dir, names[0])))
+        with open(os.path.join(export_dir, names[2]), "rb") as f:
+            self.assertEqual(b"c" * 300, f.read())
+
+        # The journal is removed once the export is complete
+        self.assertFalse(os.path.exists(journal_path))
+        self.assertIsNone(itemexport.ItemExport(training, []).read_journal())
+
+    def test_resume_detects_corruption(self):
+        training = self._get_training()
+        content = bytes(range(256)) * 1024
+        items = self._get_items_with_content([content])
+        items[0].id = 1
+
+        # Simulate an export interrupted once the file was copied
+        exporter = itemexport.ItemExport(training, items)
+        self.assertTrue(exporter.prepare())
+        exporter.copy()
+        exporter.journal.close()
+
+        # The middle of the file gets corrupted, its size is the same
+        path = os.path.join(self._get_export_dir(exporter),
+                            util.displayable_path(items[0].get("exportpath")))
+        with open(path, "r+b") as f:
+            f.seek(len(content) // 2)
+            f.write(b"x")
+
+        itemexport.ItemExport(training, items, resume=True).export()
+        with open(path, "rb") as f:
+            self.assertEqual(content, f.read())
+
+    def test_clean_target(self):
+        training = self._get_training(target_cfg={
+            "clean_target": True,
+            "delete_from_device": ["extra.txt"],
+        })
+        dst_path = itemexport.common.get_destination_path_for_training(
+            training)
+        old_dir = os.path.join(dst_path, "old")
+        os.mkdir(old_dir)
+        with open(os.path.join(old_dir, "old.mp3"), "wb") as f:
+            f.write(b"o" * 1000)
+        device_root = itemexport.common.get_target_attribute_for_training(
+            training, "device_root")
+        extra_file = os.path.join(device_root, "extra.txt")
+        with open(extra_file, "w") as f:
+            f.write("extra")
+
+        # A dry run deletes nothing
+        exporter = itemexport.ItemExport(training, [], dry_run=True)
+        exporter._clean_target()
+        self.assertListEqual(["old"], os.listdir(dst_path))
+        self.assertTrue(os.path.isfile(extra_file))
+
+        # The old folder is moved out of the way and deleted in the background
+        exporter = itemexport.ItemExport(training, [])
+        exporter._clean_target()
+        self.assertFalse(os.path.exists(old_dir))
+        exporter._wait_for_cleaning()
+        self.assertListEqual([], os.listdir(dst_path))
+        self.assertFalse(os.path.exists(extra_file))
+
+    def test_file_copier_limits(self):
+        training = self._get_training(target_cfg={
+            "max_read_mbps": 20,
+            "max_write_mbps": 5.5,
+            "io_nice": True,
+        })
+        copier = itemexport.ItemExport(training, [])._get_file_copier()
+        self.assertEqual(20 * 1024 * 1024, copier.read_limiter.rate)
+        self.assertEqual(5.5 * 1024 * 1024, copier.write_limiter.rate)
+        self.assertEqual(19, copier.io_nice)
+
+        copier = itemexport.ItemExport(self._get_training(), [])\
+            ._get_file_copier()
+        self.assertIsNone(copier.read_limiter)
+        self.assertIsNone(copier.write_limiter)
+        self.assertEqual(0, copier.io_nice)
+
+    def test_dry_run_plan(self):
+        training = self._get_training()
+        items = self._get_items_with_content([b"a" * 1000, b"b" * 3000])
+        for i, item in enumerate(items):
+            item.id = i + 1
+
+        # The first export only measures the speed of the target
+        itemexport.ItemExport(training, items).export()
+        exporter = itemexport.ItemExport(training, items, dry_run=True)
+        key = exporter._get_throughput_key()
+        self.assertEqual(1, len(itemexport.estimate.get_throughput_profiles()
+                                .get_samples(key)))
+
+        plan_path = os.path.join(self.create_temp_dir(), "plan.json")
+        export.generate_output(training, items, dry_run=True,
+                               plan_path=plan_path)
+        with open(plan_path, "r") as f:
+            plan = json.load(f)
+
+        self.assertEqual(4000, plan["bytes"])
+        target_plan = plan["targets"][0]
+        self.assertEqual("MPD1", target_plan["target"])
+        self.assertEqual(2, target_plan["files"])
+        self.assertIsNotNone(target_plan["estimated_seconds"])
+        self.assertListEqual([1, 2], [i["id"] for i in target_plan["items"]])
+        self.assertListEqual([1000, 3000],
+                             [i["bytes"] for i in target_plan["items"]])
+
+    def _mock_free_space(self, free):
+        usage = namedtuple("usage", ["total", "used", "free"])
+        return mock.patch.object(itemexport.shutil, "disk_usage",
+                                 return_value=usage(free, 0, free))
+
+    def test_capacity_abort(self):
+        training = self._get_training(target_cfg={"clean_target": True})
+        items = self._get_items_with_content([b"a" * 100000] * 3)
+        exporter = itemexport.ItemExport(training, items)
+        dst_path = itemexport.common.get_destination_path_for_training(
+            training)
+        old_file = os.path.join(dst_path, "old.mp3")
+        with open(old_file, "wb") as f:
+            f.write(b"o" * 1000)
+
+        with self._mock_free_space(1024 * 1024):
+            self.assertFalse(exporter.export())
+
+        # Nothing was deleted or copied
+        self.assertListEqual(["old.mp3"], os.listdir(dst_path))
+
+        # The file that the cleaning deletes makes it fit
+        with open(old_file, "wb") as f:
+            f.write(b"o" * 500000)
+        with self._mock_free_space(1024 * 1024):
+            self.assertTrue(exporter.export())
+        self.assertFalse(os.path.exists(old_file))
+
+    def test_capacity_clean_target_unset(self):
+        # Without `clean_target` the whole target is cleaned
+        training = self._get_training(target_cfg={"clean_target": None})
+        items = self._get_items_with_content([b"a" * 100000] * 3)
+        exporter = itemexport.ItemExport(training, items)
+        dst_path = itemexport.common.get_destination_path_for_training(
+            training)
+        old_file = os.path.join(dst_path, "old.mp3")
+        with open(old_file, "wb") as f:
+            f.write(b"o" * 500000)
+
+        self.assertEqual(500000, exporter._get_bytes_freed_by_cleaning(
+            Path(dst_path)))
+        with self._mock_free_space(1024 * 1024):
+            self.assertTrue(exporter.export())
+        self.assertTrue(exporter._clean_first)
+        self.assertFalse(os.path.exists(old_file))
+
+    def test_capacity_shrink(self):
+        training = self._get_training(
+            target_cfg={"on_insufficient_space": "shrink"})
+        items = self._get_items_with_content([b"a" * 100000, b"b" * 100000,
+                                              b"c" * 100000])
+        exporter = itemexport.ItemExport(training, items)
+        per_item = 100000 + exporter._file_overhead_
+        free = exporter._space_reserve_ + 2 * per_item + 1000
+
+        with self._mock_free_space(free):
+            self.assertTrue(exporter.export())
+
+        self.assertEqual(2, len(exporter.items))
+        self.assertIsNone(items[2].get("exportpath"))
+        export_dir = self._get_export_dir(exporter)
+        files = [f for f in os.listdir(export_dir) if f.endswith(".mp3")]
+        self.assertEqual(2, len(files))
+
+    def _get_multi_target_training(self, count=2, target_cfgs=None):
+        targets = {}
+        target_cfgs = target_cfgs or [{}] * count
+        for i in range(count):
+            device_root = self.create_temp_dir()
+            os.mkdir(os.path.join(device_root, "music"))
+            targets["MPD{}".format(i + 1)] = {
+                "device_root": device_root,
+                "device_path": "music",
+                "clean_target": "training",
+                "generate_playlist": True,
+            }
+            targets["MPD{}".format(i + 1)].update(target_cfgs[i])
+
+        cfg = {
+            "targets": targets,
+            "trainings": {"T1": {
+                "target": list(targets.keys()),
+                "increment_play_count": True,
+            }},
+        }
+        config = get_plugin_configuration(cfg)
+
+        return config["trainings"]["T1"]
+
+    def test_export_to_multiple_targets(self):
+        training = self._get_multi_target_training(2)
+        items = self._get_items_with_content([b"a" * 100, b"b" * 200,
+                                              b"c" * 300])
+        for i, item in enumerate(items):
+            item.id = i + 1
+        exporter = export.MultiTargetExport(training, items,
+                                            ["MPD1", "MPD2"])
+        with mock.patch.object(itemexport.common,
+                               "increment_play_count_on_items") as increment:
+            self.assertTrue(exporter.export())
+
+        # The play count is incremented once per song, not once per target
+        self.assertEqual(3, sum(len(call.args[0])
+                                for call in increment.call_args_list))
+
+        for target_exporter in exporter.exporters:
+            export_dir = os.path.join(
+                target_exporter._get_destination_path(),
+                target_exporter._get_cleaned_training_name())
+            files = sorted(f for f in os.listdir(export_dir)
+                           if f.endswith(".mp3"))
+            self.assertEqual(3, len(files))
+            for name, content in zip(files, [b"a" * 100, b"b" * 200,
+                                             b"c" * 300]):
+                with open(os.path.join(export_dir, name), "rb") as f:
+                    self.assertEqual(content, f.read())
+            self.assertTrue(os.path.isfile(os.path.join(export_dir,
+                                                        "T1.m3u")))
+            self.assertIsNone(target_exporter.read_journal())
+
+    def test_export_to_multiple_targets_archive_failure(self):
+        training = self._get_multi_target_training(2, [
+            {"export_mode": "archive"}, {"export_mode": "archive"}])
+        items = self._get_items_with_content([b"a" * 100, b"b" * 200])
+        for i, item in enumerate(items):
+            item.id = i + 1
+        exporter = export.MultiTargetExport(training, items,
+                                            ["MPD1", "MPD2"])
+        # The first archive breaks on its second song, the second one works
+        with mock.patch.object(archiveexport.ArchiveExport,
+                               "_add_file_to_archive",
+                               side_effect=[100, OSError("full"), 100,
+                                            200]), \
+                mock.patch.object(itemexport.common,
+                                  "increment_play_count_on_items") \
+                as increment:
+            self.assertTrue(exporter.export())
+
+        self.assertIsNotNone(exporter.exporters[0].failed)
+        self.assertFalse(os.path.exists(
+            exporter.exporters[0]._get_archive_path()))
+        # The songs are counted once, for the archive that was written
+        self.assertEqual(2, sum(len(call.args[0])
+                                for call in increment.call_args_list))
+
+    def test_export_to_multiple_targets_failure(self):
+        training = self._get_multi_target_training(2)
+        items = self._get_items_with_content([b"a" * 100, b"b" * 200])
+        exporter = export.MultiTargetExport(training, items,
+                                            ["MPD1", "MPD2"])
+        failing, working = exporter.exporters
+
+        original_plan_copy = itemexport.ItemExport._plan_copy
+
+        def plan_copy(target_exporter):
+            jobs = original_plan_copy(target_exporter)
+            if target_exporter is failing:
+                # The training folder disappears from the device
+                for job in jobs:
+                    job["dst"] = Path(str(job["dst"]) + "/missing")
+            return jobs
+
+        with mock.patch.object(itemexport.ItemExport, "_plan_copy",
+                               plan_copy), \
+                mock.patch.object(itemexport.common,
+                                  "increment_play_count_on_items"):
+            self.assertTrue(exporter.export())
+
+        self.assertIsNotNone(failing.failed)
+        self.assertIsNone(working.failed)
+
+        # The failed target keeps its journal so that it can be resumed
+        self.assertIsNotNone(failing.read_journal())
+        self.assertIsNone(working.read_journal())
+        export_dir = os.path.join(working._get_destination_path(),
+                                  working._get_cleaned_training_name())
+        self.assertEqual(2, len([f for f in os.listdir(export_dir)
+                                 if f.endswith(".mp3")]))
+
+    def test_get_copy_workers(self):
+        training = self._get_training()
+        exporter = itemexport.ItemExport(training, [])
+        self.assertEqual(1, exporter._get_copy_workers())
+
+        training = self._get_training(target_cfg={"copy_workers": 4})
+        exporter = itemexport.ItemExport(training, [])
+        self.assertEqual(4, exporter._get_copy_workers())
+
+        training = self._get_training(target_cfg={"copy_workers": 0})
+        exporter = itemexport.ItemExport(training, [])
+        self.assertEqual(1, exporter._get_copy_workers())
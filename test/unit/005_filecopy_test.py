@@ -0,0 +1,303 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+import errno
+import hashlib
+import os
+import threading
+import time
+from unittest.mock import mock_open, patch
+
+from beetsplug.goingrunning import filecopy
+
+from test.helper import UnitTestHelper
+
+
+class FileCopyTest(UnitTestHelper):
+    """Test methods in the beetsplug.goingrunning.filecopy module
+    """
+
+    def _create_file(self, content=b"0123456789" * 1000):
+        path = os.path.join(self.create_temp_dir(), "source.mp3")
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_get_link_method(self):
+        src = self._create_file()
+        dst_dir = self.create_temp_dir()
+        method = filecopy.get_link_method(src, dst_dir)
+        self.assertIn(method, [filecopy.METHOD_REFLINK,
+                               filecopy.METHOD_HARDLINK,
+                               filecopy.METHOD_COPY])
+
+        # The probe is cached and leaves nothing behind
+        self.assertEqual(method, filecopy.get_link_method(src, dst_dir))
+        self.assertListEqual([], os.listdir(dst_dir))
+
+    def test_link_or_copy(self):
+        src = self._create_file()
+        dst = os.path.join(self.create_temp_dir(), "000000_abcdef.mp3")
+        method = filecopy.link_or_copy(src, dst)
+
+        with open(src, "rb") as f1, open(dst, "rb") as f2:
+            self.assertEqual(f1.read(), f2.read())
+        if method == filecopy.METHOD_HARDLINK:
+            self.assertTrue(os.path.samefile(src, dst))
+
+    def test_stream_copy(self):
+        content = os.urandom(100000)
+        src = self._create_file(content)
+        dst = os.path.join(self.create_temp_dir(), "dst.mp3")
+        pool = filecopy.BufferPool(4096, 2)
+        written = filecopy.stream_copy(src, dst, pool)
+        self.assertEqual(len(content), written)
+        with open(dst, "rb") as f:
+            self.assertEqual(content, f.read())
+
+        # All the buffers are back in the pool
+        self.assertEqual(2, pool._free.qsize())
+
+    def test_stream_copy_missing_source(self):
+        src = os.path.join(self.create_temp_dir(), "missing.mp3")
+        dst = os.path.join(self.create_temp_dir(), "dst.mp3")
+        pool = filecopy.BufferPool(4096, 2)
+        with self.assertRaises(OSError):
+            filecopy.stream_copy(src, dst, pool)
+        self.assertEqual(2, pool._free.qsize())
+
+    def test_kernel_copy(self):
+        content = os.urandom(100000)
+        src = self._create_file(content)
+        dst = os.path.join(self.create_temp_dir(), "dst.mp3")
+        copied = filecopy.kernel_copy(src, dst)
+        if copied is None:
+            self.skipTest("Kernel copy is not supported here")
+
+        self.assertEqual(len(content), copied)
+        with open(dst, "rb") as f:
+            self.assertEqual(content, f.read())
+
+    def test_kernel_copy_unsupported(self):
+        src = self._create_file()
+        dst = os.path.join(self.create_temp_dir(), "dst.mp3")
+        error = OSError(errno.EXDEV, "Invalid cross-device link")
+        with patch("os.copy_file_range", side_effect=error, create=True), \
+                patch("os.sendfile", side_effect=error, create=True):
+            self.assertIsNone(filecopy.kernel_copy(src, dst))
+        filecopy._kernel_copy_unsupported.clear()
+
+        # The copier falls back to the stream copy
+        copier = filecopy.FileCopier()
+        with patch("beetsplug.goingrunning.filecopy.kernel_copy",
+                   return_value=None):
+            copier.copy(src, dst)
+        with open(src, "rb") as f1, open(dst, "rb") as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_get_filesystem_type(self):
+        mounts = "\n".join([
+            "/dev/sda1 / ext4 rw 0 0",
+            "/dev/sdb1 /media/My\\040Player vfat rw 0 0",
+            "/dev/sdc1 /media/My\\040Player/sd exfat rw 0 0",
+        ])
+        with patch("builtins.open", mock_open(read_data=mounts)):
+            for path, fs_type in [
+                ("/home/me/music", "ext4"),
+                ("/media/My Player", "vfat"),
+                ("/media/My Player/music", "vfat"),
+                ("/media/My Player/sd/music", "exfat"),
+                ("/media/My Players", "ext4"),
+            ]:
+                with patch("os.path.realpath", return_value=path):
+                    self.assertEqual(fs_type,
+                                     filecopy._find_filesystem_type(path))
+
+        self.assertIsNotNone(
+            filecopy.get_filesystem_type(self.create_temp_dir()))
+
+    def test_preallocate_native_only(self):
+        content = os.urandom(100000)
+        src = self._create_file(content)
+        for fs_type, expected in [("vfat", False), ("exfat", False),
+                                  ("ext4", True), (None, False)]:
+            dst = os.path.join(self.create_temp_dir(), "dst.mp3")
+            with patch("beetsplug.goingrunning.filecopy.get_filesystem_type",
+                       return_value=fs_type), \
+                    patch("os.posix_fallocate", create=True) as fallocate:
+                copied = filecopy.kernel_copy(src, dst)
+            if copied is None:
+                self.skipTest("Kernel copy is not supported here")
+
+            self.assertEqual(expected, fallocate.called)
+            with open(dst, "rb") as f:
+                self.assertEqual(content, f.read())
+
+    def test_rate_limiter(self):
+        limiter = filecopy.RateLimiter(1024 * 1024, burst=64 * 1024)
+        start_time = time.monotonic()
+        # Two threads share the rate: 256KB take at least ~0.2 seconds
+        threads = [threading.Thread(
+            target=lambda: [limiter.consume(32 * 1024) for i in range(4)])
+            for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.18)
+
+    def test_stream_copy_rate_limited(self):
+        content = os.urandom(200 * 1024)
+        src = self._create_file(content)
+        dst = os.path.join(self.create_temp_dir(), "dst.mp3")
+        copier = filecopy.FileCopier(
+            copy_method=filecopy.COPY_METHOD_SIMPLE, buffer_budget=64 * 1024,
+            write_limiter=filecopy.RateLimiter(1024 * 1024,
+                                               burst=32 * 1024))
+        start_time = time.monotonic()
+        self.assertEqual(len(content), copier.copy(src, dst))
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.15)
+        with open(dst, "rb") as f:
+            self.assertEqual(content, f.read())
+
+    def test_lower_io_priority(self):
+        results = []
+
+        def run():
+            if filecopy.lower_io_priority(5):
+                results.append(os.getpriority(os.PRIO_PROCESS,
+                                              threading.get_native_id()))
+                results.append(filecopy.get_io_priority())
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        if not results:
+            self.skipTest("Thread priorities are not supported here")
+        self.assertGreaterEqual(results[0], 5)
+        if results[1] is not None:
+            # The I/O class is set explicitly, not derived from the nice value
+            self.assertTupleEqual((filecopy.IOPRIO_CLASS_BE, 5), results[1])
+
+    def test_get_io_priority_level(self):
+        self.assertEqual(4, filecopy.get_io_priority_level(0))
+        self.assertEqual(6, filecopy.get_io_priority_level(10))
+        self.assertEqual(7, filecopy.get_io_priority_level(19))
+
+    def test_fan_out_copy(self):
+        content = os.urandom(100000)
+        src = self._create_file(content)
+        dsts = [os.path.join(self.create_temp_dir(), "dst.mp3")
+                for i in range(3)]
+        # A destination that cannot be written does not stop the others
+        dsts.append(os.path.join(self.create_temp_dir(), "missing", "x.mp3"))
+        pool = filecopy.BufferPool(4096, 2)
+        results = filecopy.fan_out_copy(src, dsts, pool)
+
+        self.assertListEqual([len(content)] * 3, results[0:3])
+        self.assertIsInstance(results[3], OSError)
+        for dst in dsts[0:3]:
+            with open(dst, "rb") as f:
+                self.assertEqual(content, f.read())
+        self.assertEqual(2, pool._free.qsize())
+
+    def test_file_copier_digest(self):
+        content = os.urandom(100000)
+        src = self._create_file(content)
+        expected = hashlib.sha1(content).hexdigest()
+
+        # Streamed or not, the digest covers the whole content
+        for method in filecopy.COPY_METHODS:
+            for link_files in (False, True):
+                copier = filecopy.FileCopier(copy_method=method,
+                                             link_files=link_files)
+                dst = os.path.join(self.create_temp_dir(), "dst.mp3")
+                digest = hashlib.sha1()
+                self.assertEqual(len(content), copier.copy(src, dst, digest))
+                self.assertEqual(expected, digest.hexdigest())
+
+        digest = hashlib.sha1()
+        dsts = [os.path.join(self.create_temp_dir(), "dst.mp3")
+                for i in range(2)]
+        filecopy.FileCopier().fan_out(src, dsts, digest=digest)
+        self.assertEqual(expected, digest.hexdigest())
+
+    def test_fan_out_copy_missing_source(self):
+        src = os.path.join(self.create_temp_dir(), "missing.mp3")
+        dsts = [os.path.join(self.create_temp_dir(), "dst.mp3")
+                for i in range(2)]
+        pool = filecopy.BufferPool(4096, 2)
+        results = filecopy.fan_out_copy(src, dsts, pool)
+        for dst, result in zip(dsts, results):
+            self.assertIsInstance(result, OSError)
+            self.assertFalse(os.path.exists(dst))
+        self.assertEqual(2, pool._free.qsize())
+
+    def test_file_copier_buffer_budget(self):
+        copier = filecopy.FileCopier(buffer_budget=8 * 1024 * 1024,
+                                     workers=2)
+        self.assertEqual(filecopy.MAX_BUFFER_SIZE, copier.buffer_size)
+        self.assertEqual(4, copier.buffer_count)
+
+        copier = filecopy.FileCopier(buffer_budget=64 * 1024, workers=1)
+        self.assertEqual(32 * 1024, copier.buffer_size)
+        self.assertEqual(2, copier.buffer_count)
+
+        copier = filecopy.FileCopier(copy_method="bogus")
+        self.assertEqual(filecopy.DEFAULT_COPY_METHOD, copier.copy_method)
+
+    def test_copy_over_hardlink_keeps_source(self):
+        content = os.urandom(100000)
+        for link_files in [True, False]:
+            for copy_method in filecopy.COPY_METHODS:
+                src = self._create_file(content)
+                dst = os.path.join(self.create_temp_dir(), "dst.mp3")
+                try:
+                    # Left by an interrupted export with linked files
+                    os.link(src, dst)
+                except OSError:
+                    self.skipTest("Hardlinks are not supported here")
+
+                copier = filecopy.FileCopier(copy_method=copy_method,
+                                             link_files=link_files)
+                copier.copy(src, dst)
+                with open(src, "rb") as f1, open(dst, "rb") as f2:
+                    self.assertEqual(content, f1.read())
+                    self.assertEqual(content, f2.read())
+
+    def test_fan_out_over_hardlink_keeps_source(self):
+        content = os.urandom(100000)
+        src = self._create_file(content)
+        dst_dir = self.create_temp_dir()
+        dsts = [os.path.join(dst_dir, "dst{0}.mp3".format(i))
+                for i in range(2)]
+        try:
+            os.link(src, dsts[0])
+        except OSError:
+            self.skipTest("Hardlinks are not supported here")
+
+        results = filecopy.FileCopier().fan_out(src, dsts)
+        self.assertListEqual([len(content)] * 2, results)
+        with open(src, "rb") as f:
+            self.assertEqual(content, f.read())
+        for dst in dsts:
+            with open(dst, "rb") as f:
+                self.assertEqual(content, f.read())
+
+    def test_link_or_copy_existing_destination(self):
+        src = self._create_file()
+        dst = os.path.join(self.create_temp_dir(), "dst.mp3")
+        with open(dst, "wb") as f:
+            f.write(b"partial")
+
+        filecopy.link_or_copy(src, dst)
+        with open(src, "rb") as f1, open(dst, "rb") as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+        # A destination appearing meanwhile is not a missing link support
+        with patch("os.link", side_effect=FileExistsError(
+                errno.EEXIST, "File exists")), \
+                patch("beetsplug.goingrunning.filecopy.get_link_method",
+                      return_value=filecopy.METHOD_HARDLINK):
+            with self.assertRaises(FileExistsError):
+                filecopy.link_or_copy(src, dst)
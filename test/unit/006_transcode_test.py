@@ -0,0 +1,105 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+import os
+
+from beetsplug.goingrunning import transcode
+
+from test.helper import UnitTestHelper
+
+
+class TranscodeTest(UnitTestHelper):
+    """Test methods in the beetsplug.goingrunning.transcode module
+    """
+
+    def test_get_transcode_profile(self):
+        self.assertIsNone(transcode.get_transcode_profile(None))
+        self.assertIsNone(transcode.get_transcode_profile({"format": "wav1"}))
+
+        profile = transcode.get_transcode_profile("mp3")
+        self.assertEqual("mp3", profile.format)
+        self.assertEqual(transcode.DEFAULT_BITRATE, profile.bitrate)
+        self.assertEqual(".mp3", profile.extension)
+
+        profile = transcode.get_transcode_profile(
+            {"format": "OGG", "bitrate": 128})
+        self.assertEqual("ogg", profile.format)
+        self.assertEqual(128, profile.bitrate)
+        self.assertEqual("ogg@128k", str(profile))
+
+    def test_profile_key(self):
+        p1 = transcode.TranscodeProfile("mp3", 192)
+        p2 = transcode.TranscodeProfile("mp3", 192)
+        p3 = transcode.TranscodeProfile("mp3", 128)
+        self.assertEqual(p1.key, p2.key)
+        self.assertNotEqual(p1.key, p3.key)
+
+    def test_needs_transcoding(self):
+        profile = transcode.TranscodeProfile("mp3")
+        self.assertFalse(profile.needs_transcoding("/music/song.mp3"))
+        self.assertFalse(profile.needs_transcoding("/music/song.MP3"))
+        self.assertTrue(profile.needs_transcoding("/music/song.flac"))
+
+    def test_get_args(self):
+        profile = transcode.TranscodeProfile("mp3", 160)
+        args = profile.get_args("/music/my song.flac", "/tmp/out file.mp3")
+        self.assertEqual("ffmpeg", args[0])
+        self.assertIn("/music/my song.flac", args)
+        self.assertIn("/tmp/out file.mp3", args)
+        self.assertIn("160k", args)
+
+    def test_transcode_cache(self):
+        src_dir = self.create_temp_dir()
+        cache = transcode.TranscodeCache(self.create_temp_dir(), 250)
+        profile = transcode.TranscodeProfile("mp3")
+
+        sources = []
+        for i in range(3):
+            src = os.path.join(src_dir, "song_{}.flac".format(i))
+            with open(src, "wb") as f:
+                f.write(bytes([i]) * 10)
+            sources.append(src)
+
+        self.assertIsNone(cache.lookup(sources[0], profile))
+        self.assertEqual(1, cache.misses)
+
+        for i, src in enumerate(sources):
+            partial = cache.get_partial_path(src, profile)
+            self.assertTrue(partial.endswith(".mp3"))
+            with open(partial, "wb") as f:
+                f.write(b"y" * 100)
+            cached = cache.store(partial, src, profile)
+            os.utime(cached, (1000 + i, 1000 + i))
+
+        # A hit makes the first song the most recently used one
+        self.assertEqual(cache.get_path(sources[0], profile),
+                         cache.lookup(sources[0], profile))
+        self.assertEqual(1, cache.hits)
+
+        # Another profile is another key
+        self.assertIsNone(cache.lookup(sources[0],
+                                       transcode.TranscodeProfile("ogg")))
+
+        # 300 bytes in the cache, the least recently used song goes
+        self.assertEqual(1, cache.evict())
+        self.assertIsNotNone(cache.lookup(sources[0], profile))
+        self.assertIsNone(cache.lookup(sources[1], profile))
+        self.assertIsNotNone(cache.lookup(sources[2], profile))
+
+    def test_transcode_cache_ignores_tags(self):
+        cache = transcode.TranscodeCache(self.create_temp_dir(), 1000)
+        profile = transcode.TranscodeProfile("mp3")
+        src = os.path.join(self.create_temp_dir(), "song.flac")
+        with open(src, "wb") as f:
+            f.write(b"fLaC" + b"\x84\x00\x00\x04" + b"tag1" + b"audio" * 20)
+        partial = cache.get_partial_path(src, profile)
+        with open(partial, "wb") as f:
+            f.write(b"y" * 100)
+        cache.store(partial, src, profile)
+
+        # The play count written to the tags does not miss the cache
+        with open(src, "wb") as f:
+            f.write(b"fLaC" + b"\x84\x00\x00\x08" + b"tag1tag2" +
+                    b"audio" * 20)
+        os.utime(src, (2000000000, 2000000000))
+        self.assertIsNotNone(cache.lookup(src, profile))
@@ -0,0 +1,90 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+from unittest import mock
+
+from beetsplug.goingrunning import itempick
+
+from test.helper import UnitTestHelper
+
+
+class ItemPickTest(UnitTestHelper):
+    """Test methods in the beetsplug.goingrunning.itempick module
+    """
+
+    def test_size_budgeted_picker(self):
+        items = [self.create_item(length=200) for i in range(6)]
+        sizes = [100, 100, 100, 100, 900, 500]
+
+        picker = itempick.SizeBudgetedPicker()
+        picker.setup(None, items, 600)
+        picker.set_size_budget(1000, sizes)
+        picked = picker.get_picked_items()
+
+        # The largest (top) item does not fit: it is skipped
+        self.assertListEqual([items[5], items[3], items[2]], picked)
+
+    def test_size_budgeted_picker_missing_files(self):
+        items = [self.create_item(length=200) for i in range(3)]
+        picker = itempick.SizeBudgetedPicker()
+        picker.setup(None, items, 600)
+        picker.set_size_budget(1000, [100, None, 100])
+        self.assertListEqual([items[2], items[0]], picker.get_picked_items())
+
+    def test_size_budget_applies_to_all_pickers(self):
+        items = [self.create_item(length=200) for i in range(4)]
+        picker = FromTopPicker()
+        picker.setup(None, items, 800)
+        picker.set_size_budget(250, [100, 100, 100, 100])
+        picked = picker.get_picked_items()
+
+        # The items at the end of the selection are dropped
+        self.assertListEqual([items[3], items[2]], picked)
+
+    def test_size_budget_sizes_of_selection_only(self):
+        items = [self.create_item(length=200, path="/music/song_{}.mp3"
+                                  .format(i).encode()) for i in range(200)]
+        picker = FromTopPicker()
+        picker.setup(None, items, 600)
+        picker.set_size_budget(1000)
+        with mock.patch.object(itempick.common, "get_file_sizes",
+                               side_effect=_get_file_sizes) as get_sizes:
+            self.assertListEqual([items[199], items[198], items[197]],
+                                 picker.get_picked_items())
+
+        # Only the selected files are looked up, in one batch
+        get_sizes.assert_called_once()
+        self.assertEqual(3, len(list(get_sizes.call_args.args[0])))
+
+    def test_size_budgeted_picker_sizes_of_candidates_only(self):
+        items = [self.create_item(length=200, path="/music/song_{}.mp3"
+                                  .format(i).encode()) for i in range(200)]
+        picker = itempick.SizeBudgetedPicker()
+        picker.setup(None, items, 600)
+        picker.set_size_budget(1000)
+        with mock.patch.object(itempick.common, "get_file_sizes",
+                               side_effect=_get_file_sizes) as get_sizes:
+            self.assertListEqual([items[199], items[198], items[197]],
+                                 picker.get_picked_items())
+
+        # Only the first batch of candidates is looked up
+        paths = [path for call in get_sizes.call_args_list
+                 for path in call.args[0]]
+        self.assertEqual(itempick.SIZE_BATCH, len(paths))
+
+
+class FromTopPicker(itempick.BasePicker):
+    """Picks the items from the top, each one once, up to the duration"""
+
+    def _make_selection(self):
+        for index in range(len(self.items) - 1, -1, -1):
+            if sum(s["length"] for s in self.selection) >= self.duration:
+                break
+            self.selection.append({
+                "index": index,
+                "length": self.items[index].get("length")
+            })
+
+
+def _get_file_sizes(paths):
+    return {path: 100 for path in paths}
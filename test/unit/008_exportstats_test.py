@@ -0,0 +1,53 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+from beetsplug.goingrunning import exportstats
+
+from test.helper import UnitTestHelper
+
+
+class ExportStatsTest(UnitTestHelper):
+    """Test methods in the beetsplug.goingrunning.exportstats module
+    """
+
+    def test_stages(self):
+        stats = exportstats.ExportStats()
+        with stats.stage("clean"):
+            pass
+        stats.add_stage("copy", 2.0)
+        stats.add_stage("copy", 2.0)
+        self.assertListEqual(["clean", "copy"], list(stats.stages.keys()))
+        self.assertEqual(4.0, stats.stages["copy"])
+
+        stats.add_file(1000, 0.1)
+        stats.add_file(3000, 0.2)
+        self.assertEqual(2, stats.files)
+        self.assertEqual(4000, stats.bytes)
+        self.assertEqual(1000, stats.throughput)
+
+    def test_latency_histogram(self):
+        stats = exportstats.ExportStats()
+        for latency in [0.005, 0.02, 0.02, 0.3, 20]:
+            stats.add_file(100, latency)
+
+        histogram = stats.get_histogram()
+        self.assertEqual(1, histogram["<10ms"])
+        self.assertEqual(2, histogram["<25ms"])
+        self.assertEqual(1, histogram["<500ms"])
+        self.assertEqual(1, histogram[">=10000ms"])
+        self.assertEqual(5, sum(histogram.values()))
+
+        self.assertEqual(0.02, stats.get_percentile(50))
+        self.assertEqual(20, stats.get_percentile(100))
+
+    def test_to_dict(self):
+        stats = exportstats.ExportStats()
+        self.assertEqual(0, stats.to_dict()["files"])
+        self.assertNotIn("p50", stats.to_dict()["latency"])
+
+        stats.add_stage("copy", 1.0)
+        stats.add_file(2048, 0.5)
+        report = stats.to_dict()
+        self.assertEqual(2048, report["throughput"])
+        self.assertEqual(0.5, report["latency"]["p50"])
+        self.assertEqual(4, len(stats.get_summary_lines()))
@@ -0,0 +1,108 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+import multiprocessing
+import os
+from unittest import mock
+
+from beets import config, library
+from beetsplug.goingrunning import tagwrite
+
+from test.helper import UnitTestHelper
+
+
+class TagWriteTest(UnitTestHelper):
+    """Test methods in the beetsplug.goingrunning.tagwrite module
+    """
+
+    def _get_queue(self):
+        return tagwrite.TagWriteQueue(
+            os.path.join(self.create_temp_dir(), "tag_writes.json"))
+
+    def _get_library(self, count=3):
+        config.add({"timeout": 5.0})
+        lib = library.Library(os.path.join(self.create_temp_dir(),
+                                           "library.db"))
+        items = []
+        for i in range(count):
+            item = library.Item(title="song {}".format(i))
+            lib.add(item)
+            items.append(item)
+        return lib, items
+
+    def test_queue_is_persistent(self):
+        queue = self._get_queue()
+        self.assertDictEqual({}, queue.get_pending())
+
+        queue.add([1, 2, None])
+        queue.add([2, 3])
+        self.assertDictEqual({1: 0, 2: 0, 3: 0}, queue.get_pending())
+
+        queue = tagwrite.TagWriteQueue(queue.path)
+        self.assertDictEqual({1: 0, 2: 0, 3: 0}, queue.get_pending())
+
+    def test_drain(self):
+        lib, items = self._get_library(3)
+        queue = self._get_queue()
+        queue.add([item.id for item in items] + [999])
+
+        def write(item_self, *args, **kwargs):
+            if item_self.id == items[1].id:
+                raise library.WriteError(item_self.path, "broken")
+
+        with mock.patch.object(library.Item, "write", write):
+            written, failed = queue.drain(lib, workers=2)
+
+        self.assertEqual(2, written)
+        self.assertEqual(1, failed)
+        # The failed write is retried on the next run
+        self.assertDictEqual({items[1].id: 1}, queue.get_pending())
+
+        with mock.patch.object(library.Item, "write"):
+            self.assertTupleEqual((1, 0), queue.drain(lib))
+        self.assertDictEqual({}, queue.get_pending())
+
+    def test_drain_gives_up(self):
+        lib, items = self._get_library(1)
+        queue = self._get_queue()
+        queue.add([items[0].id])
+
+        write = mock.Mock(side_effect=library.WriteError("x", "broken"))
+        with mock.patch.object(library.Item, "write", write):
+            for i in range(tagwrite.MAX_ATTEMPTS):
+                self.assertTupleEqual((0, 1), queue.drain(lib))
+
+        self.assertDictEqual({}, queue.get_pending())
+
+    def test_queue_per_library(self):
+        lib1, items1 = self._get_library(2)
+        lib2, items2 = self._get_library(1)
+        tagwrite.get_tag_write_queue(lib1).add(item.id for item in items1)
+
+        # The ids of a library are never drained against another one
+        self.assertDictEqual({}, tagwrite.get_tag_write_queue(lib2)
+                             .get_pending())
+        self.assertDictEqual({item.id: 0 for item in items1},
+                             tagwrite.get_tag_write_queue(lib1)
+                             .get_pending())
+
+    def test_queue_shared_by_processes(self):
+        queue = self._get_queue()
+        processes = [multiprocessing.Process(
+            target=_add_one_by_one, args=(queue.path, range(i * 20,
+                                                            (i + 1) * 20)))
+            for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        # No process lost the ids added by the others
+        self.assertListEqual(list(range(1, 80)),
+                             sorted(queue.get_pending().keys()))
+
+
+def _add_one_by_one(path, item_ids):
+    queue = tagwrite.TagWriteQueue(path)
+    for item_id in item_ids:
+        queue.add([item_id])
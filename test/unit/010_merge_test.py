@@ -0,0 +1,105 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+import os
+from unittest import mock
+
+from beets import util
+from beetsplug.goingrunning import merge
+
+from test.helper import UnitTestHelper
+
+# MPEG 1 Layer III, 128kbit/s, 44100Hz, stereo, no CRC: 417 bytes per frame
+FRAME_HEADER = b"\xff\xfb\x90\x00"
+FRAME_LENGTH = 417
+
+
+class MergeTest(UnitTestHelper):
+    """Test methods in the beetsplug.goingrunning.merge module
+    """
+
+    def _create_mp3(self, frames=3, id3v2=True, xing=True, id3v1=True,
+                    header=FRAME_HEADER):
+        audio = b""
+        for i in range(frames):
+            audio += header + bytes([i + 1]) * (FRAME_LENGTH - 4)
+
+        data = b""
+        if id3v2:
+            data += b"ID3\x04\x00\x00\x00\x00\x00\x14" + b"\x00" * 20
+        if xing:
+            info = FRAME_HEADER + b"\x00" * 32 + b"Xing"
+            data += info + b"\x00" * (FRAME_LENGTH - len(info))
+        data += audio
+        if id3v1:
+            data += b"TAG" + b"\x00" * 125
+
+        path = os.path.join(self.create_temp_dir(), "song.mp3")
+        with open(path, "wb") as f:
+            f.write(data)
+        return path, audio
+
+    def test_get_mp3_audio_range(self):
+        path, audio = self._create_mp3()
+        start, end = merge.get_mp3_audio_range(path)
+        with open(path, "rb") as f:
+            f.seek(start)
+            self.assertEqual(audio, f.read(end - start))
+
+        path, audio = self._create_mp3(id3v2=False, xing=False, id3v1=False)
+        self.assertTupleEqual((0, len(audio)),
+                              merge.get_mp3_audio_range(path))
+
+    def test_get_mp3_audio_range_of_fixture(self):
+        path = os.path.join(self._test_fixture_dir, b"song.mp3")
+        start, end = merge.get_mp3_audio_range(path)
+        self.assertEqual(1295, start)
+        with open(path, "rb") as f:
+            f.seek(start)
+            self.assertIsNotNone(merge._get_mp3_frame_length(f.read(4)))
+
+    def test_concatenate_mp3(self):
+        paths = []
+        expected = b""
+        for i in range(3):
+            path, audio = self._create_mp3(frames=i + 1)
+            paths.append(path)
+            expected += audio
+
+        dst = os.path.join(self.create_temp_dir(), "merged.mp3")
+        written = merge.concatenate_mp3(paths, dst, buffer_size=100)
+        self.assertEqual(len(expected), written)
+        with open(dst, "rb") as f:
+            self.assertEqual(expected, f.read())
+
+    def test_can_concatenate(self):
+        paths = [self._create_mp3()[0], self._create_mp3(xing=False)[0]]
+        self.assertTrue(merge.can_concatenate(paths))
+        self.assertTrue(merge.can_concatenate(
+            [util.bytestring_path(path) for path in paths]))
+        self.assertFalse(merge.can_concatenate([paths[0], b"/b.flac"]))
+        self.assertFalse(merge.can_concatenate(paths, ".ogg"))
+        self.assertFalse(merge.can_concatenate([]))
+        self.assertFalse(merge.can_concatenate([b"/missing.mp3"]))
+
+    def test_can_concatenate_mismatched_formats(self):
+        path = self._create_mp3(xing=False)[0]
+        for header in [b"\xff\xfb\x94\x00",  # 48000Hz
+                       b"\xff\xf3\x90\x00",  # MPEG 2, 22050Hz
+                       b"\xff\xfb\x90\xc0"]:  # mono
+            other = self._create_mp3(xing=False, header=header)[0]
+            self.assertFalse(merge.can_concatenate([path, other]))
+            self.assertTrue(merge.can_concatenate([other, other]))
+
+        self.assertTupleEqual((3, 44100, 2),
+                              merge.get_mp3_stream_format(path))
+
+        # Audio that does not start with a frame is not joined
+        broken = self._create_mp3(xing=False, header=b"\x00\x00\x00\x00")[0]
+        self.assertIsNone(merge.get_mp3_stream_format(broken))
+        self.assertFalse(merge.can_concatenate([path, broken]))
+
+    def test_encode_merged_without_encoder(self):
+        with mock.patch.object(merge.shutil, "which", return_value=None):
+            with self.assertRaises(util.FilesystemError):
+                merge.encode_merged([b"/a.flac"], "/tmp/x.mp3", 192)
@@ -0,0 +1,91 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+import hashlib
+import os
+import shutil
+
+from beetsplug.goingrunning import verify
+
+from test.helper import UnitTestHelper
+
+
+class VerifyTest(UnitTestHelper):
+    """Test methods in the beetsplug.goingrunning.verify module
+    """
+
+    def _create_file(self, content, name="song.mp3"):
+        path = os.path.join(self.create_temp_dir(), name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_hash_file(self):
+        content = os.urandom(100000)
+        path = self._create_file(content)
+        expected = hashlib.sha1(content).hexdigest()
+        self.assertEqual(expected, verify.hash_file(path))
+        self.assertEqual(expected, verify.hash_file(path, drop_cache=True))
+
+        path = self._create_file(b"")
+        self.assertEqual(hashlib.sha1(b"").hexdigest(),
+                         verify.hash_file(path))
+
+    def test_source_hash_cache(self):
+        store = os.path.join(self.create_temp_dir(), "hashes.json")
+        path = self._create_file(b"a" * 1000)
+
+        cache = verify.SourceHashCache(store)
+        value = cache.get_hash(path)
+        self.assertEqual(value, cache.get_hash(path))
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(1, cache.hits)
+        cache.save()
+
+        cache = verify.SourceHashCache(store)
+        self.assertEqual(value, cache.get_hash(path))
+        self.assertEqual(1, cache.hits)
+
+        # A modified file is hashed again
+        with open(path, "wb") as f:
+            f.write(b"b" * 1001)
+        self.assertNotEqual(value, cache.get_hash(path))
+        self.assertEqual(1, cache.misses)
+
+    def test_source_hash_cache_shared(self):
+        store = os.path.join(self.create_temp_dir(), "hashes.json")
+        path1 = self._create_file(b"a" * 1000)
+        path2 = self._create_file(b"b" * 1000)
+
+        # Two runs hash different songs and save one after the other
+        cache1 = verify.SourceHashCache(store)
+        cache2 = verify.SourceHashCache(store)
+        cache1.get_hash(path1)
+        cache2.get_hash(path2)
+        cache1.save()
+        cache2.save()
+
+        cache = verify.SourceHashCache(store)
+        cache.get_hash(path1)
+        cache.get_hash(path2)
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(0, cache.misses)
+
+    def test_verifier(self):
+        pairs = []
+        for i in range(4):
+            src = self._create_file(os.urandom(10000))
+            dst = os.path.join(self.create_temp_dir(), "copy.mp3")
+            shutil.copy(src, dst)
+            pairs.append((src, dst))
+
+        # A corrupted and a missing copy
+        with open(pairs[1][1], "r+b") as f:
+            f.write(b"x")
+        os.remove(pairs[3][1])
+
+        cache = verify.SourceHashCache(
+            os.path.join(self.create_temp_dir(), "hashes.json"))
+        verifier = verify.Verifier(cache, workers=3)
+        self.assertListEqual([pairs[1], pairs[3]], verifier.verify(pairs))
+        self.assertTrue(os.path.isfile(cache.path))
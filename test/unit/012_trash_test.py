@@ -0,0 +1,52 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+import os
+
+from beetsplug.goingrunning import trash
+
+from test.helper import UnitTestHelper
+
+
+class TrashTest(UnitTestHelper):
+    """Test methods in the beetsplug.goingrunning.trash module
+    """
+
+    def _create_tree(self, root, name, files=3):
+        folder = os.path.join(root, name)
+        os.makedirs(folder)
+        for i in range(files):
+            with open(os.path.join(folder, "{}.mp3".format(i)), "wb") as f:
+                f.write(b"x" * 100)
+        return folder
+
+    def test_discard(self):
+        root = self.create_temp_dir()
+        folder = self._create_tree(root, "training")
+        trash_bin = trash.Trash(root)
+        trash_bin.discard(folder)
+
+        # The folder is gone right away and can be created again
+        self.assertFalse(os.path.exists(folder))
+        os.mkdir(folder)
+
+        self.assertListEqual([], trash_bin.wait())
+        self.assertListEqual(["training"], os.listdir(root))
+
+    def test_delete_and_leftovers(self):
+        root = self.create_temp_dir()
+        leftover = self._create_tree(root, trash.TRASH_PREFIX + "old")
+        song = os.path.join(root, "song.mp3")
+        with open(song, "wb") as f:
+            f.write(b"x")
+
+        trash_bin = trash.Trash(root)
+        trash_bin.discard_leftovers()
+        trash_bin.delete(song)
+        trash_bin.delete(os.path.join(root, "missing.mp3"))
+
+        errors = trash_bin.wait()
+        self.assertEqual(1, len(errors))
+        self.assertFalse(os.path.exists(leftover))
+        self.assertListEqual([], os.listdir(root))
+        self.assertTrue(trash.is_trash(os.path.basename(leftover)))
@@ -0,0 +1,74 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+import multiprocessing
+import os
+
+from beetsplug.goingrunning import estimate
+
+from test.helper import UnitTestHelper
+
+
+class EstimateTest(UnitTestHelper):
+    """Test methods in the beetsplug.goingrunning.estimate module
+    """
+
+    @staticmethod
+    def _get_sample(files, size, overhead=0.05, throughput=10000000):
+        return {"files": files, "bytes": size,
+                "seconds": files * overhead + size / throughput}
+
+    def test_fit_profile(self):
+        self.assertIsNone(estimate.fit_profile([]))
+
+        samples = [self._get_sample(10, 50000000),
+                   self._get_sample(100, 60000000),
+                   self._get_sample(30, 200000000)]
+        overhead, throughput = estimate.fit_profile(samples)
+        self.assertAlmostEqual(0.05, overhead, places=4)
+        self.assertAlmostEqual(10000000, throughput, delta=1)
+        self.assertAlmostEqual(
+            samples[0]["seconds"],
+            estimate.estimate_seconds((overhead, throughput), 10, 50000000))
+
+        # One export cannot tell the overhead from the throughput
+        overhead, throughput = estimate.fit_profile(samples[0:1])
+        self.assertEqual(0, overhead)
+        self.assertAlmostEqual(50000000 / samples[0]["seconds"], throughput)
+
+    def test_profiles_store(self):
+        path = os.path.join(self.create_temp_dir(), "throughput.json")
+        profiles = estimate.ThroughputProfiles(path)
+        self.assertIsNone(profiles.get_profile("MPD1:files:1"))
+
+        for i in range(estimate.MAX_SAMPLES + 5):
+            profiles.add_sample("MPD1:files:1", 10 + i, 1000000 * (i + 1),
+                                0.5 + i)
+
+        profiles = estimate.ThroughputProfiles(path)
+        samples = profiles.get_samples("MPD1:files:1")
+        self.assertEqual(estimate.MAX_SAMPLES, len(samples))
+        self.assertEqual(15, samples[0]["files"])
+        self.assertIsNotNone(profiles.get_profile("MPD1:files:1"))
+        self.assertIsNone(profiles.get_profile("MPD2:files:1"))
+
+    def test_profiles_store_shared_by_processes(self):
+        path = os.path.join(self.create_temp_dir(), "throughput.json")
+        processes = [multiprocessing.Process(
+            target=_add_samples, args=(path, "MPD{}:files:1".format(i % 2)))
+            for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        # No process lost the samples added by the others
+        profiles = estimate.ThroughputProfiles(path)
+        self.assertEqual(10, len(profiles.get_samples("MPD0:files:1")))
+        self.assertEqual(10, len(profiles.get_samples("MPD1:files:1")))
+
+
+def _add_samples(path, key):
+    profiles = estimate.ThroughputProfiles(path)
+    for i in range(5):
+        profiles.add_sample(key, 1, 1000, 0.1)
@@ -0,0 +1,156 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+import os
+
+from beets import config, library
+from beets.dbcore import query
+from beetsplug.goingrunning import libquery
+
+from test.helper import UnitTestHelper
+
+
+class LibQueryTest(UnitTestHelper):
+    """Test methods in the beetsplug.goingrunning.libquery module
+    """
+
+    def _get_library(self):
+        config.add({"timeout": 5.0, "sort_item": "artist+ album+ track+",
+                    "sort_case_insensitive": True})
+        lib = library.Library(os.path.join(self.create_temp_dir(),
+                                           "library.db"))
+        for i in range(10):
+            item = library.Item(title="song {}".format(i), bpm=100 + i * 10,
+                                genre="Rock" if i % 2 else "Pop")
+            item["mood_happy"] = i / 10
+            lib.add(item)
+        return lib
+
+    def test_split_query(self):
+        fast_query = query.MatchQuery("genre", "Rock")
+        slow_query = query.NumericQuery("mood_happy", "0.5..", fast=False)
+        fast, slow = libquery.split_query(
+            query.AndQuery([fast_query, query.TrueQuery(), slow_query]))
+        self.assertListEqual([fast_query], fast.subqueries)
+        self.assertListEqual([slow_query], slow.subqueries)
+
+        fast, slow = libquery.split_query(fast_query)
+        self.assertListEqual([fast_query], fast.subqueries)
+        self.assertIsNone(slow)
+
+        fast, slow = libquery.split_query(query.AndQuery([query.TrueQuery()]))
+        self.assertIsNone(fast)
+        self.assertIsNone(slow)
+
+    def test_count_items(self):
+        lib = self._get_library()
+        queries = [
+            query.AndQuery([query.TrueQuery()]),
+            query.AndQuery([query.MatchQuery("genre", "Rock"),
+                            query.NumericQuery("bpm", "120..170")]),
+            query.AndQuery([query.MatchQuery("genre", "Rock"),
+                            query.NumericQuery("mood_happy", "0.5..",
+                                               fast=False)]),
+        ]
+        for parsed_query in queries:
+            expected = [item.id for item in lib.items(parsed_query)]
+            self.assertEqual(len(expected),
+                             libquery.count_items(lib, parsed_query))
+            self.assertListEqual(
+                expected, [item.id for item in
+                           libquery.get_items(lib, parsed_query)])
+
+        self.assertEqual(10, libquery.count_items(lib, queries[0]))
+        self.assertEqual(3, libquery.count_items(lib, queries[1]))
+        self.assertEqual(3, libquery.count_items(lib, queries[2]))
+
+    def test_flex_numeric_query(self):
+        lib = self._get_library()
+        queries = [
+            libquery.FlexNumericQuery("mood_happy", "0.3..0.6", fast=False),
+            libquery.FlexNumericQuery("mood_happy", "..0.2", fast=False),
+            libquery.FlexNumericQuery("mood_happy", "0.7", fast=False),
+            libquery.FlexNumericQuery("mood_happy", "..", fast=False),
+            libquery.FlexNumericQuery("bpm", "150..", fast=True),
+            query.NotQuery(libquery.FlexNumericQuery("mood_happy", "0.5..",
+                                                     fast=False)),
+        ]
+        for flex_query in queries:
+            self.assertIsNotNone(flex_query.clause()[0])
+            expected = [item.id for item in lib.items()
+                        if flex_query.match(item)]
+            self.assertListEqual(
+                sorted(expected),
+                sorted(item.id for item in lib.items(flex_query)))
+            self.assertEqual(len(expected),
+                             libquery.count_items(lib, flex_query))
+
+    def test_create_numeric_index(self):
+        lib = self._get_library()
+        libquery.create_numeric_index(lib)
+        libquery.create_numeric_index(lib)
+
+        where, subvals = libquery.FlexNumericQuery(
+            "mood_happy", "0.3..0.6", fast=False).clause()
+        with lib.transaction() as tx:
+            plan = tx.query("EXPLAIN QUERY PLAN SELECT id FROM items WHERE "
+                            + where, subvals)
+        self.assertIn(libquery.NUMERIC_INDEX_NAME,
+                      " ".join(str(row[-1]) for row in plan))
+
+    def test_get_light_items(self):
+        lib = self._get_library()
+        parsed_query = query.AndQuery([
+            query.MatchQuery("genre", "Rock"),
+            libquery.FlexNumericQuery("mood_happy", "0.2..", fast=False)])
+        items = libquery.get_light_items(lib, parsed_query,
+                                         ["length", "bpm", "mood_happy"])
+
+        expected = list(lib.items(parsed_query))
+        self.assertListEqual([item.id for item in expected],
+                             [item["id"] for item in items])
+        for item, lib_item in zip(items, expected):
+            self.assertListEqual(["id", "length", "bpm", "mood_happy"],
+                                 list(item.keys()))
+            self.assertEqual(lib_item.bpm, item.bpm)
+            self.assertEqual(float(lib_item.mood_happy),
+                             float(item.get("mood_happy")))
+            self.assertIsNone(item.get("play_count"))
+        with self.assertRaises(AttributeError):
+            getattr(items[0], "ordering_score")
+
+        # Only the selection is loaded with all its fields
+        hydrated = libquery.hydrate_items(lib, items[::-1])
+        self.assertListEqual([item.id for item in expected[::-1]],
+                             [item.id for item in hydrated])
+        self.assertIsInstance(hydrated[0], library.Item)
+
+        # Queries matched in Python need the full items
+        self.assertIsNone(libquery.get_light_items(
+            lib, query.NumericQuery("mood_happy", "0.2..", fast=False),
+            ["length"]))
+
+    def test_query_cache(self):
+        cache = libquery.QueryCache(max_size=2)
+        keys = [libquery.get_query_cache_key(["genre:rock"], {"bpm": i})
+                for i in range(3)]
+        self.assertEqual(3, len(set(keys)))
+        self.assertEqual(keys[0], libquery.get_query_cache_key(
+            ["genre:rock"], {"bpm": 0}))
+
+        built = []
+
+        def build(name):
+            return lambda: built.append(name) or name
+
+        self.assertEqual("q0", cache.get(keys[0], build("q0")))
+        self.assertEqual("q0", cache.get(keys[0], build("q0")))
+        cache.get(keys[1], build("q1"))
+        cache.get(keys[0], build("q0"))
+        # The least recently used query is dropped
+        cache.get(keys[2], build("q2"))
+        cache.get(keys[1], build("q1"))
+        self.assertListEqual(["q0", "q1", "q2", "q1"], built)
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(4, cache.misses)
+
@@ -0,0 +1,74 @@
+#  Copyright: Copyright (c) 2020., Adam Jakab
+#  Author: Adam Jakab <adam at jakab dot pro>
+#  License: See LICENSE.txt
+import os
+import struct
+
+from beetsplug.goingrunning import audiorange
+
+from test.helper import UnitTestHelper
+
+AUDIO = bytes(range(256)) * 20
+
+
+class AudioRangeTest(UnitTestHelper):
+    """Test methods in the beetsplug.goingrunning.audiorange module
+    """
+
+    def _create_file(self, data, name="song"):
+        path = os.path.join(self.create_temp_dir(), name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def _assert_audio(self, path, audio=AUDIO):
+        start, end = audiorange.get_audio_range(path)
+        with open(path, "rb") as f:
+            f.seek(start)
+            self.assertEqual(audio, f.read(end - start))
+
+    @staticmethod
+    def _get_flac(tags):
+        streaminfo = b"\x00\x00\x00\x22" + b"\x00" * 34
+        comments = bytes([0x84]) + len(tags).to_bytes(3, "big") + tags
+        return b"fLaC" + streaminfo + comments + AUDIO
+
+    @staticmethod
+    def _get_ogg_page(granule, sequence, packet):
+        return b"OggS\x00\x00" + struct.pack("<qII", granule, 1, sequence) + \
+            b"\x00\x00\x00\x00" + bytes([1, len(packet)]) + packet
+
+    def test_flac(self):
+        for tags in [b"", b"PLAY_COUNT=1", b"PLAY_COUNT=12" * 10]:
+            self._assert_audio(self._create_file(self._get_flac(tags),
+                                                 "song.flac"))
+
+        key1 = audiorange.get_audio_key(self._create_file(
+            self._get_flac(b"PLAY_COUNT=1")))
+        key2 = audiorange.get_audio_key(self._create_file(
+            self._get_flac(b"PLAY_COUNT=12")))
+        self.assertEqual(key1, key2)
+
+    def test_ogg(self):
+        audio = self._get_ogg_page(1024, 3, b"a" * 200) + \
+            self._get_ogg_page(2048, 4, b"b" * 200)
+        data = self._get_ogg_page(0, 0, b"\x01vorbis") + \
+            self._get_ogg_page(0, 1, b"\x03vorbis comments") + \
+            self._get_ogg_page(0, 2, b"\x05vorbis setup") + audio
+        self._assert_audio(self._create_file(data, "song.ogg"), audio)
+
+    def test_mp4(self):
+        ftyp = b"\x00\x00\x00\x10ftypM4A \x00\x00\x00\x00"
+        moov = b"\x00\x00\x00\x0cmoovtags"
+        mdat = (8 + len(AUDIO)).to_bytes(4, "big") + b"mdat" + AUDIO
+        self._assert_audio(self._create_file(ftyp + moov + mdat, "song.m4a"))
+        self._assert_audio(self._create_file(ftyp + mdat + moov, "song.m4a"))
+
+    def test_mp3(self):
+        tag = b"ID3\x04\x00\x00\x00\x00\x00\x14" + b"\x00" * 20
+        self._assert_audio(self._create_file(tag + AUDIO, "song.mp3"))
+
+    def test_unknown_format(self):
+        path = self._create_file(b"RIFF" + AUDIO, "song.wav")
+        self.assertTupleEqual((0, len(AUDIO) + 4),
+                              audiorange.get_audio_range(path))